@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import pandas as pd
+import numpy as np
+import logging
+import os
+from result_cache import file_checksum, cache_key, cache_fetch, cache_store
+
+
+def frq_keep(frq_prefix, chrom):
+
+    """ SNPs of the annotation files that ldsc --overlap-annot keeps: 0.05 < MAF < 0.95 in the .frq file """
+
+    frq = pd.read_csv(frq_prefix + str(chrom) + '.frq', delim_whitespace=True)
+    return ((frq.MAF > 0.05) & (frq.MAF < 0.95)).values
+
+
+def read_annot_matrix(prefixes, chrom, keep):
+
+    """ Annotation columns of one or more chr-split prefixes, restricted to the kept SNPs """
+
+    mats = []
+    for prefix in prefixes:
+        df = pd.read_csv(prefix + str(chrom) + '.annot.gz', compression='gzip', delim_whitespace=True)
+        df = df.drop([x for x in ['CHR','SNP','BP','CM'] if x in df.columns], axis=1)
+        mats.append(df.values[keep].astype(np.float64))
+    return np.column_stack(mats)
+
+
+def annot_checksums(prefixes, frq_prefix, chroms):
+    return [file_checksum(prefix + str(chrom) + '.annot.gz') for prefix in prefixes for chrom in chroms] + \
+           [file_checksum(frq_prefix + str(chrom) + '.frq') for chrom in chroms]
+
+
+def overlap_blocks(base_prefixes, cts_prefixes, frq_prefix, chroms=range(1,23), with_base=True):
+
+    """ One pass over the chromosomes: baseline overlap X'X and number of SNPs, and for each cts prefix X'C and the column sums of squares of C """
+
+    BB, M_tot = None, 0
+    BC = [None] * len(cts_prefixes)
+    CC = [None] * len(cts_prefixes)
+    for chrom in chroms:
+        keep = frq_keep(frq_prefix, chrom)
+        X = read_annot_matrix(base_prefixes, chrom, keep)
+        M_tot += len(X)
+        if with_base:
+            BB = np.dot(X.T, X) if BB is None else BB + np.dot(X.T, X)
+        for i, prefix in enumerate(cts_prefixes):
+            C = read_annot_matrix([prefix], chrom, keep)
+            xc, cc = np.dot(X.T, C), np.sum(C ** 2, axis=0)
+            BC[i] = xc if BC[i] is None else BC[i] + xc
+            CC[i] = cc if CC[i] is None else CC[i] + cc
+        logging.debug('Annotation overlap: chr ' + str(chrom) + ' done')
+    return BB, M_tot, BC, CC
+
+
+def cached_overlap(base_prefixes, cts_prefixes, frq_prefix, cache_dir, chroms=range(1,23), work_dir='/mnt/data'):
+
+    """ Baseline and per-cts overlap blocks, computing only the ones missing from the cache.
+        Adding one cts annotation to a panel only costs its own X'C block """
+
+    chroms = list(chroms)
+    base_key = cache_key(*annot_checksums(base_prefixes, frq_prefix, chroms))
+    tmp_dir = os.path.join(cache_dir if cache_dir and not cache_dir.startswith('gs://') else work_dir, 'tmp_overlap')
+    if not os.path.exists(tmp_dir):
+        os.makedirs(tmp_dir)
+
+    def fetch(key):
+        if cache_fetch(cache_dir, 'ldsc_overlap', key, ['overlap.npz'], tmp_dir, [key + '.npz']):
+            return dict(np.load(os.path.join(tmp_dir, key + '.npz')))
+        return None
+
+    def store(key, **arrays):
+        path = os.path.join(tmp_dir, key + '.npz')
+        np.savez(path, **arrays)
+        cache_store(cache_dir, 'ldsc_overlap', key, [path], ['overlap.npz'])
+
+    base = fetch(base_key)
+    cts_keys = [cache_key(base_key, *annot_checksums([x], frq_prefix, chroms)[:len(chroms)]) for x in cts_prefixes]
+    cts = [fetch(k) for k in cts_keys]
+    todo = [i for i, x in enumerate(cts) if x is None]
+    if base is None or todo:
+        logging.info('Computing annotation overlap for ' + ('the baseline and ' if base is None else '') + str(len(todo)) + ' cts annotation(s)')
+        BB, M_tot, BC, CC = overlap_blocks(base_prefixes, [cts_prefixes[i] for i in todo], frq_prefix, chroms, with_base=base is None)
+        if base is None:
+            base = {'BB': BB, 'M_tot': np.array(M_tot)}
+            store(base_key, **base)
+        for j, i in enumerate(todo):
+            cts[i] = {'BC': BC[j], 'CC': CC[j]}
+            store(cts_keys[i], **cts[i])
+    return base, cts
+
+
+def overlap_provider(base_prefixes, params_file, frq_prefix, cache_dir, chroms=range(1,23), work_dir='/mnt/data'):
+
+    """ Callable giving the overlap matrix of (conditional annotations, cts column j), for ldsc_regression.h2_cts, and M_tot """
+
+    cts_prefixes = []
+    with open(params_file, 'r') as f:
+        for line in f:
+            if line.strip():
+                cts_prefixes.append(line.strip().split()[1].split(','))
+    flat = [x for prefixes in cts_prefixes for x in prefixes]
+    base, cts = cached_overlap(base_prefixes, flat, frq_prefix, cache_dir, chroms, work_dir)
+    BC = np.column_stack([x['BC'] for x in cts])
+    CC = np.concatenate([x['CC'] for x in cts])
+    BB = base['BB']
+
+    def overlap(j):
+        n = len(BB)
+        out = np.empty((n + 1, n + 1))
+        out[:n, :n] = BB
+        out[:n, n] = out[n, :n] = BC[:, j]
+        out[n, n] = CC[j]
+        return out
+
+    return overlap, float(base['M_tot'])
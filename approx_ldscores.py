@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import pandas as pd
+import numpy as np
+import argparse
+import logging
+from ld_matrix_store import read_bim, read_fam, read_standardized_genotypes, write_ldscore_files
+
+
+APPROX_MODES = ['thin', 'sketch']
+PRINT_SNPS = {}
+
+
+def read_print_snps(print_snps_file):
+    if print_snps_file not in PRINT_SNPS:
+        PRINT_SNPS[print_snps_file] = set(pd.read_csv(print_snps_file, header=None, delim_whitespace=True)[0])
+    return PRINT_SNPS[print_snps_file]
+
+
+def read_thin_annot(annot_file):
+    annot_df = pd.read_csv(annot_file, compression='gzip', delim_whitespace=True)
+    return annot_df.drop([x for x in ['CHR','SNP','BP','CM'] if x in annot_df.columns], axis=1)
+
+
+def window_ldscores(geno, kept, cm, rows, annot, ld_wind_cm=1, fraction=1.0, rank=None, exact_cm=0.1, seed=0, chunk_size=500):
+
+    """ LD scores of the given rows within +-ld_wind_cm, as ldsc --l2. Pairs of SNPs closer than exact_cm, which carry
+        most of the LD, are always exact; the rest of the window is approximated: fraction < 1 sums r2 over a random
+        subset of those reference SNPs, scaled by 1 / fraction, and rank takes their correlations from a random
+        rank-dimensional sketch of the individuals """
+
+    n_indiv = geno.shape[1]
+    rng = np.random.RandomState(seed)
+    sketch = None
+    if rank:
+        # Gaussian sketch: inner products of the projected genotypes are unbiased for the full ones
+        sketch = np.dot(geno, (rng.randn(n_indiv, rank) / np.sqrt(rank)).astype(np.float32))
+    sampled = rng.rand(len(kept)) < fraction if fraction < 1 else np.ones(len(kept), dtype=bool)
+    annot = np.asarray(annot, dtype=np.float64)
+    left = np.searchsorted(cm, cm[rows] - ld_wind_cm, side='left')
+    right = np.searchsorted(cm, cm[rows] + ld_wind_cm, side='right')
+
+    def r2(x, y, bias=0):
+        block = np.dot(x, y.T) / n_indiv
+        block **= 2
+        if bias:
+            # E[r2 of the sketch] = r2 (1 + bias) + bias
+            block = (block - bias) / (1 + bias)
+        # Unbiased r2 estimator, as used by ldsc
+        return block - (1 - block) / (n_indiv - 2)
+
+    ldscores = annot[rows].copy()
+    for c0 in range(0, len(rows), chunk_size):
+        c1 = min(c0 + chunk_size, len(rows))
+        lo, hi = left[c0], right[c1 - 1]
+        cols = lo + np.flatnonzero(kept[lo:hi])
+        near = (cm[cols] >= cm[rows[c0]] - exact_cm) & (cm[cols] <= cm[rows[c1 - 1]] + exact_cm)
+        far = cols[~near & sampled[cols]]
+        parts = [(cols[near], r2(geno[rows[c0:c1]], geno[cols[near]]), 1.0)]
+        if sketch is not None:
+            parts.append((far, r2(sketch[rows[c0:c1]], sketch[far], 1.0 / rank), 1.0))
+        else:
+            parts.append((far, r2(geno[rows[c0:c1]], geno[far]), 1.0 / fraction))
+        for part_cols, block, weight in parts:
+            block[(part_cols[None, :] < left[c0:c1, None]) | (part_cols[None, :] >= right[c0:c1, None]) |
+                  (part_cols[None, :] == rows[c0:c1, None])] = 0
+            ldscores[c0:c1] += np.dot(block, annot[part_cols]) * weight
+        logging.debug('Approximate LDscores: ' + str(c1) + ' of ' + str(len(rows)) + ' SNPs done')
+    return ldscores
+
+
+def chromosome_ldscores(bfile, annot_df, print_snps_file=None, ld_wind_cm=1, fraction=1.0, rank=None, exact_cm=0.1, seed=0):
+
+    """ Printed SNPs, LD scores, M and M_5_50 of one chromosome for an annotation aligned to the plink panel """
+
+    bim = read_bim(bfile)
+    geno, maf = read_standardized_genotypes(bfile, len(read_fam(bfile)), len(bim))
+    kept = maf > 0
+    rows_mask = kept.copy()
+    if print_snps_file:
+        rows_mask &= bim.SNP.isin(read_print_snps(print_snps_file)).values
+    rows = np.flatnonzero(rows_mask)
+    annot = annot_df.values.astype(np.float64)
+    ldscores = window_ldscores(geno, kept, bim.CM.values, rows, annot, ld_wind_cm, fraction, rank, exact_cm, seed)
+    return bim.iloc[rows], ldscores, annot[kept].sum(axis=0), annot[kept & (maf > 0.05)].sum(axis=0)
+
+
+def calculate_ldscores_approx(bfile, annot_file, out_prefix, print_snps_file=None, ld_wind_cm=1, fraction=1.0, rank=None, exact_cm=0.1, seed=0):
+
+    """ Approximate drop-in replacement for ldsc.py --l2 --thin-annot --print-snps """
+
+    annot_df = read_thin_annot(annot_file)
+    bim_rows, ldscores, M, M_5_50 = chromosome_ldscores(bfile, annot_df, print_snps_file, ld_wind_cm, fraction, rank, exact_cm, seed)
+    write_ldscore_files(out_prefix, bim_rows, ldscores, list(annot_df.columns), M, M_5_50)
+
+
+def approximation_error(bfile, annot_file, out_file, print_snps_file=None, ld_wind_cm=1, fraction=1.0, rank=None, exact_cm=0.1, seed=0):
+
+    """ Compare approximate and exact LD scores of one (held-out) chromosome, one row per annotation """
+
+    annot_df = read_thin_annot(annot_file)
+    _, exact, _, _ = chromosome_ldscores(bfile, annot_df, print_snps_file, ld_wind_cm)
+    _, approx, _, _ = chromosome_ldscores(bfile, annot_df, print_snps_file, ld_wind_cm, fraction, rank, exact_cm, seed)
+    rows = []
+    for i, name in enumerate(annot_df.columns):
+        x, y = exact[:, i], approx[:, i]
+        scale = np.mean(np.abs(x)) or 1.0
+        rows.append((name, len(x), np.corrcoef(x, y)[0, 1] if np.std(x) > 0 else np.nan,
+                     np.mean(y - x) / scale, np.sqrt(np.mean((y - x) ** 2)) / scale, np.max(np.abs(y - x)) / scale))
+    df = pd.DataFrame(rows, columns=['Annotation','N_SNPs','Correlation','Relative_bias','Relative_RMSE','Relative_max_error'])
+    df.to_csv(out_file, sep='\t', index=False)
+    logging.info('Approximate LDscores against exact ones on ' + bfile + ': correlation ' + str(round(df.Correlation.min(), 4)) +
+                 ', relative RMSE ' + str(round(df.Relative_RMSE.max(), 4)) + ' (worst annotation)')
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bfile', required=True, help = 'Prefix of the plink files of one chromosome')
+    parser.add_argument('--annot', required=True, help = 'Thin .annot.gz file aligned to the plink .bim')
+    parser.add_argument('--print-snps', help = 'File with the SNPs to print LDscores for, one per line')
+    parser.add_argument('--ld-wind-cm', type=float, default=1, help = 'Window size in cM, default=1')
+    parser.add_argument('--mode', choices=APPROX_MODES, default='thin', help = 'thin: sum r2 over a random subset of the reference SNPs; sketch: correlations from a random projection of the individuals')
+    parser.add_argument('--fraction', type=float, default=0.1, help = 'Fraction of the reference SNPs kept with --mode thin, default=0.1')
+    parser.add_argument('--rank', type=int, default=64, help = 'Sketch dimension with --mode sketch, default=64')
+    parser.add_argument('--exact-cm', type=float, default=0.1, help = 'Pairs of SNPs closer than this (cM) are always exact, default=0.1')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check', action='store_true', default=False, help = 'Also compute the exact LDscores and write <out>.approx_error.txt')
+    parser.add_argument('--out', required=True, help = 'Output prefix, as ldsc.py --out')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    fraction = args.fraction if args.mode == 'thin' else 1.0
+    rank = args.rank if args.mode == 'sketch' else None
+    calculate_ldscores_approx(args.bfile, args.annot, args.out, args.print_snps, args.ld_wind_cm, fraction, rank, args.exact_cm, args.seed)
+    if args.check:
+        approximation_error(args.bfile, args.annot, args.out + '.approx_error.txt', args.print_snps, args.ld_wind_cm, fraction, rank, args.exact_cm, args.seed)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import glob
+import logging
+import os
+import shutil
+import subprocess
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+LDSCORE_SUFFIXES = ['.l2.ldscore.gz', '.l2.M', '.l2.M_5_50']
+
+
+def is_gcs(path):
+    return path.startswith('gs://')
+
+
+def copy_file(src, dest):
+
+    """ Copy one local file to a bucket path (gsutil) or to a local folder standing in for it """
+
+    if is_gcs(dest):
+        return subprocess.call(['gsutil','-q','cp',src,dest]) == 0
+    try:
+        os.makedirs(os.path.dirname(dest))
+    except OSError:
+        if not os.path.isdir(os.path.dirname(dest)):
+            raise
+    tmp = dest + '.tmp' + str(os.getpid())
+    shutil.copy(src, tmp)
+    os.rename(tmp, dest)
+    return True
+
+
+def copy_files(srcs, dest_dir):
+
+    """ Copy local files into a bucket folder with one parallel gsutil call (or into a local folder standing in for it) """
+
+    if is_gcs(dest_dir):
+        proc = subprocess.Popen(['gsutil','-m','-q','cp','-I',os.path.join(dest_dir, '')], stdin=subprocess.PIPE)
+        proc.communicate(''.join(x + '\n' for x in srcs).encode('utf-8'))
+        return proc.returncode == 0
+    return all([copy_file(src, os.path.join(dest_dir, os.path.basename(src))) for src in srcs])
+
+
+def remote_sizes(dest_dir):
+
+    """ Size in bytes of the files of a folder, by name, from one listing """
+
+    if is_gcs(dest_dir):
+        try:
+            out = subprocess.check_output(['gsutil','ls','-l',os.path.join(dest_dir, '')]).decode('utf-8')
+        except subprocess.CalledProcessError:
+            return {}
+        fields = [x.split() for x in out.splitlines()]
+        # Object lines are "size date url"; sub-folders and the TOTAL line have no url after a size
+        return dict((x[2].rstrip('/').split('/')[-1], int(x[0])) for x in fields if len(x) == 3 and x[0].isdigit())
+    if not os.path.isdir(dest_dir):
+        return {}
+    return dict((x, os.path.getsize(os.path.join(dest_dir, x))) for x in os.listdir(dest_dir))
+
+
+def ldscore_sets_ready(local_dir):
+
+    """ Files of the per-chromosome LDscore sets of local_dir that are complete.
+        ldsc.py and ld_matrix_store.py write .l2.M_5_50 last, so a set is done once it exists """
+
+    files = []
+    for m_file in glob.glob(os.path.join(local_dir, '*.l2.M_5_50')):
+        base = m_file[:-len('.l2.M_5_50')]
+        if all(os.path.exists(base + x) for x in LDSCORE_SUFFIXES):
+            files += [base + x for x in LDSCORE_SUFFIXES]
+    return files
+
+
+class AsyncUploader(object):
+
+    """ Upload result files in background threads while the pipeline keeps computing. Each thread takes all the
+        queued files and sends those of one destination folder with a single gsutil -m cp -I """
+
+    def __init__(self, n_threads=2, poll_seconds=30, retries=3):
+        self.queue = queue.Queue()
+        self.poll_seconds = poll_seconds
+        self.retries = retries
+        self.uploaded = {}
+        self.failed = []
+        self.watched = []
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.threads = [threading.Thread(target=self._work) for i in range(n_threads)]
+        self.watcher = threading.Thread(target=self._watch)
+        for t in self.threads + [self.watcher]:
+            t.daemon = True
+            t.start()
+
+    def submit(self, path, dest_dir):
+
+        """ Queue a finished local file (or glob pattern) for upload into dest_dir.
+            A file is sent again only if it was modified since its last upload """
+
+        for src in sorted(glob.glob(path)):
+            if not os.path.isfile(src):
+                continue
+            stamp = (dest_dir, os.path.getmtime(src), os.path.getsize(src))
+            with self.lock:
+                if self.uploaded.get(src) == stamp:
+                    continue
+                self.uploaded[src] = stamp
+            self.queue.put((src, dest_dir))
+
+    def watch(self, local_dir, dest_dir, ready=ldscore_sets_ready):
+
+        """ Upload the files of local_dir that ready() reports as complete, as soon as they appear """
+
+        self.watched.append((local_dir, dest_dir, ready))
+
+    def _scan(self):
+        for local_dir, dest_dir, ready in self.watched:
+            for src in ready(local_dir):
+                self.submit(src, dest_dir)
+
+    def _watch(self):
+        while not self.stop.wait(self.poll_seconds):
+            self._scan()
+
+    def _batch(self):
+
+        """ The next queued file and every other file queued by now """
+
+        batch = [self.queue.get()]
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def _work(self):
+        while True:
+            batch = self._batch()
+            by_dest = {}
+            for src, dest_dir in batch:
+                if src not in by_dest.setdefault(dest_dir, []):
+                    by_dest[dest_dir].append(src)
+            for dest_dir, srcs in by_dest.items():
+                try:
+                    ok = False
+                    for attempt in range(self.retries):
+                        if copy_files(srcs, dest_dir):
+                            ok = True
+                            break
+                        logging.warning('Upload of ' + str(len(srcs)) + ' files to ' + dest_dir + ' failed, attempt ' + str(attempt + 1))
+                    if ok:
+                        logging.debug('Uploaded ' + str(len(srcs)) + ' files to ' + dest_dir)
+                    else:
+                        with self.lock:
+                            self.failed += srcs
+                except Exception as e:
+                    logging.error('Upload of ' + str(len(srcs)) + ' files to ' + dest_dir + ' failed: ' + str(e))
+                    with self.lock:
+                        self.failed += srcs
+            for item in batch:
+                self.queue.task_done()
+
+    def close(self, flush_watched=True):
+
+        """ Upload whatever is still pending (and, optionally, everything left in the watched folders),
+            wait for the uploads and check every file arrived with the local size. Returns the files that did not """
+
+        self.stop.set()
+        self.watcher.join()
+        self._scan()
+        if flush_watched:
+            for local_dir, dest_dir, ready in self.watched:
+                self.submit(os.path.join(local_dir, '*'), dest_dir)
+        self.queue.join()
+
+        missing = list(self.failed)
+        # One listing per destination folder, compared with the sizes at submission (the local files may be removed since)
+        sizes = dict((x, remote_sizes(x)) for x in set(stamp[0] for stamp in self.uploaded.values()))
+        for src, stamp in sorted(self.uploaded.items()):
+            if src not in missing and sizes[stamp[0]].get(os.path.basename(src)) != stamp[2]:
+                missing.append(src)
+        if missing:
+            logging.error('Files not uploaded: ' + ','.join(missing))
+        else:
+            logging.info(str(len(self.uploaded)) + ' files uploaded and verified')
+        return missing
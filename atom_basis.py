@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+import argparse
+import json
+import logging
+import os
+import shutil
+from ld_matrix_store import read_bim, read_fam, read_standardized_genotypes, write_ldscore_files
+from ldscore_api import normalize_chrom, gene_window, annotate_snps
+from gene_windows import parse_window
+from resident import resident_load
+from result_cache import file_checksum
+
+
+def snp_atoms(windows, bim):
+
+    """ Atom of each panel SNP, -1 outside all windows. The window boundaries split a chromosome into segments
+        covered by a fixed set of gene windows; the segments holding panel SNPs are the atoms, so any union of
+        windows is exactly a union of atoms """
+
+    covered = annotate_snps(windows, bim, binary=True) > 0
+    bounds = np.unique(np.concatenate([windows.START.values, windows.END.values + 1]))
+    segment = np.searchsorted(bounds, bim.BP.values, side='right')
+    atoms = np.full(len(bim), -1, dtype=np.int64)
+    _, atoms[covered] = np.unique(segment[covered], return_inverse=True)
+    return atoms
+
+
+def build_chromosome(bfile, windows, out_dir, ld_wind_cm=1, print_snps=None, chunk_size=2000):
+
+    """ Compute and save the per-atom LD score contributions (printed SNPs x atoms) of one chromosome """
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    bim = read_bim(bfile)
+    n_indiv = len(read_fam(bfile))
+    geno, maf = read_standardized_genotypes(bfile, n_indiv, len(bim))
+    kept = maf > 0
+    atoms = snp_atoms(windows, bim)
+    n_atoms = int(atoms.max()) + 1
+
+    rows_mask = kept.copy()
+    if print_snps is not None:
+        rows_mask &= bim.SNP.isin(print_snps).values
+    rows = np.flatnonzero(rows_mask)
+    cm = bim.CM.values
+    left = np.searchsorted(cm, cm[rows] - ld_wind_cm, side='left')
+    right = np.searchsorted(cm, cm[rows] + ld_wind_cm, side='right')
+
+    entries = []
+    for c0 in range(0, len(rows), chunk_size):
+        c1 = min(c0 + chunk_size, len(rows))
+        lo, hi = left[c0], right[c1 - 1]
+        cols = lo + np.flatnonzero(kept[lo:hi] & (atoms[lo:hi] >= 0))
+        if not len(cols):
+            continue
+        block = np.dot(geno[rows[c0:c1]], geno[cols].T) / n_indiv
+        block **= 2
+        # Unbiased r2 estimator, as used by ldsc
+        block -= (1 - block) / (n_indiv - 2)
+        block[(cols[None, :] < left[c0:c1, None]) | (cols[None, :] >= right[c0:c1, None])] = 0
+        # Sum the r2 of the window SNPs of each atom
+        a0 = atoms[cols].min()
+        indicator = sp.csr_matrix((np.ones(len(cols), dtype=np.float32), (np.arange(len(cols)), atoms[cols] - a0)))
+        contrib = sp.coo_matrix(indicator.T.dot(block.T).T.astype(np.float32))
+        entries.append((contrib.row + c0, contrib.col + a0, contrib.data))
+        logging.debug('Atom basis: ' + str(c1) + ' of ' + str(len(rows)) + ' rows done')
+    i, j, data = [np.concatenate([x[k] for x in entries]) if entries else np.zeros(0) for k in range(3)]
+    l2 = sp.csr_matrix((data.astype(np.float32), (i, j)), shape=(len(rows), n_atoms))
+
+    # CSR arrays as .npy files, as ld_matrix_store.py (scipy.sparse.save_npz needs scipy 0.19)
+    for x in ['data', 'indices', 'indptr']:
+        np.save(os.path.join(out_dir, 'l2_' + x + '.npy'), getattr(l2, x))
+    in_atom = atoms >= 0
+    np.save(os.path.join(out_dir, 'M.npy'), np.bincount(atoms[in_atom & kept], minlength=n_atoms).astype(np.float64))
+    np.save(os.path.join(out_dir, 'M_5_50.npy'), np.bincount(atoms[in_atom & kept & (maf > 0.05)], minlength=n_atoms).astype(np.float64))
+    np.save(os.path.join(out_dir, 'atoms.npy'), atoms)
+    np.save(os.path.join(out_dir, 'rows.npy'), rows)
+    shutil.copy(bfile + '.bim', os.path.join(out_dir, 'panel.bim'))
+    return n_atoms
+
+
+def build_basis(bfile_chr, gene_coord_file, out, window=100000, ld_wind_cm=1, print_snps_file=None, chroms=range(1,23)):
+
+    """ Build the atom basis of a plink panel for the gene windows of a gene coordinate file at one window size """
+
+    print_snps = None
+    if print_snps_file:
+        print_snps = set(pd.read_csv(print_snps_file, header=None, delim_whitespace=True)[0])
+    windows = gene_window(pd.read_csv(gene_coord_file, delim_whitespace=True), window)
+    window_chrom = windows.CHR.map(normalize_chrom)
+    n_atoms = {}
+    for chrom in chroms:
+        logging.info('Building atom basis for chr ' + str(chrom))
+        n_atoms[str(chrom)] = build_chromosome(bfile_chr + str(chrom), windows[window_chrom == normalize_chrom(chrom)],
+                                               os.path.join(out, 'chr' + str(chrom)), ld_wind_cm, print_snps)
+    up, down = window if isinstance(window, (tuple, list)) else (window, window)
+    with open(os.path.join(out, 'basis.json'), 'w') as f:
+        json.dump({'window_up': up, 'window_down': down, 'gene_coord_file': gene_coord_file,
+                   'gene_coord_md5': file_checksum(gene_coord_file), 'ld_wind_cm': ld_wind_cm, 'bfile_chr': bfile_chr,
+                   'print_snps_file': print_snps_file, 'print_snps_md5': print_snps_file and file_checksum(print_snps_file),
+                   'chroms': list(chroms), 'n_atoms': n_atoms}, f)
+
+
+def basis_mismatch(basis, print_snps_file, gene_coord_file, window, ld_wind_cm=1, bfile_chr=None):
+
+    """ Why the basis can not give the LDscores of a job (printed SNPs, gene coordinates, window, cM window, panel), None if it can """
+
+    with open(os.path.join(basis, 'basis.json')) as f:
+        settings = json.load(f)
+    up, down = window if isinstance(window, (tuple, list)) else (window, window)
+    if settings.get('print_snps_md5') != (print_snps_file and file_checksum(print_snps_file)):
+        return 'the atom basis was built for another --print-snps list'
+    if settings.get('gene_coord_md5') != file_checksum(gene_coord_file):
+        return 'the atom basis was built for another gene coordinate file'
+    if (settings['window_up'], settings['window_down']) != (up, down):
+        return 'the atom basis was built for a ' + str(settings['window_up']) + ',' + str(settings['window_down']) + ' bp window'
+    if float(settings['ld_wind_cm']) != float(ld_wind_cm):
+        return 'the atom basis has a ' + str(settings['ld_wind_cm']) + ' cM window'
+    for chrom in settings['chroms'] if bfile_chr else []:
+        if file_checksum(os.path.join(basis, 'chr' + str(chrom), 'panel.bim')) != file_checksum(bfile_chr + str(chrom) + '.bim'):
+            return 'the atom basis was built from another panel than ' + bfile_chr + str(chrom)
+    return None
+
+
+def load_basis_chromosome(basis, chrom):
+    chrom_dir = os.path.join(basis, 'chr' + str(chrom))
+    chrom_basis = dict((x, np.load(os.path.join(chrom_dir, x + '.npy'))) for x in ['atoms','rows','M','M_5_50'])
+    l2 = [np.load(os.path.join(chrom_dir, 'l2_' + x + '.npy')) for x in ['data', 'indices', 'indptr']]
+    chrom_basis['l2'] = sp.csr_matrix(tuple(l2), shape=(len(chrom_basis['rows']), len(chrom_basis['M'])))
+    chrom_basis['bim'] = read_bim(os.path.join(chrom_dir, 'panel'))
+    return chrom_basis
+
+
+def read_basis_chromosome(basis, chrom):
+    chrom_dir = os.path.join(basis, 'chr' + str(chrom))
+    return resident_load('atom_basis ' + chrom_dir, [chrom_dir], load_basis_chromosome, basis, chrom)
+
+
+def atom_weights(atoms, annot):
+
+    """ (atoms x annotations) values of an annotation that is constant on every atom and 0 outside them, else None """
+
+    if annot.shape[0] != len(atoms):
+        raise ValueError('Annotation has ' + str(annot.shape[0]) + ' rows but the atom basis has ' + str(len(atoms)) + ' SNPs')
+    in_atom = atoms >= 0
+    if np.any(annot[~in_atom] != 0):
+        return None
+    n_atoms = int(atoms.max()) + 1 if in_atom.any() else 0
+    first = np.zeros(n_atoms, dtype=np.int64)
+    first[atoms[in_atom]] = np.flatnonzero(in_atom)
+    weights = annot[first]
+    if not np.allclose(annot[in_atom], weights[atoms[in_atom]], rtol=1e-9, atol=0):
+        return None
+    return weights
+
+
+def calculate_ldscores_atoms(basis, chrom, annot_file, out_prefix):
+
+    """ Drop-in replacement for ldsc.py --l2 --thin-annot --print-snps for annotations made of whole atoms (binary
+        or continuous gene-window annotations of the basis gene coordinates and window size): the LDscores, M and
+        M_5_50 are sums of atom columns. Returns False, writing nothing, if the annotation is not made of atoms """
+
+    annot_df = pd.read_csv(annot_file, compression='gzip', delim_whitespace=True)
+    annot_df = annot_df.drop([x for x in ['CHR','SNP','BP','CM'] if x in annot_df.columns], axis=1)
+    chrom_basis = read_basis_chromosome(basis, chrom)
+    weights = atom_weights(chrom_basis['atoms'], annot_df.values.astype(np.float64))
+    if weights is None:
+        return False
+    ldscores = chrom_basis['l2'].dot(weights)
+    write_ldscore_files(out_prefix, chrom_basis['bim'].iloc[chrom_basis['rows']], ldscores, list(annot_df.columns),
+                        chrom_basis['M'].dot(weights), chrom_basis['M_5_50'].dot(weights))
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bfile-chr', required=True, help = 'Prefix of the chr-specific plink files, e.g. /mnt/data/plink_files/1000G.EUR.QC.')
+    parser.add_argument('--gene-coord-file', required=True, help = 'File with the start and end position of each gene (the --gene-coord-file of main_ldscore.py)')
+    parser.add_argument('--windowsize', default='100000', help = 'Window around the genes in bp, or upstream,downstream, default=100000')
+    parser.add_argument('--print-snps', help = 'File with the SNPs to print LDscores for, one per line (the --print-snps list used for ldsc)')
+    parser.add_argument('--ld-wind-cm', type=float, default=1, help = 'Window size in cM, default=1')
+    parser.add_argument('--chrom', type=int, help = 'Only build the basis for this chromosome')
+    parser.add_argument('--out', required=True, help = 'Folder to write the atom basis to')
+    parser.add_argument("--verbose", help="increase output verbosity",action="store_true")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    chroms = [args.chrom] if args.chrom else range(1,23)
+    build_basis(args.bfile_chr, args.gene_coord_file, args.out, parse_window(args.windowsize),
+                args.ld_wind_cm, args.print_snps, chroms)
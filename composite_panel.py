@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import pandas as pd
+import numpy as np
+import argparse
+import gzip
+import logging
+import os
+from result_cache import file_checksum, cache_key, cache_fetch, cache_store
+from ldscore_archive import pack_ldscores, unpack_ldscores
+
+
+COMPOSITE_NAME = 'composite'
+
+
+def component_files(prefix, chrom):
+    return [prefix + str(chrom) + x for x in ['.l2.ldscore.gz', '.l2.M', '.l2.M_5_50', '.annot.gz']]
+
+
+def composite_key(prefixes, chroms=range(1,23)):
+
+    """ Cache key of a composite panel: checksums of every component file, in --ref-ld-chr order """
+
+    return cache_key(*[file_checksum(x) if os.path.exists(x) else 'missing'
+                       for prefix in prefixes for chrom in chroms for x in component_files(prefix, chrom)])
+
+
+def unique_columns(columns):
+
+    """ Suffix repeated annotation names with the index of their component, as ldsc does for several --ref-ld-chr files """
+
+    names = [x for cols in columns for x in cols]
+    return [[x + '_' + str(i) if names.count(x) > 1 else x for x in cols] for i, cols in enumerate(columns)]
+
+
+def build_composite(prefixes, out_dir, chroms=range(1,23)):
+
+    """ Join the LDscores, M, M_5_50 and annotations of several chr-split panels into one panel per chromosome """
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    out_prefix = os.path.join(out_dir, COMPOSITE_NAME + '.')
+    for chrom in chroms:
+        frames = [pd.read_csv(prefix + str(chrom) + '.l2.ldscore.gz', compression='gzip', delim_whitespace=True) for prefix in prefixes]
+        snps = frames[0].SNP.values
+        for prefix, df in zip(prefixes, frames):
+            if len(df) != len(snps) or not (df.SNP.values == snps).all():
+                raise ValueError('LDscores of ' + prefix + str(chrom) + ' do not have the same SNPs as ' + prefixes[0] + str(chrom))
+        ld_cols = [[x for x in df.columns if x not in ['CHR','SNP','BP','CM','MAF']] for df in frames]
+        names = unique_columns([[x[:-2] if x.endswith('L2') else x for x in cols] for cols in ld_cols])
+        l2 = frames[0][['CHR','SNP','BP']].copy()
+        for df, cols, new in zip(frames, ld_cols, names):
+            for col, name in zip(cols, new):
+                l2[name + 'L2'] = df[col].values.astype(np.float32)
+        with gzip.open(out_prefix + str(chrom) + '.l2.ldscore.gz', 'wb') as f:
+            f.write(l2.to_csv(sep='\t', index=False, float_format='%.3f').encode('utf-8'))
+        for suffix in ['.l2.M', '.l2.M_5_50']:
+            M = np.concatenate([np.loadtxt(prefix + str(chrom) + suffix, ndmin=1) for prefix in prefixes])
+            with open(out_prefix + str(chrom) + suffix, 'w') as f:
+                f.write('\t'.join(map(str, M)) + '\n')
+        # Thin annotation with the columns of every component, for --overlap-annot
+        if all(os.path.exists(prefix + str(chrom) + '.annot.gz') for prefix in prefixes):
+            annots = [pd.read_csv(prefix + str(chrom) + '.annot.gz', compression='gzip', delim_whitespace=True) for prefix in prefixes]
+            annots = [df.drop([x for x in ['CHR','SNP','BP','CM'] if x in df.columns], axis=1) for df in annots]
+            annot = pd.concat([df.reset_index(drop=True) for df in annots], axis=1)
+            annot.columns = [x for cols in unique_columns([list(df.columns) for df in annots]) for x in cols]
+            with gzip.open(out_prefix + str(chrom) + '.annot.gz', 'wb') as f:
+                f.write(annot.to_csv(sep='\t', index=False, float_format='%g').encode('utf-8'))
+    logging.info('Composite panel of ' + ','.join(prefixes) + ' written to ' + out_prefix)
+    return out_prefix
+
+
+def composite_panel(prefixes, out_dir, panel_cache=None, chroms=range(1,23)):
+
+    """ Composite panel prefix for a --ref-ld-chr list, fetched from the cache when it was built by an earlier job """
+
+    key = composite_key(prefixes, chroms)
+    archive = os.path.join(out_dir, COMPOSITE_NAME + '.ldscores.h5')
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    if cache_fetch(panel_cache, 'ldsc_composite_panel', key, ['composite.ldscores.h5'], out_dir):
+        unpack_ldscores(archive, out_dir, names=[COMPOSITE_NAME])
+        return os.path.join(out_dir, COMPOSITE_NAME + '.')
+    out_prefix = build_composite(prefixes, out_dir, chroms)
+    if panel_cache:
+        pack_ldscores(out_dir, archive, names=[COMPOSITE_NAME], chroms=chroms)
+        cache_store(panel_cache, 'ldsc_composite_panel', key, [archive])
+    return out_prefix
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ref-ld-chr', required=True, help = 'Comma separated list of chr-split LDscore prefixes, as for ldsc.py')
+    parser.add_argument('--out', required=True, help = 'Folder to write the composite panel to (prefix <out>/composite.)')
+    parser.add_argument('--panel-cache', help = 'Local folder or google bucket path to cache composite panels in')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(composite_panel(args.ref_ld_chr.split(','), args.out, args.panel_cache))
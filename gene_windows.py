@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import pandas as pd
+import numpy as np
+import argparse
+import logging
+from ldscore_api import normalize_chrom, gene_window, snp_ranges, ranges_to_annotation
+from ld_matrix_store import read_bim
+
+
+def parse_window(window, scale=1):
+
+    """ (upstream, downstream) in bp from 'size' or 'up,down' given in units of scale bp """
+
+    sizes = [int(float(x) * scale) for x in str(window).split(',')]
+    return (sizes[0], sizes[-1])
+
+
+def read_gene_loc(loc_file):
+
+    """ MAGMA gene location file: GENE CHR START STOP STRAND """
+
+    genes = pd.read_csv(loc_file, delim_whitespace=True, header=None, usecols=[0,1,2,3,4],
+                        names=['GENE','CHR','START','END','STRAND'], dtype={'GENE': str, 'CHR': str})
+    return genes
+
+
+def window_index(genes, bim, window):
+
+    """ Per chromosome: the gene windows and the [lo, hi) range of each window in the position-sorted panel SNPs.
+        MAGMA's .genes.annot and the LDSC per-SNP annotations are both written from it """
+
+    windows = gene_window(genes, window)
+    windows['GENE_START'] = genes['START'].values
+    windows['GENE_END'] = genes['END'].values
+    bim_chrom = bim.CHR.map(normalize_chrom).values
+    gene_chrom = windows.CHR.map(normalize_chrom).values
+    index = {}
+    for chrom in pd.unique(gene_chrom):
+        b = bim[bim_chrom == chrom]
+        if not len(b):
+            continue
+        order = np.argsort(b.BP.values, kind='mergesort')
+        w = windows[gene_chrom == chrom].reset_index(drop=True)
+        lo, hi = snp_ranges(w, b.BP.values[order])
+        index[chrom] = {'genes': w, 'lo': lo, 'hi': hi, 'order': order,
+                        'snps': b.SNP.values[order], 'bim': b.reset_index(drop=True)}
+    return index
+
+
+def write_genes_annot(index, out_file, window, gene_col='GENE'):
+
+    """ MAGMA .genes.annot (gene, CHR:START:STOP, SNPs in the window) from the window index, as magma --annotate writes it """
+
+    up, down = window
+    with open(out_file, 'w') as f:
+        f.write('# window_up = ' + str(up) + '\n')
+        f.write('# window_down = ' + str(down) + '\n')
+        n = 0
+        for chrom in sorted(index, key=lambda x: (len(x), x)):
+            x = index[chrom]
+            g = x['genes']
+            for i in np.flatnonzero(x['hi'] > x['lo']):
+                f.write(str(g[gene_col].values[i]) + '\t' + chrom + ':' + str(g.GENE_START.values[i]) + ':' + str(g.GENE_END.values[i]) + '\t' +
+                        '\t'.join(x['snps'][x['lo'][i]:x['hi'][i]]) + '\n')
+                n += 1
+    logging.info(str(n) + ' genes with SNPs in their window written to ' + out_file)
+
+
+def ldsc_annotation(index, chrom, n_snps, genes, gene_col='GENE', values=None):
+
+    """ LDSC per-SNP annotation of the chromosome's panel SNPs (in .bim order) for some genes of the index:
+        binary, or the mean of the gene values (values aligned to genes) over the windows covering a SNP """
+
+    x = index.get(normalize_chrom(chrom))
+    if x is None:
+        annot = np.zeros(n_snps)
+        return annot.astype(int) if values is None else annot
+    if values is None:
+        sel = np.flatnonzero(x['genes'][gene_col].isin(set(genes)).values)
+        return ranges_to_annotation(x['lo'][sel], x['hi'][sel], x['order'])
+    rows = pd.DataFrame({gene_col: x['genes'][gene_col].values, 'ROW': np.arange(len(x['genes']))})
+    rows = pd.merge(pd.DataFrame({gene_col: genes, 'ANNOT': values}), rows, on=gene_col)
+    return ranges_to_annotation(x['lo'][rows.ROW.values], x['hi'][rows.ROW.values], x['order'], rows.ANNOT.values)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gene-loc', required=True, help = 'MAGMA gene location file: GENE CHR START STOP STRAND')
+    parser.add_argument('--snp-loc', required=True, help = 'plink .bim file of the reference panel')
+    parser.add_argument('--window', default='0', help = 'Window around the genes in KB, one size or upstream,downstream as for magma --annotate window=')
+    parser.add_argument('--out', required=True, help = 'Output prefix, writes <out>.genes.annot')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    window = parse_window(args.window, 1000)
+    bim = read_bim(args.snp_loc[:-len('.bim')] if args.snp_loc.endswith('.bim') else args.snp_loc)
+    write_genes_annot(window_index(read_gene_loc(args.gene_loc), bim, window), args.out + '.genes.annot', window)
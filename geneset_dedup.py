@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import pandas as pd
+import numpy as np
+import argparse
+import hashlib
+import logging
+import os
+from bitarray import bitarray
+
+
+def annot_to_bitarray(annot_file):
+
+    """ Pack the per-SNP annotation of a thin .annot.gz file into a bit vector (None if not binary) """
+
+    annot = pd.read_csv(annot_file, compression='gzip', delim_whitespace=True).iloc[:,-1].values
+    if not np.all((annot == 0) | (annot == 1)):
+        return None, hashlib.sha1(np.ascontiguousarray(annot, dtype=np.float64).tobytes()).hexdigest()
+    bits = bitarray(endian='big')
+    bits.frombytes(np.packbits(annot.astype(np.uint8)).tobytes())
+    bits = bits[:len(annot)]
+    return bits, hashlib.sha1(bits.tobytes()).hexdigest()
+
+
+def geneset_signature(annot_prefix, chroms=range(1,23)):
+
+    """ Return the per-chromosome bit vectors and a genome-wide digest for one annotation prefix """
+
+    bits = {}
+    digest = hashlib.sha1()
+    for chrom in chroms:
+        chrom_bits, chrom_digest = annot_to_bitarray(annot_prefix + '.' + str(chrom) + '.annot.gz')
+        bits[chrom] = chrom_bits
+        digest.update((str(chrom) + ':' + chrom_digest).encode('ascii'))
+    if any(x is None for x in bits.values()):
+        bits = None
+    return bits, digest.hexdigest()
+
+
+def find_duplicates(signatures):
+
+    """ Map every geneset to the first geneset (in input order) with an identical annotation """
+
+    canonical = {}
+    first_seen = {}
+    for name, (bits, digest) in signatures:
+        if digest not in first_seen:
+            first_seen[digest] = name
+        canonical[name] = first_seen[digest]
+    return canonical
+
+
+def jaccard_overlaps(signatures, threshold):
+
+    """ Return (geneset1, geneset2, jaccard) for all pairs of binary genesets with jaccard >= threshold """
+
+    named_bits = [(name, bits) for name, (bits, digest) in signatures if bits is not None]
+    sizes = [sum(bits[c].count() for c in bits) for name, bits in named_bits]
+    overlaps = []
+    for i in range(len(named_bits)):
+        name_i, bits_i = named_bits[i]
+        for j in range(i + 1, len(named_bits)):
+            name_j, bits_j = named_bits[j]
+            # Jaccard can never exceed the ratio of the two set sizes
+            small, large = min(sizes[i], sizes[j]), max(sizes[i], sizes[j])
+            if large == 0 or small / large < threshold:
+                continue
+            inter = sum((bits_i[c] & bits_j[c]).count() for c in bits_i)
+            jaccard = inter / (sizes[i] + sizes[j] - inter)
+            if jaccard >= threshold:
+                overlaps.append((name_i, name_j, jaccard))
+    return overlaps
+
+
+def link_ldscores(outldscore, alias, target, chroms=range(1,23)):
+
+    """ Point the LDscore files of a duplicated geneset to the ones computed for its canonical copy """
+
+    for chrom in chroms:
+        for suffix in ['.l2.ldscore.gz', '.l2.M', '.l2.M_5_50']:
+            src = outldscore + target + '.' + str(chrom) + suffix
+            dst = outldscore + alias + '.' + str(chrom) + suffix
+            if os.path.lexists(dst):
+                os.remove(dst)
+            os.symlink(os.path.basename(src), dst)
+
+
+def dedup_genesets(outldscore, prefixes, report_file, threshold=0.9, chroms=range(1,23)):
+
+    """ Detect identical and near-identical geneset annotations, write an overlap report and return the canonical map """
+
+    signatures = [(p, geneset_signature(outldscore + p, chroms)) for p in prefixes]
+    canonical = find_duplicates(signatures)
+    overlaps = jaccard_overlaps(signatures, threshold)
+
+    with open(report_file, 'w') as file:
+        file.write('GENESET1\tGENESET2\tJACCARD\tDUPLICATE\n')
+        for name_i, name_j, jaccard in overlaps:
+            file.write(name_i + '\t' + name_j + '\t' + str(round(jaccard, 6)) + '\t' + str(canonical[name_i] == canonical[name_j]) + '\n')
+
+    n_dup = sum(1 for p in prefixes if canonical[p] != p)
+    logging.info('Genesets with identical annotation to a previous geneset: ' + str(n_dup) + ' of ' + str(len(prefixes)))
+    logging.info('Geneset pairs with jaccard >= ' + str(threshold) + ': ' + str(len(overlaps)))
+    return canonical
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--annot-folder', required=True, help = 'Folder containing the <prefix>.<chr>.annot.gz files')
+    parser.add_argument('--prefixes', required=True, help = 'Comma separated list of annotation prefixes to compare')
+    parser.add_argument('--jaccard-threshold', type=float, default=0.9, help = 'Report geneset pairs with at least this jaccard overlap')
+    parser.add_argument('--out', required=True, help = 'Output file for the overlap report')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    dedup_genesets(os.path.join(args.annot_folder, ''), args.prefixes.split(','), args.out, args.jaccard_threshold)
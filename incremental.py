@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import pandas as pd
+import glob
+import json
+import logging
+import os
+import shutil
+import subprocess
+from result_cache import is_gcs, file_checksum, cache_key
+
+
+# Arguments of main_ldscore.py that change the LDscores or the regression: results of a run with other values are not reused
+RESULT_SETTINGS = ['windowsize', 'window_up', 'window_down', 'gene_coord_file', 'gene_col_name', 'snp_list_file',
+                   'tkg_weights_folder', 'tkg_plink_folder', 'tkg_freq_folder', 'baseline_ldscores_folder', 'no_baseline',
+                   'condition_annot_genes', 'condition_annot_rsids', 'condition_annot_ldscores', 'condition_annot_bed',
+                   'exclude_file', 'quantiles', 'cont_breaks', 'in_process_regression', 'full_report', 'screen_p',
+                   'screen_calibration', 'approx_ldscores', 'approx_fraction', 'approx_rank', 'approx_exact_cm']
+
+
+def manifest_name(prefix):
+    return prefix + '.manifest.json'
+
+
+def settings_key(args):
+    return cache_key(*[repr(getattr(args, x, None)) for x in RESULT_SETTINGS])
+
+
+def trait_name(sumstats):
+    return os.path.basename(sumstats).replace('.sumstats.gz','')
+
+
+def fetch(src, dest):
+
+    """ Copy a local or bucket file if it exists, return whether it did """
+
+    if is_gcs(src):
+        if subprocess.call(['gsutil','-q','stat',src]) != 0:
+            return False
+        return subprocess.call(['gsutil','-q','cp',src,dest]) == 0
+    if not os.path.exists(src):
+        return False
+    shutil.copy2(src, dest)
+    return True
+
+
+def fetch_ldscores(export_path, names, dest_dir):
+
+    """ Copy the exported per-chromosome LDscore files of earlier runs for some genesets """
+
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+    for name in names:
+        pattern = os.path.join(export_path, name + '.[0-9]*')
+        if is_gcs(export_path):
+            subprocess.call(['gsutil','-m','-q','cp',pattern,dest_dir])
+        else:
+            for path in glob.glob(pattern):
+                shutil.copy2(path, dest_dir)
+
+
+def plan_incremental(args, ldcts_file, sumstats_files, work_dir):
+
+    """ Compare the genesets of the ldcts file and the traits with the manifest of the earlier runs in --out.
+        The ldcts file is rewritten with the genesets whose LDscores must be computed; the plan lists the genesets
+        whose exported LDscores are reused, the traits to regress and the earlier results to merge """
+
+    with open(ldcts_file) as f:
+        lines = [x for x in f if x.strip()]
+    genesets = dict((x.split()[0], file_checksum(os.path.join(work_dir, 'genesets', os.path.basename(x.split()[1])))) for x in lines)
+    traits = dict((trait_name(x), file_checksum(x)) for x in sumstats_files)
+
+    # done: trait -> {geneset: checksum of the geneset its result was computed with}
+    manifest = {'settings': settings_key(args), 'genesets': {}, 'traits': {}, 'done': {}, 'ldscores': {}}
+    local_manifest = os.path.join(work_dir, manifest_name(args.prefix))
+    if fetch(os.path.join(args.out, manifest_name(args.prefix)), local_manifest):
+        with open(local_manifest) as f:
+            previous = json.load(f)
+        if previous['settings'] == manifest['settings']:
+            manifest = previous
+        else:
+            logging.info('The settings differ from the earlier runs in ' + args.out + ', running all genesets')
+
+    done = {}
+    for trait, checksum in traits.items():
+        same_trait = manifest['traits'].get(trait) == checksum
+        done[trait] = set(g for g, c in manifest['done'].get(trait, {}).items() if same_trait and genesets.get(g) == c)
+    pending = dict((t, [g for g in genesets if g not in done[t]]) for t in traits)
+    needed = [g for g in genesets if any(g in pending[t] for t in traits)]
+
+    exported = set()
+    if args.export_ldscore_path and not args.ldscore_archive:
+        exported = set(g for g, checksum in manifest['ldscores'].items() if genesets.get(g) == checksum)
+    reuse = [g for g in needed if g in exported]
+    compute = [g for g in needed if g not in exported]
+    logging.info('Incremental run: ' + str(len(needed)) + ' of ' + str(len(genesets)) + ' genesets and ' +
+                 str(sum(1 for t in traits if pending[t])) + ' of ' + str(len(traits)) + ' traits have no results yet; ' +
+                 str(len(compute)) + ' geneset LDscores to compute, ' + str(len(reuse)) + ' reused from ' + str(args.export_ldscore_path))
+
+    with open(ldcts_file, 'w') as f:
+        f.writelines([x for x in lines if x.split()[0] in compute])
+    return {'manifest': manifest, 'genesets': genesets, 'traits': traits, 'done': done, 'needed': needed,
+            'reuse': reuse, 'compute': compute, 'run_traits': [t for t in traits if pending[t]], 'exported': exported}
+
+
+def fetch_previous_results(args, plan, previous_dir):
+
+    """ Copy the cell_type_results tables of the earlier runs for the traits about to be regressed """
+
+    if not os.path.exists(previous_dir):
+        os.makedirs(previous_dir)
+    for trait in plan['run_traits']:
+        name = trait + '.' + args.prefix + '.ldsc.cell_type_results.txt'
+        fetch(os.path.join(args.out, name), os.path.join(previous_dir, name))
+
+
+def merge_results(results_file, previous_file, keep):
+
+    """ Add the rows of the earlier table for the genesets in keep (still valid and not recomputed) to a new cell_type_results table """
+
+    if not (os.path.exists(results_file) and os.path.exists(previous_file)):
+        return
+    new = pd.read_csv(results_file, sep='\t')
+    previous = pd.read_csv(previous_file, sep='\t')
+    previous = previous[previous.Name.isin(keep) & ~previous.Name.isin(new.Name)]
+    df = pd.concat([new, previous], ignore_index=True)
+    df = df.sort_values(by='Coefficient_P_value')
+    df.to_csv(results_file, sep='\t', index=False)
+    logging.info('Merged ' + str(len(previous)) + ' earlier and ' + str(len(new)) + ' new rows into ' + results_file)
+
+
+def updated_manifest(args, plan):
+
+    """ Manifest of the results in --out once the run is uploaded """
+
+    manifest = plan['manifest']
+    manifest['settings'] = settings_key(args)
+    # Traits not in this run keep the geneset checksums of their own results
+    for trait, checksum in plan['traits'].items():
+        done = plan['done'][trait] | (set(plan['needed']) if trait in plan['run_traits'] else set())
+        manifest['done'][trait] = dict((g, plan['genesets'][g]) for g in done)
+        manifest['traits'][trait] = checksum
+    manifest['genesets'] = plan['genesets']
+    if args.export_ldscore_path and not args.ldscore_archive:
+        exported = plan['exported'] | set(plan['compute'])
+        manifest['ldscores'] = dict((g, c) for g, c in plan['genesets'].items() if g in exported)
+    return manifest
+
+
+def write_manifest(manifest, path):
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
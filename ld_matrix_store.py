@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+import argparse
+import json
+import gzip
+import logging
+import os
+import shutil
+from resident import resident_load
+from result_cache import file_checksum
+
+
+# PLINK .bed 2-bit genotype codes -> allele count (01 is missing)
+BED_CODES = np.array([0., np.nan, 1., 2.], dtype=np.float32)
+BED_LOOKUP = np.array([[BED_CODES[(b >> (2 * i)) & 3] for i in range(4)] for b in range(256)], dtype=np.float32)
+
+
+def load_bim(bfile):
+    return pd.read_csv(bfile + '.bim', delim_whitespace=True, usecols=[0,1,2,3], names=['CHR','SNP','CM','BP'])
+
+
+def read_bim(bfile):
+    return resident_load('bim ' + bfile, [bfile + '.bim'], load_bim, bfile)
+
+
+def read_fam(bfile):
+    return pd.read_csv(bfile + '.fam', delim_whitespace=True, usecols=[0,1], names=['FID','IID'])
+
+
+def read_standardized_genotypes(bfile, n_indiv, n_snp, block_size=10000):
+
+    """ Read a SNP-major plink .bed file into a SNP x individual matrix of standardized genotypes """
+
+    n_bytes = (n_indiv + 3) // 4
+    bed = np.memmap(bfile + '.bed', dtype=np.uint8, mode='r')
+    if not (bed[0] == 0x6c and bed[1] == 0x1b and bed[2] == 0x01):
+        raise ValueError(bfile + '.bed is not a SNP-major plink bed file')
+    bed = bed[3:3 + n_snp * n_bytes].reshape(n_snp, n_bytes)
+
+    geno = np.zeros((n_snp, n_indiv), dtype=np.float32)
+    maf = np.zeros(n_snp)
+    for start in range(0, n_snp, block_size):
+        end = min(start + block_size, n_snp)
+        x = BED_LOOKUP[bed[start:end]].reshape(end - start, n_bytes * 4)[:, :n_indiv]
+        freq = np.nanmean(x, axis=1) / 2
+        x = x - 2 * freq[:, None]
+        x[np.isnan(x)] = 0
+        sd = np.sqrt(np.mean(x ** 2, axis=1))
+        sd[sd == 0] = 1
+        geno[start:end] = x / sd[:, None]
+        maf[start:end] = np.minimum(freq, 1 - freq)
+    return geno, maf
+
+
+def build_chromosome(bfile, out_dir, ld_wind_cm=1, print_snps=None, dtype='float16', chunk_size=2000):
+
+    """ Compute and save the banded r2 matrix of one chromosome, one row per printed SNP """
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    bim = read_bim(bfile)
+    n_indiv = len(read_fam(bfile))
+    geno, maf = read_standardized_genotypes(bfile, n_indiv, len(bim))
+    kept = maf > 0
+
+    rows_mask = kept.copy()
+    if print_snps is not None:
+        rows_mask &= bim.SNP.isin(print_snps).values
+    rows = np.flatnonzero(rows_mask)
+    cm = bim.CM.values
+    left = np.searchsorted(cm, cm[rows] - ld_wind_cm, side='left')
+    right = np.searchsorted(cm, cm[rows] + ld_wind_cm, side='right')
+    indptr = np.concatenate([[0], np.cumsum(right - left)]).astype(np.int64)
+
+    r2 = np.lib.format.open_memmap(os.path.join(out_dir, 'r2.npy'), mode='w+', dtype=dtype, shape=(int(indptr[-1]),))
+    for c0 in range(0, len(rows), chunk_size):
+        c1 = min(c0 + chunk_size, len(rows))
+        lo, hi = left[c0], right[c1 - 1]
+        block = np.dot(geno[rows[c0:c1]], geno[lo:hi].T) / n_indiv
+        block **= 2
+        # Unbiased r2 estimator, as used by ldsc
+        block -= (1 - block) / (n_indiv - 2)
+        block[:, ~kept[lo:hi]] = 0
+        cols = np.arange(lo, hi)
+        in_window = (cols[None, :] >= left[c0:c1, None]) & (cols[None, :] < right[c0:c1, None])
+        r2[indptr[c0]:indptr[c1]] = block[in_window]
+        logging.debug('LD matrix store: ' + str(c1) + ' of ' + str(len(rows)) + ' rows done')
+    r2.flush()
+    del r2
+
+    np.save(os.path.join(out_dir, 'rows.npy'), rows)
+    np.save(os.path.join(out_dir, 'left.npy'), left)
+    np.save(os.path.join(out_dir, 'indptr.npy'), indptr)
+    np.save(os.path.join(out_dir, 'maf.npy'), maf)
+    np.save(os.path.join(out_dir, 'kept.npy'), kept)
+    shutil.copy(bfile + '.bim', os.path.join(out_dir, 'panel.bim'))
+
+
+def build_store(bfile_chr, out, ld_wind_cm=1, print_snps_file=None, dtype='float16', chroms=range(1,23)):
+
+    """ Build the LD matrix store for all chromosomes of a plink panel """
+
+    print_snps = None
+    if print_snps_file:
+        print_snps = set(pd.read_csv(print_snps_file, header=None, delim_whitespace=True)[0])
+    for chrom in chroms:
+        logging.info('Building LD matrix store for chr ' + str(chrom))
+        build_chromosome(bfile_chr + str(chrom), os.path.join(out, 'chr' + str(chrom)), ld_wind_cm, print_snps, dtype)
+    with open(os.path.join(out, 'store.json'), 'w') as f:
+        json.dump({'ld_wind_cm': ld_wind_cm, 'dtype': dtype, 'bfile_chr': bfile_chr,
+                   'print_snps_file': print_snps_file, 'print_snps_md5': print_snps_file and file_checksum(print_snps_file),
+                   'chroms': list(chroms)}, f)
+
+
+def check_store(store, print_snps_file, ld_wind_cm=1, bfile_chr=None, chroms=range(1,23)):
+
+    """ Raise ValueError if the store was not built for these printed SNPs, cM window and plink panel """
+
+    with open(os.path.join(store, 'store.json')) as f:
+        settings = json.load(f)
+    if settings.get('print_snps_md5') != (print_snps_file and file_checksum(print_snps_file)):
+        raise ValueError('The LD matrix store ' + store + ' was built for another --print-snps list than ' + str(print_snps_file))
+    if float(settings['ld_wind_cm']) != float(ld_wind_cm):
+        raise ValueError('The LD matrix store ' + store + ' has a ' + str(settings['ld_wind_cm']) + ' cM window, not ' + str(ld_wind_cm))
+    for chrom in chroms if bfile_chr else []:
+        if file_checksum(os.path.join(store, 'chr' + str(chrom), 'panel.bim')) != file_checksum(bfile_chr + str(chrom) + '.bim'):
+            raise ValueError('The LD matrix store ' + store + ' was built from another panel than ' + bfile_chr + str(chrom))
+
+
+def load_chromosome(store, chrom):
+
+    """ Memory-map the banded r2 matrix of one chromosome """
+
+    chrom_dir = os.path.join(store, 'chr' + str(chrom))
+    chrom_store = dict((x, np.load(os.path.join(chrom_dir, x + '.npy'))) for x in ['rows','left','indptr','maf','kept'])
+    chrom_store['r2'] = np.load(os.path.join(chrom_dir, 'r2.npy'), mmap_mode='r')
+    chrom_store['bim'] = read_bim(os.path.join(chrom_dir, 'panel'))
+    return chrom_store
+
+
+def ldscores_from_store(chrom_store, annot, chunk_size=20000):
+
+    """ LD scores of the printed SNPs for a (panel SNPs x annotations) matrix, as a sparse x dense product """
+
+    annot = np.asarray(annot, dtype=np.float32)
+    if annot.ndim == 1:
+        annot = annot[:, None]
+    n_panel = len(chrom_store['kept'])
+    if annot.shape[0] != n_panel:
+        raise ValueError('Annotation has ' + str(annot.shape[0]) + ' rows but the LD matrix store has ' + str(n_panel) + ' SNPs')
+
+    left, indptr = chrom_store['left'], chrom_store['indptr']
+    n_rows = len(chrom_store['rows'])
+    ldscores = np.zeros((n_rows, annot.shape[1]))
+    for c0 in range(0, n_rows, chunk_size):
+        c1 = min(c0 + chunk_size, n_rows)
+        ptr = indptr[c0:c1 + 1] - indptr[c0]
+        lengths = np.diff(ptr)
+        indices = np.repeat(left[c0:c1] - ptr[:-1], lengths) + np.arange(ptr[-1])
+        data = np.asarray(chrom_store['r2'][indptr[c0]:indptr[c1]], dtype=np.float32)
+        mat = sp.csr_matrix((data, indices, ptr), shape=(c1 - c0, n_panel))
+        ldscores[c0:c1] = mat.dot(annot)
+    return ldscores
+
+
+def write_ldscore_files(out_prefix, bim_rows, ldscores, annot_names, M, M_5_50):
+
+    """ Write .l2.ldscore.gz, .l2.M and .l2.M_5_50 files in the format produced by ldsc.py --l2 """
+
+    df = bim_rows[['CHR','SNP','BP']].reset_index(drop=True)
+    for i, name in enumerate(annot_names):
+        df[name + 'L2'] = ldscores[:, i]
+    with gzip.open(out_prefix + '.l2.ldscore.gz', 'wb') as f:
+        f.write(df.to_csv(sep='\t', index=False, float_format='%.3f').encode('utf-8'))
+    with open(out_prefix + '.l2.M', 'w') as f:
+        f.write('\t'.join(map(str, M)) + '\n')
+    with open(out_prefix + '.l2.M_5_50', 'w') as f:
+        f.write('\t'.join(map(str, M_5_50)) + '\n')
+
+
+def annot_ldscores(chrom_store, annot_df, out_prefix):
+
+    """ Compute and write LDscores for an annotation data frame aligned to the store panel """
+
+    annot = annot_df.values.astype(np.float64)
+    kept = chrom_store['kept']
+    ldscores = ldscores_from_store(chrom_store, annot)
+    M = annot[kept].sum(axis=0)
+    M_5_50 = annot[kept & (chrom_store['maf'] > 0.05)].sum(axis=0)
+    write_ldscore_files(out_prefix, chrom_store['bim'].iloc[chrom_store['rows']], ldscores, list(annot_df.columns), M, M_5_50)
+
+
+def calculate_ldscores_store(store, chrom, annot_file, out_prefix):
+
+    """ Drop-in replacement for ldsc.py --l2 --thin-annot --print-snps using a prebuilt LD matrix store """
+
+    annot_df = pd.read_csv(annot_file, compression='gzip', delim_whitespace=True)
+    annot_ldscores(load_chromosome(store, chrom), annot_df, out_prefix)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bfile-chr', required=True, help = 'Prefix of the chr-specific plink files, e.g. /mnt/data/plink_files/1000G.EUR.QC.')
+    parser.add_argument('--print-snps', help = 'File with the SNPs to store LD for, one per line (the --print-snps list used for ldsc)')
+    parser.add_argument('--ld-wind-cm', type=float, default=1, help = 'Window size in cM, default=1')
+    parser.add_argument('--dtype', default='float16', choices=['float16','float32'], help = 'Storage precision of the r2 values')
+    parser.add_argument('--chrom', type=int, help = 'Only build the store for this chromosome')
+    parser.add_argument('--out', required=True, help = 'Folder to write the LD matrix store to')
+    parser.add_argument("--verbose", help="increase output verbosity",action="store_true")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    chroms = [args.chrom] if args.chrom else range(1,23)
+    build_store(args.bfile_chr, args.out, args.ld_wind_cm, args.print_snps, args.dtype, chroms)
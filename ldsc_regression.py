@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import pandas as pd
+import numpy as np
+import scipy.stats as st
+import scipy.linalg as la
+import argparse
+import logging
+from resident import resident_load
+
+
+def read_ldscores(prefixes, chroms=range(1,23)):
+
+    """ Read and column-join the chr-specific LDscores and M_5_50 of one or more ldsc prefixes """
+
+    frames = []
+    M = []
+    names = []
+    for i, prefix in enumerate(prefixes):
+        df = pd.concat([pd.read_csv(prefix + str(chrom) + '.l2.ldscore.gz', compression='gzip', delim_whitespace=True)
+                        for chrom in chroms], ignore_index=True)
+        df = df.drop([x for x in ['CHR','BP','CM','MAF'] if x in df.columns], axis=1)
+        cols = [x for x in df.columns if x != 'SNP']
+        # ldsc suffixes the column names with the file index when several files are joined
+        if len(prefixes) > 1:
+            df.columns = ['SNP'] + [x + '_' + str(i) for x in cols]
+        names += list(df.columns[1:])
+        M.append(np.sum([np.loadtxt(prefix + str(chrom) + '.l2.M_5_50', ndmin=1) for chrom in chroms], axis=0))
+        if frames:
+            df = df.drop('SNP', axis=1)
+        frames.append(df)
+    df = pd.concat(frames, axis=1)
+    return df, np.concatenate(M), names
+
+
+def read_cts_panels(params_file, snps, chroms=range(1,23), split_columns=False):
+
+    """ Read all LDscores listed in a --ref-ld-chr-cts file, aligned to the given SNPs. ldsc --h2-cts fits the columns
+        of a line jointly and reports the first one, which is not done here: a line must have a single LDscore column,
+        unless split_columns makes each column its own annotation (name_column, e.g. the null genesets of a geneset) """
+
+    names = []
+    cts = []
+    M = []
+    with open(params_file, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            name, prefixes = line.strip().split()
+            df, M_cts, cols = read_ldscores(prefixes.split(','), chroms)
+            if len(cols) != 1 and not split_columns:
+                raise ValueError('The cts annotation ' + name + ' has ' + str(len(cols)) + ' LDscore columns (quantile bins or a comma separated list): ' +
+                                 'the in-process regression only fits one column per cts annotation, run it with ldsc.py')
+            df = pd.merge(pd.DataFrame({'SNP': snps}), df, how='left', on='SNP')
+            if df[cols].isnull().values.any():
+                raise ValueError('LDscores for ' + name + ' do not cover all SNPs of the reference panel')
+            for j, col in enumerate(cols):
+                names.append(name if len(cols) == 1 else name + '_' + col)
+                cts.append(df[col].values.astype(np.float32))
+                M.append(M_cts[j])
+    return names, np.column_stack(cts), np.array(M)
+
+
+def read_reference_panels(ref_ld_chr, w_ld_chr, chroms=range(1,23)):
+
+    """ Conditioning LDscores joined with the regression weights """
+
+    ref_ld, M, names = read_ldscores(ref_ld_chr.split(','), chroms)
+    w_ld = pd.concat([pd.read_csv(w_ld_chr + str(chrom) + '.l2.ldscore.gz', compression='gzip', delim_whitespace=True)
+                      for chrom in chroms], ignore_index=True)
+    w_ld = w_ld[['SNP', w_ld.columns[-1]]]
+    w_ld.columns = ['SNP', 'LD_weights']
+    return pd.merge(ref_ld, w_ld, how='inner', on='SNP'), M, names
+
+
+def load_regression_panels(ref_ld_chr, w_ld_chr, params_file=None, chroms=range(1,23)):
+
+    """ Load the conditioning, weight and cts LDscores once so they can be reused for every trait """
+
+    ref_ld, M, names = resident_load('reference_panels', ref_ld_chr.split(',') + [w_ld_chr], read_reference_panels, ref_ld_chr, w_ld_chr, list(chroms))
+    panels = {'ref_ld': ref_ld, 'M': M, 'names': names}
+    if params_file:
+        panels['cts_names'], panels['cts'], panels['cts_M'] = read_cts_panels(params_file, ref_ld.SNP.values, chroms)
+    return panels
+
+
+def ldsc_weights(ld, w_ld, N, M, hsq, intercept=1):
+
+    """ Heteroscedasticity and over-counting weights of ldsc """
+
+    hsq = min(max(hsq, 0.0), 1.0)
+    ld = np.fmax(ld, 1.0)
+    w_ld = np.fmax(w_ld, 1.0)
+    c = hsq * N / M
+    het_w = 1.0 / (2 * np.square(intercept + c * ld))
+    oc_w = 1.0 / w_ld
+    return het_w * oc_w
+
+
+def regression_weights(y, x_tot, w_ld, N, M_tot, n_iter=2):
+
+    """ Square root regression weights from an IRWLS fit of the total LDscore, as ldsc does """
+
+    Nbar = np.mean(N)
+    hsq = M_tot * (np.mean(y) - 1) / np.mean(x_tot * N)
+    w = ldsc_weights(x_tot, w_ld, N, M_tot, hsq)
+    design = np.column_stack([N * x_tot / Nbar, np.ones_like(y)])
+    for i in range(n_iter):
+        sw = np.sqrt(w) / np.sum(np.sqrt(w))
+        xw = design * sw[:, None]
+        coef = np.linalg.solve(np.dot(xw.T, xw), np.dot(xw.T, y * sw))
+        w = ldsc_weights(x_tot, w_ld, N, M_tot, M_tot * coef[0] / Nbar, coef[1])
+    w = np.sqrt(w)
+    return w / np.sum(w)
+
+
+def merge_sumstats(sumstats_file, panels):
+
+    """ Read a munged sumstats file and align it to the loaded panels """
+
+    ss = pd.read_csv(sumstats_file, compression='gzip', delim_whitespace=True)
+    ss = ss.dropna(subset=['Z','N'])
+    ss = ss[['SNP','Z','N']]
+    ref_ld = panels['ref_ld']
+    idx = pd.merge(pd.DataFrame({'SNP': ref_ld.SNP.values, 'IDX': np.arange(len(ref_ld))}), ss, how='inner', on='SNP')
+    y = idx.Z.values ** 2
+    chisq_max = max(0.001 * idx.N.max(), 80)
+    keep = y < chisq_max
+    logging.info('Regression SNPs: ' + str(keep.sum()) + ' (removed ' + str((~keep).sum()) + ' with chi^2 > ' + str(chisq_max) + ')')
+    return idx.IDX.values[keep], y[keep], idx.N.values[keep].astype(np.float64)
+
+
+def block_sums(x, y, separators):
+
+    """ Per jackknife block cross-products x'x and x'y """
+
+    n_blocks = len(separators) - 1
+    xtx = np.zeros((n_blocks, x.shape[1], x.shape[1]))
+    xty = np.zeros((n_blocks, x.shape[1]))
+    for k in range(n_blocks):
+        xb = x[separators[k]:separators[k + 1]]
+        xtx[k] = np.dot(xb.T, xb)
+        xty[k] = np.dot(xb.T, y[separators[k]:separators[k + 1]])
+    return xtx, xty
+
+
+def schur_solve(A, b, U, s, t):
+
+    """ Solve [[s, U'], [U, A]] [gamma, beta] = [t, b] for many cts columns at once, reusing one factorization of A """
+
+    factor = la.cho_factor(A)
+    sol = la.cho_solve(factor, np.column_stack([b, U]))
+    Ainv_b, Ainv_U = sol[:, 0], sol[:, 1:]
+    gamma = (t - np.dot(U.T, Ainv_b)) / (s - np.sum(U * Ainv_U, axis=0))
+    beta = Ainv_b[:, None] - Ainv_U * gamma[None, :]
+    return gamma, beta
+
+
+class BaselineSystem(object):
+
+    """ Weighted baseline design and its jackknife blocks for one trait, factorized once and shared by all cts annotations """
+
+    def __init__(self, sumstats_file, panels, n_blocks=200):
+        ref_ld = panels['ref_ld']
+        self.idx, self.y, self.N = merge_sumstats(sumstats_file, panels)
+        self.Nbar = np.mean(self.N)
+        self.n_blocks = n_blocks
+        self.separators = np.floor(np.linspace(0, len(self.y), n_blocks + 1)).astype(int)
+
+        ref = ref_ld[panels['names']].values[self.idx].astype(np.float64)
+        x_tot = ref.sum(axis=1)
+        self.w = regression_weights(self.y, x_tot, ref_ld.LD_weights.values[self.idx], self.N, np.sum(panels['M']))
+        self.scale = self.w * self.N / self.Nbar
+        design = np.column_stack([ref * self.scale[:, None], self.w])
+        self.yw = self.y * self.w
+        self.BB, self.By = block_sums(design, self.yw, self.separators)
+        self.design = design
+
+    def fit_cts(self, cts):
+
+        """ Coefficients and delete-one-block values for a (SNPs x annotations) batch of cts LDscores """
+
+        cw = cts[self.idx].astype(np.float64) * self.scale[:, None]
+        K = self.n_blocks
+        BC = np.zeros((K, self.design.shape[1], cw.shape[1]))
+        CC = np.zeros((K, cw.shape[1]))
+        Cy = np.zeros((K, cw.shape[1]))
+        for k in range(K):
+            sl = slice(self.separators[k], self.separators[k + 1])
+            BC[k] = np.dot(self.design[sl].T, cw[sl])
+            CC[k] = np.sum(cw[sl] ** 2, axis=0)
+            Cy[k] = np.dot(cw[sl].T, self.yw[sl])
+
+        tot = [x.sum(axis=0) for x in (self.BB, self.By, BC, CC, Cy)]
+        gamma, beta = schur_solve(*tot)
+        gamma_del = np.zeros((K, cw.shape[1]))
+        beta_del = np.zeros((K,) + beta.shape)
+        for k in range(K):
+            gamma_del[k], beta_del[k] = schur_solve(*[t - x[k] for t, x in zip(tot, (self.BB, self.By, BC, CC, Cy))])
+        return gamma, beta, gamma_del, beta_del
+
+
+def jackknife_cov(est, delete_values):
+
+    """ Block jackknife covariance from delete-one-block values (blocks on the first axis) """
+
+    K = delete_values.shape[0]
+    pseudo = K * est[None, :] - (K - 1) * delete_values
+    return np.atleast_2d(np.cov(pseudo.T, ddof=1)) / K
+
+
+def full_report(system, coef_est, coef_del, categories, M, overlap=None, M_tot=None):
+
+    """ ldsc --h2 --overlap-annot --print-coefficients style .results table for one fitted model """
+
+    n_annot = len(categories)
+    Nbar = system.Nbar
+    coef = coef_est / Nbar
+    coef_cov = jackknife_cov(coef_est, coef_del) / Nbar ** 2
+    coef_se = np.sqrt(np.diag(coef_cov))
+
+    cat = coef * M
+    prop = cat / np.sum(cat)
+    numer = M[None, :] * coef_del / Nbar
+    denom = np.sum(numer, axis=1)[:, None]
+    prop_cov = jackknife_cov(prop, numer / denom)
+
+    if overlap is None:
+        overlap = np.diag(M)
+        M_tot = np.max(M) if M_tot is None else M_tot
+    overlap_prop = overlap / M[None, :]
+    prop_h2 = np.dot(overlap_prop, prop)
+    prop_h2_se = np.sqrt(np.maximum(0, np.diag(np.dot(np.dot(overlap_prop, prop_cov), overlap_prop.T))))
+    prop_M = M / M_tot
+    enrichment = prop_h2 / prop_M
+    enrichment_se = prop_h2_se / prop_M
+
+    overlap_diff = np.zeros((n_annot, n_annot))
+    for i in range(n_annot):
+        if not M_tot == M[i]:
+            overlap_diff[i, :] = overlap[i, :] / M[i] - (M - overlap[i, :]) / (M_tot - M[i])
+    diff_est = np.dot(overlap_diff, coef)
+    diff_se = np.sqrt(np.maximum(0, np.diag(np.dot(np.dot(overlap_diff, coef_cov), overlap_diff.T))))
+    diff_p = ['NA' if diff_se[i] == 0 else 2 * st.t.sf(abs(diff_est[i] / diff_se[i]), system.n_blocks) for i in range(n_annot)]
+
+    df = pd.DataFrame({'Category': categories,
+                       'Prop._SNPs': prop_M,
+                       'Prop._h2': prop_h2,
+                       'Prop._h2_std_error': prop_h2_se,
+                       'Enrichment': enrichment,
+                       'Enrichment_std_error': enrichment_se,
+                       'Enrichment_p': diff_p,
+                       'Coefficient': coef,
+                       'Coefficient_std_error': coef_se,
+                       'Coefficient_z-score': coef / coef_se})
+    return df[['Category','Prop._SNPs','Prop._h2','Prop._h2_std_error','Enrichment','Enrichment_std_error',
+               'Enrichment_p','Coefficient','Coefficient_std_error','Coefficient_z-score']]
+
+
+def fit_cts_columns(system, panels, columns, full_report_prefix=None, overlap=None, M_tot=None, batch_size=100):
+
+    """ Block jackknife fit of the given cts columns: (name, coefficient, standard error) of each, and their full report """
+
+    Nbar = system.Nbar
+    n_base = len(panels['names'])
+    results = []
+    for c0 in range(0, len(columns), batch_size):
+        batch = columns[c0:c0 + batch_size]
+        gamma, beta, gamma_del, beta_del = system.fit_cts(panels['cts'][:, batch])
+        for j, col in enumerate(batch):
+            name = panels['cts_names'][col]
+            se = np.sqrt(jackknife_cov(gamma[j:j + 1], gamma_del[:, j:j + 1])[0, 0]) / Nbar
+            results.append((name, gamma[j] / Nbar, se))
+            if full_report_prefix is not None:
+                # Same column order as --ref-ld-chr <conditional panels>,<cts>: conditional annotations first
+                coef_est = np.concatenate([beta[:n_base, j], [gamma[j]]])
+                coef_del = np.column_stack([beta_del[:, :n_base, j], gamma_del[:, j]])
+                categories = panels['names'] + [name]
+                M = np.concatenate([panels['M'], [panels['cts_M'][col]]])
+                ov = None if overlap is None else overlap(col)
+                df = full_report(system, coef_est, coef_del, categories, M, ov, M_tot)
+                df.to_csv(full_report_prefix + '.' + name + '.ldsc_full.results', sep='\t', index=False)
+        logging.info('In-process regression: ' + str(c0 + len(batch)) + ' of ' + str(len(columns)) + ' cts annotations done')
+    return results
+
+
+def write_cts_results(results, outfile, columns=['Name','Coefficient','Coefficient_std_error']):
+    df = pd.DataFrame(results, columns=columns)
+    df['Coefficient_P_value'] = st.norm.sf(df.Coefficient / df.Coefficient_std_error)
+    df = df.sort_values(by='Coefficient_P_value')
+    df.to_csv(outfile + '.cell_type_results.txt', sep='\t', index=False)
+    return df
+
+
+def h2_cts(sumstats_file, panels, outfile, full_report_prefix=None, overlap=None, M_tot=None, batch_size=100, n_blocks=200):
+
+    """ In-process equivalent of ldsc.py --h2-cts --print-all-cts (and of --h2 per cts for the full report) """
+
+    system = BaselineSystem(sumstats_file, panels, n_blocks)
+    results = fit_cts_columns(system, panels, list(range(len(panels['cts_names']))), full_report_prefix, overlap, M_tot, batch_size)
+    return write_cts_results(results, outfile)
+
+
+def screen_cts(system, cts, batch_size=100):
+
+    """ Coefficient of every cts annotation from a single weighted fit on all SNPs, without the delete-one-block refits,
+        and its analytic standard error sigma^2 / (Schur complement of the baseline), both on the N-scaled axis """
+
+    A = system.BB.sum(axis=0)
+    b = system.By.sum(axis=0)
+    factor = la.cho_factor(A)
+    Ainv_b = la.cho_solve(factor, b)
+    resid = system.yw - np.dot(system.design, Ainv_b)
+    sigma2 = np.sum(resid ** 2) / (len(resid) - len(b))
+    gamma = np.zeros(cts.shape[1])
+    se = np.zeros(cts.shape[1])
+    for c0 in range(0, cts.shape[1], batch_size):
+        c1 = min(c0 + batch_size, cts.shape[1])
+        cw = cts[system.idx, c0:c1].astype(np.float64) * system.scale[:, None]
+        U = np.dot(system.design.T, cw)
+        schur = np.sum(cw ** 2, axis=0) - np.sum(U * la.cho_solve(factor, U), axis=0)
+        gamma[c0:c1] = (np.dot(cw.T, system.yw) - np.dot(U.T, Ainv_b)) / schur
+        se[c0:c1] = np.sqrt(sigma2 / schur)
+    return gamma, se
+
+
+def h2_cts_screen(sumstats_file, panels, outfile, screen_p=0.05, n_calibration=50, full_report_prefix=None, overlap=None, M_tot=None, batch_size=100, n_blocks=200):
+
+    """ Two-tier --h2-cts: screen every cts annotation with one fit and an analytic standard error, then run the
+        block jackknife regression (and the full report) only for the ones with a screening P-value below screen_p.
+        The Tier column of the results is 1 for screened-out annotations and 2 for the ones fitted in full """
+
+    system = BaselineSystem(sumstats_file, panels, n_blocks)
+    n_cts = len(panels['cts_names'])
+    gamma, se = screen_cts(system, panels['cts'], batch_size)
+
+    # The analytic standard error ignores the LD between SNPs: it is scaled to the jackknife on evenly spread annotations
+    calibration = sorted(set(np.linspace(0, n_cts - 1, min(n_cts, n_calibration)).astype(int)))
+    jackknifed = dict(zip(calibration, fit_cts_columns(system, panels, calibration, batch_size=batch_size)))
+    inflation = np.median([jackknifed[i][2] * system.Nbar / se[i] for i in calibration])
+    se = se * inflation
+    screen_pval = st.norm.sf(gamma / se)
+    passed = [i for i in range(n_cts) if screen_pval[i] < screen_p]
+    logging.info('Screening: ' + str(len(passed)) + ' of ' + str(n_cts) + ' cts annotations with P < ' + str(screen_p) +
+                 ' (standard error inflation ' + str(round(inflation, 3)) + ') get the full regression')
+
+    # Calibration fits are reused unless the full report is needed for them
+    todo = passed if full_report_prefix is not None else [i for i in passed if i not in jackknifed]
+    full = dict(zip(todo, fit_cts_columns(system, panels, todo, full_report_prefix, overlap, M_tot, batch_size)))
+    results = []
+    for i in range(n_cts):
+        if i in passed:
+            results.append(tuple(full.get(i, jackknifed.get(i))) + (2, screen_pval[i]))
+        else:
+            results.append((panels['cts_names'][i], gamma[i] / system.Nbar, se[i] / system.Nbar, 1, screen_pval[i]))
+    return write_cts_results(results, outfile, ['Name','Coefficient','Coefficient_std_error','Tier','Screening_P_value'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--h2-cts', required=True, help = 'Munged summary statistics file (.sumstats.gz)')
+    parser.add_argument('--ref-ld-chr', required=True, help = 'Comma separated list of chr-split LDscore prefixes to condition on')
+    parser.add_argument('--ref-ld-chr-cts', required=True, help = 'File with name "\t" comma separated chr-split LDscore prefixes, one cts annotation per line')
+    parser.add_argument('--w-ld-chr', required=True, help = 'Prefix of the chr-split regression weight LDscores')
+    parser.add_argument('--full-report', action='store_true', default=False, help = 'Also write a .results table per cts annotation')
+    parser.add_argument('--n-blocks', type=int, default=200, help = 'Number of jackknife blocks, default=200')
+    parser.add_argument('--screen-p', type=float, help = 'Screen all cts annotations first and run the jackknife regression only for the ones with a screening P-value below this')
+    parser.add_argument('--out', required=True, help = 'Output prefix')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    panels = load_regression_panels(args.ref_ld_chr, args.w_ld_chr, args.ref_ld_chr_cts)
+    if args.screen_p:
+        h2_cts_screen(args.h2_cts, panels, args.out, args.screen_p, full_report_prefix=args.out if args.full_report else None, n_blocks=args.n_blocks)
+    else:
+        h2_cts(args.h2_cts, panels, args.out, full_report_prefix=args.out if args.full_report else None, n_blocks=args.n_blocks)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import pandas as pd
+import numpy as np
+from ld_matrix_store import read_bim, load_chromosome, ldscores_from_store
+
+
+def normalize_chrom(chrom):
+    return str(chrom).lstrip('chr')
+
+
+def load_panel(bfile_chr=None, store=None, chroms=range(1,23)):
+
+    """ Load the .bim SNPs of a reference panel, and optionally memory-map its LD matrix store """
+
+    panel = {'chroms': list(chroms), 'bim': {}, 'store': {}}
+    for chrom in chroms:
+        if store:
+            panel['store'][chrom] = load_chromosome(store, chrom)
+            panel['bim'][chrom] = panel['store'][chrom]['bim']
+        else:
+            panel['bim'][chrom] = read_bim(bfile_chr + str(chrom))
+    return panel
+
+
+def gene_window(genes, window):
+
+    """ Window START/END of genes. window is a size or an (upstream, downstream) pair;
+        with a STRAND column, upstream is before START for + strand genes and after END for - strand genes """
+
+    up, down = window if isinstance(window, (tuple, list)) else (window, window)
+    df = genes.copy()
+    if 'STRAND' in df.columns:
+        minus = (df['STRAND'] == '-').values
+        start = df['START'].values - np.where(minus, down, up)
+        end = df['END'].values + np.where(minus, up, down)
+    else:
+        start = df['START'].values - up
+        end = df['END'].values + down
+    df['START'] = np.maximum(0, start)
+    df['END'] = end
+    return df
+
+
+def snp_ranges(intervals, sorted_bp):
+
+    """ [lo, hi) range of the sorted SNP positions inside each (inclusive) interval """
+
+    lo = np.searchsorted(sorted_bp, intervals.START.values, side='left')
+    hi = np.searchsorted(sorted_bp, intervals.END.values, side='right')
+    return lo, hi
+
+
+def genes_to_intervals(genes, coords, window, gene_col='GENENAME'):
+
+    """ Gene windows for a list of genes (binary) or a genes x value data frame (continuous) """
+
+    if isinstance(genes, pd.DataFrame) and genes.shape[1] > 1:
+        geneset = genes.iloc[:, :2].copy()
+        geneset.columns = [gene_col, 'ANNOT']
+    else:
+        geneset = pd.DataFrame({gene_col: np.asarray(genes).ravel()})
+    df = pd.merge(geneset, coords, on=gene_col, how='inner')
+    return gene_window(df, window)
+
+
+def rsids_to_intervals(rsids, bim):
+
+    """ Single base intervals for a list of rsids (binary) or a rsids x value data frame (continuous) """
+
+    if isinstance(rsids, pd.DataFrame) and rsids.shape[1] > 1:
+        rs = rsids.iloc[:, :2].copy()
+        rs.columns = ['SNP', 'ANNOT']
+    else:
+        rs = pd.DataFrame({'SNP': np.asarray(rsids).ravel()})
+    df = pd.merge(rs, bim, how='inner', on='SNP')
+    df = df.rename(columns={'BP': 'START'})
+    df['END'] = df['START']
+    return df
+
+
+def ranges_to_annotation(lo, hi, order, values=None):
+
+    """ Per-SNP annotation (in the original order of the SNPs sorted by order) from the [lo, hi) sorted SNP ranges of
+        intervals: 1 if inside any range (binary, values None) or the mean value of the overlapping ranges """
+
+    n = len(order)
+    annot = np.zeros(n)
+    # Add each interval to the range of SNPs it covers with a difference array
+    count = np.zeros(n + 1)
+    np.add.at(count, lo, 1)
+    np.add.at(count, hi, -1)
+    count = np.cumsum(count)[:-1]
+    if values is None:
+        annot[order] = (count > 0).astype(float)
+        return annot.astype(int)
+    total = np.zeros(n + 1)
+    values = np.asarray(values, dtype=float)
+    np.add.at(total, lo, values)
+    np.add.at(total, hi, -values)
+    total = np.cumsum(total)[:-1]
+    annot[order] = np.where(count > 0, total / np.maximum(count, 1), 0)
+    return annot
+
+
+def annotate_snps(intervals, bim, binary=True):
+
+    """ Per-SNP annotation of a .bim panel: 1 if inside any interval (binary) or the mean value of the overlapping intervals """
+
+    bp = bim.BP.values
+    order = np.argsort(bp, kind='mergesort')
+    chrom_bim = set(normalize_chrom(x) for x in pd.unique(bim.CHR))
+    sel = np.array([normalize_chrom(x) in chrom_bim for x in intervals.CHR], dtype=bool)
+    if not sel.any():
+        annot = np.zeros(len(bp))
+        return annot.astype(int) if binary else annot
+    lo, hi = snp_ranges(intervals[sel], bp[order])
+    return ranges_to_annotation(lo, hi, order, None if binary else intervals.ANNOT.values[sel])
+
+
+def build_annotation(genes, coords, panel, window, gene_col='GENENAME'):
+
+    """ Per-chromosome SNP annotation arrays of a geneset, aligned to the panel .bim files """
+
+    intervals = genes_to_intervals(genes, coords, window, gene_col)
+    binary = 'ANNOT' not in intervals.columns
+    annot = {}
+    for chrom in panel['chroms']:
+        chrom_intervals = intervals[intervals.CHR.map(normalize_chrom) == normalize_chrom(chrom)]
+        annot[chrom] = annotate_snps(chrom_intervals, panel['bim'][chrom], binary)
+    return annot
+
+
+def compute_ldscores(annot, panel, names=None):
+
+    """ LD scores, M and M_5_50 per chromosome for annotation arrays, using the panel LD matrix store """
+
+    ldscores = {}
+    for chrom in panel['chroms']:
+        chrom_store = panel['store'][chrom]
+        a = np.asarray(annot[chrom], dtype=np.float64)
+        if a.ndim == 1:
+            a = a[:, None]
+        kept = chrom_store['kept']
+        cols = names if names is not None else ['ANNOT'] if a.shape[1] == 1 else ['ANNOT' + str(i) for i in range(a.shape[1])]
+        df = chrom_store['bim'].iloc[chrom_store['rows']][['CHR','SNP','BP']].reset_index(drop=True)
+        l2 = ldscores_from_store(chrom_store, a)
+        for i, name in enumerate(cols):
+            df[name + 'L2'] = l2[:, i]
+        ldscores[chrom] = {'ldscore': df,
+                           'M': a[kept].sum(axis=0),
+                           'M_5_50': a[kept & (chrom_store['maf'] > 0.05)].sum(axis=0)}
+    return ldscores
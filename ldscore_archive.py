@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import pandas as pd
+import numpy as np
+import h5py
+import argparse
+import glob
+import gzip
+import logging
+import os
+
+
+# Layout of an archive:
+#   /snps/<chrom>/SNP, /snps/<chrom>/BP       shared LDscore SNP index of each chromosome
+#   /sets/<name>/<chrom>/L2                   float32 LDscores, SNPs x annotations, one chunk per column
+#   /sets/<name>/<chrom>/M, M_5_50            float64 vectors
+#   /sets/<name>/<chrom>/annot                float32 thin annotation (optional), aligned to the plink .bim
+# Annotation column names are kept in the 'columns' attribute of each set.
+ARCHIVE_FORMAT = 'sc_enrichment_ldscores'
+ARCHIVE_VERSION = 1
+LDSCORE_SUFFIXES = ['.l2.ldscore.gz', '.l2.M', '.l2.M_5_50']
+
+
+def is_archive(path):
+    return path.rstrip('/').endswith('.h5')
+
+
+def find_ldscore_sets(ldscore_dir, chroms=range(1,23)):
+
+    """ Names of the complete LDscore sets (name.<chrom>.l2.*) of a folder """
+
+    names = set()
+    for m_file in glob.glob(os.path.join(ldscore_dir, '*.' + str(chroms[0]) + '.l2.M_5_50')):
+        names.add(os.path.basename(m_file)[:-len('.' + str(chroms[0]) + '.l2.M_5_50')])
+    return sorted(x for x in names
+                  if all(os.path.exists(os.path.join(ldscore_dir, x + '.' + str(c) + s)) for c in chroms for s in LDSCORE_SUFFIXES))
+
+
+def linked_set(ldscore_dir, name, chrom):
+
+    """ Name of the set whose files a deduplicated set links to (see geneset_dedup.link_ldscores), else None """
+
+    path = os.path.join(ldscore_dir, name + '.' + str(chrom) + '.l2.ldscore.gz')
+    if not os.path.islink(path):
+        return None
+    return os.path.basename(os.readlink(path))[:-len('.' + str(chrom) + '.l2.ldscore.gz')]
+
+
+def pack_ldscores(ldscore_dir, archive, names=None, chroms=range(1,23), with_annot=True):
+
+    """ Pack the per-chromosome LDscore (and thin annotation) files of one or more sets into one HDF5 archive """
+
+    chroms = list(chroms)
+    names = names or find_ldscore_sets(ldscore_dir, chroms)
+    links = dict((x, linked_set(ldscore_dir, x, chroms[0])) for x in names)
+    with h5py.File(archive, 'w') as f:
+        f.attrs['format'] = ARCHIVE_FORMAT
+        f.attrs['version'] = ARCHIVE_VERSION
+        f.attrs['chroms'] = np.array(chroms)
+        for name in [x for x in names if links[x] not in names]:
+            for chrom in chroms:
+                prefix = os.path.join(ldscore_dir, name + '.' + str(chrom))
+                df = pd.read_csv(prefix + '.l2.ldscore.gz', compression='gzip', delim_whitespace=True)
+                snps = 'snps/' + str(chrom)
+                if snps not in f:
+                    f.create_dataset(snps + '/SNP', data=df.SNP.values.astype('S'))
+                    f.create_dataset(snps + '/BP', data=df.BP.values.astype(np.int64))
+                elif len(f[snps + '/SNP']) != len(df) or not (f[snps + '/SNP'][:] == df.SNP.values.astype('S')).all():
+                    raise ValueError(prefix + '.l2.ldscore.gz does not have the SNPs of the other sets in the archive')
+                group = f.create_group('sets/' + name + '/' + str(chrom))
+                cols = [x for x in df.columns if x not in ['CHR','SNP','BP','CM','MAF']]
+                l2 = df[cols].values.astype(np.float32)
+                group.create_dataset('L2', data=l2, chunks=(len(l2), 1), compression='gzip', shuffle=True)
+                group.create_dataset('M', data=np.loadtxt(prefix + '.l2.M', ndmin=1))
+                group.create_dataset('M_5_50', data=np.loadtxt(prefix + '.l2.M_5_50', ndmin=1))
+                if with_annot and os.path.exists(prefix + '.annot.gz'):
+                    annot = pd.read_csv(prefix + '.annot.gz', compression='gzip', delim_whitespace=True)
+                    group.create_dataset('annot', data=annot.values.astype(np.float32), compression='gzip', shuffle=True)
+                    group['annot'].attrs['columns'] = np.array(list(annot.columns), dtype='S')
+            f['sets/' + name].attrs['columns'] = np.array([x[:-len('L2')] if x.endswith('L2') else x for x in cols], dtype='S')
+        # Identical sets only point to the data of their canonical copy
+        for name in [x for x in names if links[x] in names]:
+            f['sets/' + name] = h5py.SoftLink('/sets/' + links[name])
+    logging.info('Packed ' + str(len(names)) + ' LDscore set(s) into ' + archive)
+
+
+def archive_sets(archive):
+
+    """ Names of the LDscore sets of an archive """
+
+    with h5py.File(archive, 'r') as f:
+        return sorted(f['sets'].keys())
+
+
+def _decode(values):
+    return [x.decode('utf-8') if isinstance(x, bytes) else x for x in values]
+
+
+def read_archive(archive, name, chrom, columns=None):
+
+    """ LDscores of one set and chromosome (optionally only some annotation columns), with M and M_5_50 """
+
+    with h5py.File(archive, 'r') as f:
+        group = f['sets/' + name + '/' + str(chrom)]
+        names = _decode(f['sets/' + name].attrs['columns'])
+        idx = list(range(len(names))) if columns is None else [names.index(x) for x in columns]
+        l2 = np.column_stack([group['L2'][:, i] for i in idx]) if idx else np.zeros((len(f['snps/' + str(chrom) + '/SNP']), 0))
+        df = pd.DataFrame({'CHR': chrom,
+                           'SNP': _decode(f['snps/' + str(chrom) + '/SNP'][:]),
+                           'BP': f['snps/' + str(chrom) + '/BP'][:]}, columns=['CHR','SNP','BP'])
+        for j, i in enumerate(idx):
+            df[names[i] + 'L2'] = l2[:, j]
+        return df, group['M'][:][idx], group['M_5_50'][:][idx]
+
+
+def unpack_ldscores(archive, out_dir, names=None, chroms=None):
+
+    """ Write sets of an archive back as the per-chromosome files ldsc.py reads, return the set names """
+
+    with h5py.File(archive, 'r') as f:
+        names = names or sorted(f['sets'].keys())
+        chroms = chroms or list(f.attrs['chroms'])
+        with_annot = dict((x, 'annot' in f['sets/' + x + '/' + str(chroms[0])]) for x in names)
+    for name in names:
+        for chrom in chroms:
+            prefix = os.path.join(out_dir, name + '.' + str(chrom))
+            df, M, M_5_50 = read_archive(archive, name, chrom)
+            with gzip.open(prefix + '.l2.ldscore.gz', 'wb') as out:
+                out.write(df.to_csv(sep='\t', index=False, float_format='%.3f').encode('utf-8'))
+            with open(prefix + '.l2.M', 'w') as out:
+                out.write('\t'.join(map(str, M)) + '\n')
+            with open(prefix + '.l2.M_5_50', 'w') as out:
+                out.write('\t'.join(map(str, M_5_50)) + '\n')
+            if with_annot[name]:
+                with h5py.File(archive, 'r') as f:
+                    annot = f['sets/' + name + '/' + str(chrom) + '/annot']
+                    annot = pd.DataFrame(annot[:], columns=_decode(annot.attrs['columns']))
+                with gzip.open(prefix + '.annot.gz', 'wb') as out:
+                    out.write(annot.to_csv(sep='\t', index=False, float_format='%g').encode('utf-8'))
+    logging.info('Unpacked ' + str(len(names)) + ' LDscore set(s) from ' + archive + ' to ' + out_dir)
+    return names
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['pack','unpack','list'])
+    parser.add_argument('--archive', required=True, help = 'HDF5 LDscore archive (.h5)')
+    parser.add_argument('--ldscore-dir', help = 'Folder with the per-chromosome LDscore files (pack) or to write them to (unpack)')
+    parser.add_argument('--names', help = 'Comma separated LDscore sets to pack or unpack, default all')
+    parser.add_argument('--no-annot', action='store_true', default=False, help = 'Do not pack the .annot.gz files')
+    parser.add_argument("--verbose", help="increase output verbosity",action="store_true")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    names = args.names.split(',') if args.names else None
+    if args.command == 'pack':
+        pack_ldscores(args.ldscore_dir, args.archive, names, with_annot=not args.no_annot)
+    elif args.command == 'unpack':
+        unpack_ldscores(args.archive, args.ldscore_dir, names)
+    else:
+        print('\n'.join(archive_sets(args.archive)))
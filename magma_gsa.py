@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import pandas as pd
+import numpy as np
+import scipy.stats as st
+import scipy.linalg as la
+import argparse
+import logging
+from resident import resident_load
+
+
+def read_genes_raw(raw_file):
+
+    """ Read a MAGMA .genes.raw file: gene table and the correlations of each gene with the genes preceding it """
+
+    covar_names = []
+    genes = []
+    corrs = []
+    with open(raw_file) as f:
+        for line in f:
+            if line.startswith('#'):
+                if line.startswith('# COVAR'):
+                    covar_names = line.split('=')[1].split()
+                continue
+            fields = line.split()
+            if not fields:
+                continue
+            n_fixed = 6 + len(covar_names) + 1
+            genes.append(fields[:n_fixed])
+            corrs.append(np.array(fields[n_fixed:], dtype=float))
+    genes = pd.DataFrame(genes, columns=['GENE','CHR','START','STOP','NSNPS','NPARAM'] + covar_names + ['ZSTAT'])
+    for col in genes.columns[2:]:
+        genes[col] = genes[col].astype(float)
+    return genes, corrs
+
+
+def correlation_blocks(genes, corrs):
+
+    """ Dense gene-gene correlation matrix per chromosome.
+        The k values listed for gene i are its correlations with genes i-k, ..., i-1 of the file """
+
+    blocks = []
+    chrom = genes.CHR.values
+    start = 0
+    for end in list(np.flatnonzero(chrom[1:] != chrom[:-1]) + 1) + [len(genes)]:
+        R = np.eye(end - start)
+        for i in range(start, end):
+            k = min(len(corrs[i]), i - start)
+            if k:
+                R[i - start, i - start - k:i - start] = corrs[i][len(corrs[i]) - k:]
+        R = np.tril(R) + np.tril(R, -1).T
+        blocks.append((start, end, R))
+        start = end
+    return blocks
+
+
+def whitener(blocks):
+
+    """ Cholesky factor of each correlation block, with a small ridge if a block is not positive definite """
+
+    factors = []
+    for start, end, R in blocks:
+        ridge = 0.0
+        while True:
+            try:
+                L = la.cholesky(R + ridge * np.eye(len(R)), lower=True)
+                break
+            except la.LinAlgError:
+                ridge = 1e-4 if ridge == 0 else ridge * 10
+        if ridge:
+            logging.info('Gene correlation block ' + str(start) + '-' + str(end) + ' regularized with ridge ' + str(ridge))
+        factors.append((start, end, L))
+    return factors
+
+
+def whiten(factors, x):
+
+    """ L^-1 x for the block diagonal Cholesky factor """
+
+    out = np.empty_like(x, dtype=np.float64)
+    for start, end, L in factors:
+        out[start:end] = la.solve_triangular(L, x[start:end], lower=True)
+    return out
+
+
+def default_covariates(genes):
+
+    """ MAGMA default gene covariates: gene size, gene density, inverse mean MAC, the logs of these and log sample size """
+
+    covar = {'size': genes.NSNPS.values, 'density': genes.NPARAM.values / genes.NSNPS.values}
+    if 'MAC' in genes.columns:
+        covar['inverse_mac'] = 1.0 / genes.MAC.values
+    df = pd.DataFrame(covar)
+    for col in list(df.columns):
+        df['log_' + col] = np.log(df[col])
+    if 'NSAMP' in genes.columns and genes.NSAMP.nunique() > 1:
+        df['log_nsamp'] = np.log(genes.NSAMP.values)
+    return df
+
+
+def read_set_annot(set_file):
+
+    """ Gene-sets of a MAGMA --set-annot file (name gene1 gene2 ...) """
+
+    sets = []
+    with open(set_file) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 1:
+                sets.append((fields[0], fields[1:]))
+    return sets
+
+
+def set_matrix(genes, sets):
+
+    """ Genes x sets indicator matrix """
+
+    index = dict((g, i) for i, g in enumerate(genes.GENE.values))
+    S = np.zeros((len(genes), len(sets)))
+    for j, (name, members) in enumerate(sets):
+        rows = [index[g] for g in set(members) if g in index]
+        S[rows, j] = 1
+    return S
+
+
+def competitive_gsa(raw_file, sets, condition=None, gene_covar=None, batch_size=500):
+
+    """ Competitive gene-set analysis of many sets at once: GLS of gene Z on each set indicator and shared covariates """
+
+    genes, corrs = resident_load('genes_raw', [raw_file], read_genes_raw, raw_file)
+    covar = default_covariates(genes)
+    keep = np.ones(len(genes), dtype=bool)
+
+    condition = condition or []
+    test_sets = [x for x in sets if x[0] not in condition]
+    cond_sets = [x for x in sets if x[0] in condition]
+    if cond_sets:
+        C = set_matrix(genes, cond_sets)
+        for j, (name, members) in enumerate(cond_sets):
+            covar['set_' + name] = C[:, j]
+    if gene_covar is not None:
+        gc = pd.merge(genes[['GENE']], gene_covar, how='left', on='GENE')
+        for col in gene_covar.columns[1:]:
+            covar['covar_' + str(col)] = gc[col].values
+        keep &= ~gc.isnull().any(axis=1).values
+    if not keep.all():
+        logging.info('Removing ' + str((~keep).sum()) + ' genes without covariate values')
+        corrs = [c for c, k in zip(corrs, keep) if k]
+        genes = genes[keep].reset_index(drop=True)
+        covar = covar[keep].reset_index(drop=True)
+
+    factors = whitener(correlation_blocks(genes, corrs))
+    z = genes.ZSTAT.values
+    X = np.column_stack([np.ones(len(genes)), covar.values])
+    Xw = whiten(factors, X)
+    zw = whiten(factors, z)
+    Q = la.qr(Xw, mode='economic')[0]
+    rz = zw - np.dot(Q, np.dot(Q.T, zw))
+    rzz = np.dot(rz, rz)
+    df_resid = len(genes) - X.shape[1] - 1
+
+    results = []
+    for c0 in range(0, len(test_sets), batch_size):
+        batch = test_sets[c0:c0 + batch_size]
+        S = set_matrix(genes, batch)
+        Sw = whiten(factors, S)
+        rS = Sw - np.dot(Q, np.dot(Q.T, Sw))
+        ss = np.sum(rS ** 2, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            beta = np.dot(rS.T, rz) / ss
+            sigma2 = (rzz - beta ** 2 * ss) / df_resid
+            se = np.sqrt(sigma2 / ss)
+            p = st.t.sf(beta / se, df_resid)
+            beta_std = beta * np.std(S, axis=0) / np.std(z)
+        for j, (name, members) in enumerate(batch):
+            results.append((name, 'SET', int(S[:, j].sum()), beta[j], beta_std[j], se[j], p[j]))
+    df = pd.DataFrame(results, columns=['VARIABLE','TYPE','NGENES','BETA','BETA_STD','SE','P'])
+    df = df[df.NGENES > 0]
+    return df, genes
+
+
+def write_gsa_out(df, genes, out, condition=None):
+
+    """ Write results in the layout of MAGMA's .gsa.out """
+
+    with open(out + '.gsa.out', 'w') as f:
+        if 'NSAMP' in genes.columns:
+            f.write('# MEAN_SAMPLE_SIZE = ' + str(round(genes.NSAMP.mean(), 2)) + '\n')
+        f.write('# TOTAL_GENES = ' + str(len(genes)) + '\n')
+        f.write('# TEST_DIRECTION = one-sided, positive (set)\n')
+        if condition:
+            f.write('# CONDITIONED_INTERNAL = ' + ','.join(condition) + '\n')
+        f.write(df.to_string(index=False, float_format=lambda x: '%.5g' % x) + '\n')
+
+
+def run_gsa(raw_file, set_file, out, condition=None, gene_covar_file=None, covar_cols=None):
+
+    """ Drop-in replacement for magma --gene-results --set-annot [condition=] [--gene-covar condition=] """
+
+    gene_covar = None
+    if gene_covar_file:
+        gene_covar = pd.read_csv(gene_covar_file, delim_whitespace=True, header=None)
+        cols = [0] + ([int(x) for x in covar_cols.split(',')] if covar_cols else list(range(1, gene_covar.shape[1])))
+        gene_covar = gene_covar[cols]
+        gene_covar.columns = ['GENE'] + ['c' + str(x) for x in cols[1:]]
+        gene_covar['GENE'] = gene_covar.GENE.astype(str)
+    condition = condition.split(',') if condition else []
+    df, genes = competitive_gsa(raw_file, read_set_annot(set_file), condition, gene_covar)
+    write_gsa_out(df, genes, out, condition)
+    logging.info('Gene-set analysis of ' + str(len(df)) + ' sets written to ' + out + '.gsa.out')
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gene-results', required=True, help = 'MAGMA .genes.raw file')
+    parser.add_argument('--set-annot', required=True, help = 'Gene-set file, one set per line: name gene1 gene2 ...')
+    parser.add_argument('--condition', help = 'Comma separated names of sets in --set-annot to condition on')
+    parser.add_argument('--gene-covar', help = 'File with gene ID and continuous covariate columns to condition on')
+    parser.add_argument('--gene-covar-condition', help = 'Comma separated (1-based, excluding the gene ID) columns of --gene-covar to use')
+    parser.add_argument('--out', required=True, help = 'Output prefix')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    run_gsa(args.gene_results, args.set_annot, args.out, args.condition, args.gene_covar, args.gene_covar_condition)
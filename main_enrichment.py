@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import pandas as pd
+import numpy as np
+import argparse
+import subprocess
+import shlex
+import sys
+import logging
+import os
+from staging import stage_file, work_dir
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--main-annot-genes', help = 'Path to file with a list of genes to run as your annotation. This can also have an additional column for continuous annotations.')
+    parser.add_argument('--main-annot-ldcts', help = 'Path to file that has prefix "\t" google bucket path to a geneset, one per line.')
+    parser.add_argument('--condition-annot-genes', help = 'Comma separated gene list file(s) to condition on, in both LDSC and MAGMA.')
+    parser.add_argument('--summary-stats-files', required=True, help = 'Comma separated list of summary statistics (processed with munge_sumstats.py, ending with .sumstats.gz).')
+    parser.add_argument('--prefix', required=True, help = 'Prefix for the ldscore and results files.')
+    parser.add_argument('--out', required=True, help = 'Path to save the results of both methods and the combined report.')
+    parser.add_argument('--windowsize', type=int, help = 'Size (in KB) of the window around the gene used by both methods. If not given each method uses its own default.')
+    parser.add_argument('--window-up', type=int, help = 'Size (in KB) of the window upstream of the gene used by both methods, default is --windowsize')
+    parser.add_argument('--window-down', type=int, help = 'Size (in KB) of the window downstream of the gene used by both methods, default is --windowsize')
+    parser.add_argument('--quantiles', type=int, default=5, help = 'For a continuous annotation, number of quantiles of the gene values used as bins by both methods, default=5.')
+    parser.add_argument('--cont-breaks', type=str, help = 'Specific boundary points to split a continuous annotation on, comma separated, used by both methods.')
+    parser.add_argument('--ldsc-args', default='', help = 'Extra arguments passed to main_ldscore.py, as one quoted string.')
+    parser.add_argument('--magma-args', default='', help = 'Extra arguments passed to main_magma.py, as one quoted string.')
+    parser.add_argument('--work-dir', default=work_dir(), help = 'Working folder shared by both methods, default is $SC_WORK_DIR or /mnt/data')
+    parser.add_argument("--verbose", help="increase output verbosity",action="store_true")
+
+    args = parser.parse_args()
+    if not (args.main_annot_genes or args.main_annot_ldcts):
+        parser.error("You have to specify --main-annot-genes or --main-annot-ldcts")
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    return args
+
+
+def stage_inputs(args):
+
+    """ Download the genesets and summary statistics once, where both main_ldscore.py and main_magma.py look for them """
+
+    for folder in ['ss','genesets','tmp']:
+        if not os.path.exists(os.path.join(args.work_dir,folder)):
+            os.makedirs(os.path.join(args.work_dir,folder))
+    genesets = []
+    if args.main_annot_genes:
+        genesets.append(stage_file(args.main_annot_genes,args.work_dir))
+    if args.main_annot_ldcts:
+        ldcts = stage_file(args.main_annot_ldcts,args.work_dir,'file.ldcts')
+        with open(ldcts) as f:
+            for line in f:
+                if line.strip():
+                    genesets.append(stage_file(line.split()[1],os.path.join(args.work_dir,'genesets')))
+    for ss in args.summary_stats_files.split(','):
+        stage_file(ss,os.path.join(args.work_dir,'ss'))
+    return genesets
+
+
+def shared_breaks(args, genesets):
+
+    """ Bin edges of a continuous geneset computed once from the gene values, so LDSC and MAGMA use identical bins """
+
+    values = []
+    for geneset in genesets:
+        x = pd.read_csv(geneset, delim_whitespace=True, header=None)
+        if x.shape[1] > 1:
+            values.append(x[1].values.astype(float))
+    if not values:
+        return None
+    if args.cont_breaks:
+        return args.cont_breaks
+    values = np.concatenate(values)
+    edges = np.unique(np.percentile(values, np.linspace(0, 100, args.quantiles + 1)[1:-1]))
+    breaks = ','.join(str(x) for x in edges)
+    logging.info('Continuous annotation split on shared breaks: ' + breaks)
+    return breaks
+
+
+def method_commands(args, breaks):
+
+    """ main_ldscore.py and main_magma.py command lines sharing the staged inputs """
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    common = ['--summary-stats-files', args.summary_stats_files, '--prefix', args.prefix, '--out', args.out, '--work-dir', args.work_dir]
+    if args.main_annot_genes:
+        common += ['--main-annot-genes', args.main_annot_genes]
+    if args.main_annot_ldcts:
+        common += ['--main-annot-ldcts', args.main_annot_ldcts]
+    if args.condition_annot_genes:
+        common += ['--condition-annot-genes', args.condition_annot_genes]
+    if breaks:
+        common += ['--cont-breaks=' + breaks]
+    if args.verbose:
+        common += ['--verbose']
+
+    ldsc = [os.path.join(here,'main_ldscore.py')] + common + shlex.split(args.ldsc_args)
+    magma = [os.path.join(here,'main_magma.py')] + common + shlex.split(args.magma_args)
+    if args.windowsize:
+        # main_ldscore.py takes the window in bp, main_magma.py in KB
+        ldsc += ['--windowsize', str(args.windowsize * 1000)]
+        magma += ['--windowsize', str(args.windowsize)]
+    for flag, size in [('--window-up', args.window_up), ('--window-down', args.window_down)]:
+        if size is not None:
+            ldsc += [flag, str(size * 1000)]
+            magma += [flag, str(size)]
+    return ldsc, magma
+
+
+def read_gsa_out(gsa_file):
+    return pd.read_csv(gsa_file, delim_whitespace=True, comment='#')
+
+
+def combined_report(args, report_file):
+
+    """ One table with the LDSC and MAGMA result of every geneset and trait """
+
+    frames = []
+    for ss in args.summary_stats_files.split(','):
+        phname = os.path.basename(ss).replace('.sumstats.gz','')
+        ldsc_file = os.path.join(args.work_dir, phname + '.' + args.prefix + '.ldsc.cell_type_results.txt')
+        magma_file = os.path.join(args.work_dir, 'magma_results_' + phname + '.gsa.out')
+        ldsc = pd.DataFrame(columns=['GENESET','LDSC_COEF','LDSC_SE','LDSC_P'])
+        magma = pd.DataFrame(columns=['GENESET','MAGMA_BETA','MAGMA_SE','MAGMA_P'])
+        if os.path.exists(ldsc_file):
+            ldsc = pd.read_csv(ldsc_file, sep='\t')[['Name','Coefficient','Coefficient_std_error','Coefficient_P_value']]
+            ldsc.columns = ['GENESET','LDSC_COEF','LDSC_SE','LDSC_P']
+        if os.path.exists(magma_file):
+            magma = read_gsa_out(magma_file)[['VARIABLE','BETA','SE','P']]
+            magma.columns = ['GENESET','MAGMA_BETA','MAGMA_SE','MAGMA_P']
+        df = pd.merge(ldsc, magma, how='outer', on='GENESET')
+        df.insert(0, 'TRAIT', phname)
+        frames.append(df)
+    df = pd.concat(frames, ignore_index=True)
+    df.to_csv(report_file, sep='\t', index=False, na_rep='NA')
+    logging.info('Combined report written to ' + report_file)
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+    genesets = stage_inputs(args)
+    breaks = shared_breaks(args, genesets)
+    ldsc_cmd, magma_cmd = method_commands(args, breaks)
+
+    # Both methods run concurrently on the same VM and the same staged inputs
+    logging.info('Running: ' + ' '.join(ldsc_cmd))
+    ldsc = subprocess.Popen(ldsc_cmd)
+    logging.info('Running: ' + ' '.join(magma_cmd))
+    magma = subprocess.Popen(magma_cmd)
+    status = {'LDSC': ldsc.wait(), 'MAGMA': magma.wait()}
+    for method, code in status.items():
+        if code != 0:
+            logging.error(method + ' exited with status ' + str(code))
+
+    report_file = os.path.join(args.work_dir, args.prefix + '.combined_report.txt')
+    combined_report(args, report_file)
+    subprocess.call(['gsutil','cp',report_file,os.path.join(args.out,"")])
+
+    if any(status.values()):
+        sys.exit(1)
+    logging.info('FINITO!')
@@ -14,9 +14,40 @@ import random
 import string
 from pybedtools import BedTool
 from argparse import Namespace
+from geneset_dedup import dedup_genesets, link_ldscores
+from ld_matrix_store import calculate_ldscores_store, check_store
+from atom_basis import calculate_ldscores_atoms, basis_mismatch
+from approx_ldscores import APPROX_MODES, calculate_ldscores_approx, approximation_error
+from staging import stage_file, work_dir, reference_dir, reference_lock
+from async_upload import AsyncUploader, copy_file
+from scratch import ScratchManager
+from resident import resident_load
+from ldscore_archive import is_archive, archive_sets, pack_ldscores, unpack_ldscores
+from ldsc_regression import load_regression_panels, read_cts_panels, h2_cts, h2_cts_screen
+from ldscore_api import load_panel
+from composite_panel import composite_panel
+from annot_overlap import overlap_provider
+from resource_estimator import ldsc_features, ldscores_stage, estimate, record_stage, track_memory
+import time
+from null_genesets import gene_features, sample_matched, write_null_gmt, write_null_annotations, null_calibration
+import genesets_to_ldscores
+from incremental import plan_incremental, fetch_ldscores, fetch_previous_results, merge_results, updated_manifest, write_manifest, manifest_name, trait_name
 
 
-def parse_args():
+# Working folder of the job (--work-dir) and folder of the shared reference data (--reference-dir), set by main
+WORK_DIR = work_dir()
+REFERENCE_DIR = reference_dir() or WORK_DIR
+
+
+def work(path=''):
+    return os.path.join(WORK_DIR, path)
+
+
+def reference(path=''):
+    return os.path.join(REFERENCE_DIR, path)
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--main-annot-genes', help = 'Path to file with a list of genes to run as your annotation.This can also have an additional column for continuous annotations.')
@@ -26,6 +57,9 @@ def parse_args():
     
     parser.add_argument('--main-annot-ldcts',help='Path to file that has prefix for what you want your ldcsores to be named "\t" google bucket path to a geneset, one per line to run multiple genesets using --cts flag in ldsc software on one machine.')
     parser.add_argument('--main-annot-ldscores-ldcts',help='Path to file that has prefix of ldscores "\t" gs://path/to/ldscores/prefix.*')
+    parser.add_argument('--incremental', action='store_true', default=False, help='With --main-annot-ldcts, only run the (geneset, trait) pairs without results in --out: a manifest of the earlier runs (<prefix>.manifest.json) records the geneset and summary statistic checksums. LDscores exported by earlier runs to --export-ldscore-path are reused, and the new rows are merged into the existing cell_type_results tables')
+    parser.add_argument('--dedup-genesets', action='store_true', default=False, help='With --main-annot-ldcts, compute LDscores only once for genesets with identical SNP annotations and report near-duplicate genesets.')
+    parser.add_argument('--jaccard-threshold', type=float, default=0.9, help='With --dedup-genesets, report geneset pairs whose SNP annotations have at least this jaccard overlap. Default is 0.9.')
 
     parser.add_argument('--condition-annot-genes', help = 'Path to file with a list of genes to run as a conditional annotation.This can also have an additional column for continuous annotations.')
     parser.add_argument('--condition-annot-rsids',help='Path to file with list of rsids to run as a conditional annotation. This can also have an additional column for a continuous annotation.')
@@ -37,25 +71,50 @@ def parse_args():
     parser.add_argument('--prefix', required=True, help = 'Prefix that will be used for the ldscore files and the regression output files. If using a --main-annot-*-ldcts flag, this should be a common descriptor of the analyses.')
     parser.add_argument('--out', required=False, help = 'Path to save the regression results.')
     parser.add_argument('--export-ldscore-path', help = 'Path to export the LDscores generated from --main-annot-rsids/genes/bed')
+    parser.add_argument('--ldscore-archive', action='store_true', default=False, help = 'Export the LDscores as one packed HDF5 archive <prefix>.ldscores.h5 (see ldscore_archive.py) instead of per-chromosome files')
     parser.add_argument('--no-baseline', action='store_true', default=False, help = 'Do not condition on baseline annotations')
     parser.add_argument('--exclude-file', help = 'File in UCSC bed format of regions to exclude in regression')
 
     parser.add_argument('--windowsize', type=int, default=100000, help = 'size of the window around the gene')
+    parser.add_argument('--window-up', type=int, help = 'size of the window before the gene start (the gene coordinate file has no strand), default is --windowsize')
+    parser.add_argument('--window-down', type=int, help = 'size of the window after the gene end, default is --windowsize')
     parser.add_argument('--snp-list-file', default="gs://singlecellldscore/list.txt", help = 'Path of the file containing the list of SNPs to use for the generation of the LD-scores')
     parser.add_argument('--full-report', help = 'Return a full report, including coefficients and enrichment for all annotations.',action="store_true", default=False)
+    parser.add_argument('--in-process-regression', help = 'Run the --h2-cts (and --full-report) regressions in-process: the baseline design and its jackknife blocks are factorized once per trait and all cts annotations are fitted in vectorized batches.',action="store_true", default=False)
+    parser.add_argument('--screen-p', type=float, help = 'Two-tier mode for large geneset collections, with --in-process-regression: every geneset is screened with one regression fit and an analytic standard error (scaled to the jackknife on a subset), and only the ones with a screening P-value below this get the block jackknife regression and --full-report. The Tier column of the results is 1 (screened out) or 2 (full regression)')
+    parser.add_argument('--screen-calibration', type=int, default=50, help = 'Number of genesets fitted with the jackknife to scale the --screen-p standard errors, default=50')
+    parser.add_argument('--null-genesets', type=int, default=0, help = 'Number of random genesets matched on gene length, SNP coverage and SNP density to sample for each binary --main-annot-genes/--main-annot-ldcts geneset. Their LDscores are computed in bulk and regressed to give an empirical P-value per geneset. Requires --in-process-regression')
+    parser.add_argument('--null-seed', type=int, default=0, help = 'Random seed for --null-genesets')
     parser.add_argument('--gene-coord-file', default="gs://singlecellldscore/GENENAME_gene_annot.txt", help = 'Path of the file containing start and end position for each gene, default is ENTREZ')
     parser.add_argument('--gene-col-name', default="GENENAME", help = 'Gene column name in the file specified in --gene-coord-file')
 
     parser.add_argument('--tkg-weights-folder', default="gs://singlecellldscore/1000G_Phase3_weights_hm3_no_MHC", help = 'Folder containing the chr-specific files with 1000 genomes weights for running LDscore regression')
     parser.add_argument('--tkg-plink-folder', default="gs://singlecellldscore/plink_files", help = 'Folder containing the chr-specific plink files from 1000 genomes to be used to create LDscores')
     parser.add_argument('--tkg-freq-folder', default="gs://singlecellldscore/1000G_Phase3_frq", help = 'Folder containing the chr-specific plink files with 1000 genomes frequencies')
+    parser.add_argument('--ld-matrix-store', help = 'Folder with a prebuilt banded LD matrix store (see ld_matrix_store.py). If given, LDscores for --annot style annotations are computed from it instead of from the plink genotypes')
+    parser.add_argument('--atom-basis', help = 'Folder with a precomputed atom basis (see atom_basis.py) of the plink panel for the --gene-coord-file and window size. LDscores of gene-window annotations (binary, or continuous without bins) are then exact sums of its per-atom columns, without reading genotypes; other annotations fall back to the usual computation')
+    parser.add_argument('--approx-ldscores', choices=APPROX_MODES, help = 'Approximate LDscores for exploratory runs of --annot style annotations, in the same files as ldsc.py: pairs of SNPs closer than --approx-exact-cm are exact, the rest of the 1 cM window is summed over a random --approx-fraction of the reference SNPs (thin) or correlated on a random --approx-rank sketch of the individuals (sketch)')
+    parser.add_argument('--approx-fraction', type=float, default=0.1, help = 'Fraction of the reference SNPs kept by --approx-ldscores thin, default=0.1')
+    parser.add_argument('--approx-rank', type=int, default=64, help = 'Sketch dimension of --approx-ldscores sketch, default=64')
+    parser.add_argument('--approx-exact-cm', type=float, default=0.1, help = 'Pairs of SNPs closer than this (cM) are exact with --approx-ldscores, default=0.1')
+    parser.add_argument('--approx-check-chrom', type=int, default=22, help = 'Chromosome on which --approx-ldscores are compared with exact LDscores for the first geneset, written to <prefix>.approx_ldscore_error.txt (0 to skip), default=22')
     parser.add_argument('--baseline-ldscores-folder', default="gs://singlecellldscore/baselineLD_v1.1", help = 'Folder containing the baseline chr-specific LDscores to be used for conditioning')
+    parser.add_argument('--composite-panel', action='store_true', default=False, help = 'Join the baseline and conditional LDscores, M and annotation files once into a single panel per chromosome that every regression reads, instead of ldsc re-joining them for each trait and geneset')
+    parser.add_argument('--panel-cache', help = 'Local folder or google bucket path where --composite-panel panels and the annotation overlap matrices of --in-process-regression --full-report are cached, keyed by the checksums of their components, for reuse by later jobs')
+    parser.add_argument('--clean-scratch', action='store_true', default=False, help = 'Delete intermediate files from the working folder as soon as the last stage reading them is done: plink panels and LD matrix store after the LDscores, annotation files after their LDscores (spilled to --export-ldscore-path if given), summary statistics after their regression')
+    parser.add_argument('--estimate', action='store_true', default=False, help = 'Do not run anything: predict the time, memory and disk of each stage from the input sizes and print recommended dsub resource flags')
+    parser.add_argument('--estimate-calibration', help = 'Calibration file for --estimate fitted from recorded runs (resource_estimator.py fit)')
+    parser.add_argument('--record-run', help = 'Append the measured time and peak memory of each stage to this file, to calibrate --estimate')
+    parser.add_argument('--work-dir', default=work_dir(), help = 'Working folder of the job, where inputs are staged and intermediate and result files written. Concurrent jobs on one machine need one each. Default is $SC_WORK_DIR or /mnt/data')
+    parser.add_argument('--reference-dir', default=reference_dir(), help = 'Folder where the plink, weights, frequency and baseline folders (and --ld-matrix-store, --atom-basis) are staged, shared read-only by the jobs of a machine. Default is $SC_REFERENCE_DIR or the working folder')
     parser.add_argument("--verbose", help="increase output verbosity",action="store_true")
     
     parser.add_argument('--quantiles', type=int, default=0,required=False, help='If using a continuous annotation,the number of quantiles to split it into for regression. Default is 0. Then the annotation is treated as continuous.')
     parser.add_argument('--cont-breaks',type=str,required=False,help='Specific boundary points to split your continuous annotation on, comma separated list e.g. 0.1,0.4,0.5,0.6. ATTENTION: if you use negative values add a space in the beginning e.g. <space>-0.1,-0.4,0.5,0.6')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if not args.reference_dir:
+        args.reference_dir = args.work_dir
     if not args.just_ldscores:
         if not ((args.main_annot_genes or args.main_annot_rsids or args.main_annot_ldscores or args.main_annot_bed or args.main_annot_ldcts or args.main_annot_ldscores_ldcts) or args.summary_stats_files or args.prefix or args.out):
             parser.error("You have to specify --main-annot-* and --summary-stats-files and --prefix and --out")
@@ -67,6 +126,24 @@ def parse_args():
         if not (args.main_annot_ldscores_ldcts or args.main_annot_ldcts):
             parser.error("--full-report can only used with --main-annot-ldscores-ldcts or --main-annot-ldcts")
 
+    if args.in_process_regression and args.exclude_file:
+        parser.error("--in-process-regression can not be used with --exclude-file")
+
+    # Binned continuous annotations give several LDscore columns per geneset, which ldsc fits jointly
+    if args.in_process_regression and (args.quantiles or args.cont_breaks):
+        parser.error("--in-process-regression can not be used with --quantiles or --cont-breaks")
+
+    if args.screen_p and not args.in_process_regression:
+        parser.error("--screen-p needs --in-process-regression")
+
+    if args.incremental:
+        if not (args.main_annot_ldcts and args.out) or args.just_ldscores or args.null_genesets:
+            parser.error("--incremental needs --main-annot-ldcts and --out, and can not be used with --just-ldscores or --null-genesets")
+
+    if args.null_genesets:
+        if not (args.in_process_regression and (args.main_annot_genes or args.main_annot_ldcts)):
+            parser.error("--null-genesets needs --in-process-regression and --main-annot-genes or --main-annot-ldcts")
+
     if (args.cont_breaks):
         args.quantiles = None
 
@@ -101,58 +178,75 @@ def download_files(args,main_file,ss_list,prefix):
 
     #Create folders
     logging.info('Creating folders')
-    subprocess.call(['mkdir','/mnt/data/ss'])
-    subprocess.call(['mkdir','/mnt/data/outld'])
-    subprocess.call(['mkdir','/mnt/data/inld'])
-    subprocess.call(['mkdir','/mnt/data/tmp'])
-    subprocess.call(['mkdir','/mnt/data/genesets/'])
-
-    # Download plink files
-    logging.info('Downloading 1000 genomes plink files')
-    subprocess.call(['gsutil','-m','cp','-r',args.tkg_plink_folder,'/mnt/data/'])
-
-    # Downlad 1000 genome weights
-    logging.info('Downloading 1000 genomes weights for ldscore')
-    subprocess.call(['gsutil','-m','cp','-r',args.tkg_weights_folder,"/mnt/data/inld/"])
-
-    # Downlad frequency files
-    logging.info('Downloading 1000 genomes frequencies')
-    subprocess.call(['gsutil','-m','cp','-r',args.tkg_freq_folder,"/mnt/data/"])
-
-
-    # Download baseline
-    if not args.no_baseline:
-        logging.info('Downloading baseline annotation')
-        subprocess.call(['gsutil','-m','cp','-r',args.baseline_ldscores_folder,"/mnt/data/inld/"])
+    subprocess.call(['mkdir',work('ss')])
+    subprocess.call(['mkdir',work('outld')])
+    subprocess.call(['mkdir',work('tmp')])
+    subprocess.call(['mkdir',work('genesets/')])
+
+    # Reference data already there (e.g. kept by worker.py from an earlier job, or staged by
+    # another job sharing --reference-dir) is not copied again
+    with reference_lock(REFERENCE_DIR):
+        subprocess.call(['mkdir','-p',reference('inld')])
+        # Download plink files
+        logging.info('Downloading 1000 genomes plink files')
+        subprocess.call(['gsutil','-m','cp','-n','-r',args.tkg_plink_folder,reference()])
+
+        # Download prebuilt LD matrix store
+        if args.ld_matrix_store:
+            logging.info('Downloading LD matrix store')
+            subprocess.call(['gsutil','-m','cp','-n','-r',args.ld_matrix_store.rstrip('/'),reference()])
+
+        # Download precomputed atom basis
+        if args.atom_basis:
+            logging.info('Downloading atom basis')
+            subprocess.call(['gsutil','-m','cp','-n','-r',args.atom_basis.rstrip('/'),reference()])
+
+        # Downlad 1000 genome weights
+        logging.info('Downloading 1000 genomes weights for ldscore')
+        subprocess.call(['gsutil','-m','cp','-n','-r',args.tkg_weights_folder,reference('inld/')])
+
+        # Downlad frequency files
+        logging.info('Downloading 1000 genomes frequencies')
+        subprocess.call(['gsutil','-m','cp','-n','-r',args.tkg_freq_folder,reference()])
+
+        # Download baseline
+        if not args.no_baseline:
+            logging.info('Downloading baseline annotation')
+            subprocess.call(['gsutil','-m','cp','-n','-r',args.baseline_ldscores_folder,reference('inld/')])
 
 
     # Download main annotations
     if args.main_annot_ldscores:  
         logging.info('Downloading main annotation LDscores(s):' + main_file)
-        subprocess.call(['mkdir','/mnt/data/outld'])
-        if '*' in main_file:
-            subprocess.call(['gsutil','-m','cp','-r',main_file,'/mnt/data/outld/'])
+        subprocess.call(['mkdir',work('outld')])
+        if is_archive(main_file):
+            unpack_ldscores(stage_file(main_file,work('tmp/')),work('outld/'))
+        elif '*' in main_file:
+            subprocess.call(['gsutil','-m','cp','-r',main_file,work('outld/')])
         else:
-            subprocess.call(['gsutil','-m','cp','-r',os.path.join(main_file, "") + '*' ,'/mnt/data/outld/'])
+            subprocess.call(['gsutil','-m','cp','-r',os.path.join(main_file, "") + '*' ,work('outld/')])
     elif (args.main_annot_genes or args.main_annot_rsids or args.main_annot_bed):
         logging.info('Downloading main annotation file(s):' + main_file)
-        subprocess.call(['gsutil','cp',main_file,'/mnt/data/'])
+        stage_file(main_file,work())
     elif args.main_annot_ldcts:
         logging.info('Downloading main annotation files from list of files provided.')
-        subprocess.call(['gsutil','cp',main_file,'/mnt/data/file.ldcts'])
-        with open('/mnt/data/file.ldcts','r') as ldcts_file:
+        stage_file(main_file,work(),'file.ldcts')
+        with open(work('file.ldcts'),'r') as ldcts_file:
             for line in ldcts_file:
-                subprocess.call(['gsutil','cp',line,'/mnt/data/genesets/'])
+                stage_file(line.split()[1],work('genesets/'))
     elif args.main_annot_ldscores_ldcts:
         logging.info('Downloading main annotation files from list of files provided.')
-        subprocess.call(['gsutil','cp',main_file,'/mnt/data/file.ldcts'])
-        with open('/mnt/data/file.ldcts','r') as ldcts_file:
+        stage_file(main_file,work(),'file.ldcts')
+        with open(work('file.ldcts'),'r') as ldcts_file:
             for line in ldcts_file:
                 path = line.split()[1]
-                if '*' in path:
-                    subprocess.call(['gsutil','-m','cp','-r',path,'/mnt/data/outld/'])
+                if is_archive(path):
+                    # Several lines can point to the same archive, it is downloaded once
+                    unpack_ldscores(stage_file(path,work('tmp/')),work('outld/'),names=[line.split()[0]])
+                elif '*' in path:
+                    subprocess.call(['gsutil','-m','cp','-r',path,work('outld/')])
                 else:
-                    subprocess.call(['gsutil','-m','cp','-r',os.path.join(path, "") + '*' ,'/mnt/data/outld/'])
+                    subprocess.call(['gsutil','-m','cp','-r',os.path.join(path, "") + '*' ,work('outld/')])
 
     # Download conditional annotations
     if (args.condition_annot_ldscores or args.condition_annot_genes or args.condition_annot_rsids or args.condition_annot_bed):
@@ -166,33 +260,62 @@ def download_files(args,main_file,ss_list,prefix):
             cond_files = args.condition_annot_ldscores.split(',') 
         if args.condition_annot_ldscores:
             logging.info('Downloading conditional ldscores annotation(s)')
-            subprocess.call(['mkdir','/mnt/data/cond_ldscores'])
+            subprocess.call(['mkdir',work('cond_ldscores')])
             for k in cond_files:
+                if is_archive(k):
+                    # One folder per LDscore set of the archive
+                    archive = stage_file(k,work('tmp/'))
+                    for name in archive_sets(archive):
+                        ts = os.path.join(random_string(7),"")
+                        subprocess.call(['mkdir',work('cond_ldscores/') + ts])
+                        unpack_ldscores(archive,work('cond_ldscores/') + ts,names=[name])
+                    continue
                 ts = os.path.join(random_string(7),"")
-                subprocess.call(['mkdir','/mnt/data/cond_ldscores/' + ts])
-                subprocess.call(['gsutil','-m','cp','-r',os.path.join(k, "") + '*' ,'/mnt/data/cond_ldscores/' + ts])
+                subprocess.call(['mkdir',work('cond_ldscores/') + ts])
+                subprocess.call(['gsutil','-m','cp','-r',os.path.join(k, "") + '*' ,work('cond_ldscores/') + ts])
         else:
             logging.info('Downloading file(s) containing conditional annotations')
-            subprocess.call(['mkdir','/mnt/data/outcondld'])
+            subprocess.call(['mkdir',work('outcondld')])
             for k in cond_files:
-                subprocess.call(['gsutil','cp',k,"/mnt/data/"])
+                subprocess.call(['gsutil','cp',k,work()])
 	    
     # Dowload SNP-list for generating LD-scores
     logging.info('Downloading SNP list for LDscore')
-    subprocess.call(['gsutil','cp',args.snp_list_file,'/mnt/data/list.txt'])
+    subprocess.call(['gsutil','cp',args.snp_list_file,work('list.txt')])
 
     if args.exclude_file:
         logging.info('Downloading file to exclude in regression')
-        subprocess.call(['gsutil','cp',args.exclude_file,'/mnt/data/exclude.bed'])
+        subprocess.call(['gsutil','cp',args.exclude_file,work('exclude.bed')])
     # Download file mapping SNPs to positions
     logging.info('Downloading file to map genes to positions')
-    subprocess.call(['gsutil','cp',args.gene_coord_file,'/mnt/data/GENENAME_gene_annot.txt'])
+    subprocess.call(['gsutil','cp',args.gene_coord_file,work('GENENAME_gene_annot.txt')])
 
     # Download summary stats
     if not args.just_ldscores:
         logging.info('Downloading summary statistic(s):' + ':'.join(ss_list))
         for ss in ss_list:
-            subprocess.call(['gsutil','cp',ss,'/mnt/data/ss/'])
+            stage_file(ss,work('ss/'))
+
+def gene_window_size(args):
+
+    """ (upstream, downstream) window around the genes """
+
+    return (args.windowsize if args.window_up is None else args.window_up,
+            args.windowsize if args.window_down is None else args.window_down)
+
+def annotate_chromosome(args,chrom,outldscore,plink_panel,geneset_file=None,rsid_file=None,bed_file=None):
+
+    """ Write the annot files of one chromosome, running genesets_to_ldscores.py in-process """
+
+    genesets_to_ldscores.main(Namespace(geneset_file=geneset_file,
+                        rsid_file=rsid_file,
+                        bed_file=bed_file,
+                        gene_coord_file=work('GENENAME_gene_annot.txt'),
+                        bfile_chr=plink_panel,
+                        prefix=outldscore,
+                        chrom=chrom,
+                        windowsize=gene_window_size(args),
+                        gene_col_name=str(args.gene_col_name)))
 
 def prepare_annotations_bed(args,bed_file,outldscore,plink_panel):
 
@@ -200,15 +323,8 @@ def prepare_annotations_bed(args,bed_file,outldscore,plink_panel):
     logging.info('Creating LDscores')
 
     for chrom in range(1, 23):
-        logging.debug('Running genesets_to_ldscores.py for chr ' + str(chrom) + ' and bed-file ' + str(gene_list))
-        subprocess.call(['/home/sc_enrichment/sc_enrichment-master/genesets_to_ldscores.py',
-                        '--bed-file',bed_file,
-                        '--gene-coord-file',"/mnt/data/GENENAME_gene_annot.txt",
-                        '--bfile-chr',plink_panel,
-                        '--prefix',outldscore,
-                        '--windowsize',str(args.windowsize),
-                        '--gene-col-name', str(args.gene_col_name),
-                        '--chrom', str(chrom)])
+        logging.debug('Running genesets_to_ldscores.py for chr ' + str(chrom) + ' and bed-file ' + str(bed_file))
+        annotate_chromosome(args,chrom,outldscore,plink_panel,bed_file=bed_file)
 
 def prepare_annotations_genes(args,gene_list,outldscore,plink_panel):
     """Prepare LDscores for analysis"""
@@ -216,14 +332,7 @@ def prepare_annotations_genes(args,gene_list,outldscore,plink_panel):
 
     for chrom in range(1, 23):
         logging.debug('Running genesets_to_ldscores.py for chr ' + str(chrom) + ' and geneset-file ' + str(gene_list))
-        subprocess.call(['/home/sc_enrichment/sc_enrichment-master/genesets_to_ldscores.py',
-                        '--geneset-file',gene_list,
-                        '--chrom',str(chrom),
-                        '--gene-coord-file',"/mnt/data/GENENAME_gene_annot.txt",
-                        '--bfile-chr',plink_panel,
-                        '--prefix',outldscore,
-                        '--windowsize',str(args.windowsize),
-                        '--gene-col-name', str(args.gene_col_name)])
+        annotate_chromosome(args,chrom,outldscore,plink_panel,geneset_file=gene_list)
 
 def prepare_annotations_genes_ldcts(args,gene_list,outldscore,plink_panel,local_prefix):
     """Prepare LDscores for analysis"""
@@ -231,14 +340,7 @@ def prepare_annotations_genes_ldcts(args,gene_list,outldscore,plink_panel,local_
 
     for chrom in range(1, 23):
         logging.debug('Running genesets_to_ldscores.py for chr ' + str(chrom) + ' and geneset-file ' + str(gene_list))
-        subprocess.call(['/home/sc_enrichment/sc_enrichment-master/genesets_to_ldscores.py',
-                        '--geneset-file',gene_list,
-                        '--chrom',str(chrom),
-                        '--gene-coord-file',"/mnt/data/GENENAME_gene_annot.txt",
-                        '--bfile-chr',plink_panel,
-                        '--prefix',outldscore+local_prefix,
-                        '--windowsize',str(args.windowsize),
-                        '--gene-col-name', str(args.gene_col_name)])
+        annotate_chromosome(args,chrom,outldscore+local_prefix,plink_panel,geneset_file=gene_list)
 
 def prepare_annotations_rsids(args,gene_list,outldscore,plink_panel):
     """Prepare LDscores for analysis"""
@@ -247,18 +349,64 @@ def prepare_annotations_rsids(args,gene_list,outldscore,plink_panel):
     for chrom in range(1, 23):
 
         logging.debug('Running genesets_to_ldscores.py for chr ' + str(chrom) + ' and rsid-file ' + str(gene_list))
-        subprocess.call(['/home/sc_enrichment/sc_enrichment-master/genesets_to_ldscores.py',
-                        '--rsid-file',gene_list,
-                        '--gene-coord-file',"/mnt/data/GENENAME_gene_annot.txt",
-                        '--bfile-chr',plink_panel,
-                        '--prefix',outldscore,
-                        '--windowsize',str(args.windowsize),
-                        '--gene-col-name', str(args.gene_col_name),
-                        '--chrom', str(chrom)])      
+        annotate_chromosome(args,chrom,outldscore,plink_panel,rsid_file=gene_list)
+
+def local_ld_matrix_store(args):
+    return reference(os.path.basename(args.ld_matrix_store.rstrip('/')))
+
+def local_atom_basis(args):
+    return reference(os.path.basename(args.atom_basis.rstrip('/')))
+
+def atom_ldscores(args,outldscore,chrom):
+
+    """ LDscores of one chromosome summed from --atom-basis, False if the annotation is not made of its atoms """
+
+    if not args.atom_basis:
+        return False
+    if calculate_ldscores_atoms(local_atom_basis(args),chrom,
+                            annot_file=outldscore + '.' + str(chrom) + '.annot.gz',
+                            out_prefix=outldscore + '.' + str(chrom)):
+        logging.debug('LDscores of chr ' + str(chrom) + ' summed from the atom basis')
+        return True
+    logging.debug('The annotation of chr ' + str(chrom) + ' is not made of atom basis atoms, computing its LDscores')
+    return False
+
+def approx_settings(args):
+
+    """ (fraction, rank, exact_cm) of --approx-ldscores """
+
+    return (args.approx_fraction if args.approx_ldscores == 'thin' else 1.0,
+            args.approx_rank if args.approx_ldscores == 'sketch' else None,
+            args.approx_exact_cm)
+
+def check_approx_ldscores(args,outldscore,plink_panel):
+
+    """ Error of --approx-ldscores against exact LDscores on one chromosome, for the first geneset of the job """
+
+    report = work() + args.prefix + '.approx_ldscore_error.txt'
+    if not args.approx_ldscores or not args.approx_check_chrom or os.path.exists(report):
+        return
+    logging.info('Checking the approximate LDscores of ' + outldscore + ' against exact ones on chr ' + str(args.approx_check_chrom))
+    approximation_error(plink_panel + str(args.approx_check_chrom), outldscore + '.' + str(args.approx_check_chrom) + '.annot.gz',
+                        report, work('list.txt'), 1, *approx_settings(args))
 
 def calculate_ldscores(args,outldscore,plink_panel,noun):
     for chrom in range(1,23):
-        if 'binary' in noun:
+        if ('binary' in noun or args.quantiles==0) and atom_ldscores(args,outldscore,chrom):
+            continue
+        if args.ld_matrix_store and ('binary' in noun or args.quantiles==0):
+            logging.debug('Computing LDscores from the LD matrix store for chr ' + str(chrom) )
+            calculate_ldscores_store(local_ld_matrix_store(args),chrom,
+                            annot_file=outldscore + '.' + str(chrom) + '.annot.gz',
+                            out_prefix=outldscore + "." + str(chrom))
+        elif args.approx_ldscores and ('binary' in noun or args.quantiles==0):
+            logging.debug('Computing approximate LDscores for chr ' + str(chrom) )
+            calculate_ldscores_approx(plink_panel + str(chrom),
+                            outldscore + '.' + str(chrom) + '.annot.gz',
+                            outldscore + "." + str(chrom),
+                            work('list.txt'), 1,
+                            *approx_settings(args))
+        elif 'binary' in noun:
             logging.debug('Running ldsc.py for chr ' + str(chrom) )
             subprocess.call(['/home/ldscore/ldsc-kt_exclude_files/ldsc.py',
                             '--l2',
@@ -267,7 +415,7 @@ def calculate_ldscores(args,outldscore,plink_panel,noun):
                             '--annot',outldscore + '.' + str(chrom) + '.annot.gz',
                             '--thin-annot',
                             '--out', outldscore + "." + str(chrom),
-                            '--print-snps',"/mnt/data/list.txt"])
+                            '--print-snps',work('list.txt')])
         elif ('continuous' in noun and args.quantiles==0):
             logging.debug('Running ldsc.py for chr ' + str(chrom) )
             subprocess.call(['/home/ldscore/ldsc-kt_exclude_files/ldsc.py',
@@ -277,7 +425,7 @@ def calculate_ldscores(args,outldscore,plink_panel,noun):
                             '--annot',outldscore + '.' + str(chrom) + '.annot.gz',
                             '--thin-annot',
                             '--out', outldscore + "." + str(chrom),
-                            '--print-snps',"/mnt/data/list.txt"])
+                            '--print-snps',work('list.txt')])
         elif (('continuous' in noun) and args.quantiles):
             try:
                 logging.debug('Running ldsc.py for chr ' + str(chrom) )
@@ -304,6 +452,22 @@ def calculate_ldscores(args,outldscore,plink_panel,noun):
 
 def calculate_ldscores_ldcts(args,outldscore,plink_panel,local_prefix):
     for chrom in range(1,23):
+        if atom_ldscores(args,outldscore + local_prefix,chrom):
+            continue
+        if args.ld_matrix_store:
+            logging.debug('Computing LDscores from the LD matrix store for chr ' + str(chrom) )
+            calculate_ldscores_store(local_ld_matrix_store(args),chrom,
+                            annot_file=outldscore + local_prefix + '.' + str(chrom) + '.annot.gz',
+                            out_prefix=outldscore + local_prefix + '.' + str(chrom))
+            continue
+        if args.approx_ldscores:
+            logging.debug('Computing approximate LDscores for chr ' + str(chrom) )
+            calculate_ldscores_approx(plink_panel + str(chrom),
+                            outldscore + local_prefix + '.' + str(chrom) + '.annot.gz',
+                            outldscore + local_prefix + '.' + str(chrom),
+                            work('list.txt'), 1,
+                            *approx_settings(args))
+            continue
         logging.debug('Running ldsc.py for chr ' + str(chrom) )
         subprocess.call(['/home/ldscore/ldsc-kt_exclude_files/ldsc.py',
                         '--l2',
@@ -312,7 +476,7 @@ def calculate_ldscores_ldcts(args,outldscore,plink_panel,local_prefix):
                         '--annot',outldscore + local_prefix + '.' + str(chrom) + '.annot.gz',
                         '--thin-annot',
                         '--out', outldscore + local_prefix + '.' + str(chrom),
-                        '--print-snps',"/mnt/data/list.txt"])    
+                        '--print-snps',work('list.txt')])    
 
 def commonprefix(m):
 
@@ -326,19 +490,71 @@ def commonprefix(m):
             return s1[:i]
     return s1
 
-def prepare_params_file(args,prefix,name_main_ldscore,params_file='/mnt/data/params.ldcts'):
+def export_ldscores(args,prefix,uploader):
+
+    """ Upload the LDscores of outld/, packed into a single archive with --ldscore-archive """
+
+    if args.ldscore_archive:
+        archive = work() + prefix + '.ldscores.h5'
+        pack_ldscores(work('outld/'), archive)
+        uploader.submit(archive, os.path.join(args.export_ldscore_path,""))
+    # Otherwise the chromosome files are uploaded by the uploader watching outld/
+    logging.info('LDscores copied to ' + str(args.export_ldscore_path))
+
+def register_annotations(args,scratch,outldscore,stage,spill_dir=None):
+
+    """ The annotation files of an LDscore set are only read to compute its LDscores, unless
+        the full report (--overlap-annot) or the LDscore archive still needs them """
+
+    chroms = [str(chrom) for chrom in range(1,23)]
+    scratch.register([outldscore + '.' + chrom + '.cont_bin.gz' for chrom in chroms], [stage])
+    if not (args.full_report or args.ldscore_archive):
+        scratch.register([outldscore + '.' + chrom + '.annot.gz' for chrom in chroms], [stage], spill_dir=spill_dir)
+
+def prepare_null_genesets(args,test_sets,plink_panel,scratch,params_file=None):
+
+    """ Sample matched null genesets for each (name, geneset file) and compute all their LDscores, one column per null geneset """
+
+    params_file = params_file or work('params.null')
+    subprocess.call(['mkdir',work('outnull')])
+    coords = resident_load('gene_coords', [work('GENENAME_gene_annot.txt')], pd.read_csv, work('GENENAME_gene_annot.txt'), delim_whitespace=True)
+    panel = load_panel(bfile_chr=plink_panel)
+    features = gene_features(coords, panel, gene_window_size(args), args.gene_col_name)
+    null_sets = []
+    with open(params_file, 'w') as file:
+        for name, geneset in test_sets:
+            if 'binary' not in type_of_file(geneset):
+                logging.info('Skipping null genesets for the continuous geneset ' + name)
+                continue
+            genes = pd.read_csv(geneset, delim_whitespace=True, header=None)[0].values
+            logging.info('Sampling ' + str(args.null_genesets) + ' matched null genesets for ' + name)
+            sets = sample_matched(genes, features, args.null_genesets, seed=args.null_seed)
+            write_null_annotations(sets, coords, panel, gene_window_size(args), work('outnull/') + name, args.gene_col_name)
+            scratch.register([work('outnull/') + name + '.*.annot.gz'], ['ldscores_null_' + name])
+            with scratch.stage('ldscores_null_' + name):
+                calculate_ldscores(args,outldscore=work('outnull/') + name,plink_panel=plink_panel,noun='binary')
+            file.write(name + '_null' + "\t" + work('outnull/') + name + '.' + "\n")
+            null_sets.append((name, sets))
+    write_null_gmt(null_sets, work() + args.prefix + '.null_genesets.gmt')
+
+def prepare_params_file(args,prefix,name_main_ldscore,params_file=None):
 
     """ Save the parameter file containing the name of the ldscores to use for partitioning heritability """
+    params_file = params_file or work('params.ldcts')
     with open(params_file, 'w') as file:
-        logging.debug('Save parameter file with prefix: ' + prefix + ' and ldscore: /mnt/data/outld/' + name_main_ldscore)
-        file.write(prefix + "\t" + '/mnt/data/outld/' + name_main_ldscore + '\n')
+        logging.debug('Save parameter file with prefix: ' + prefix + ' and ldscore: ' + work('outld/') + name_main_ldscore)
+        file.write(prefix + "\t" + work('outld/') + name_main_ldscore + '\n')
 
-def prepare_params_file_ldcts(args,main_file,params_file='/mnt/data/params.ldcts'):
+def prepare_params_file_ldcts(args,main_file,params_file=None,reused=None):
+    params_file = params_file or work('params.ldcts')
     with open(params_file,'w') as file:
-        with open('/mnt/data/file.ldcts','r') as ldcts_file:
+        with open(work('file.ldcts'),'r') as ldcts_file:
             for line in ldcts_file:
                 local_prefix = line.split()[0]
-                file.write(local_prefix + "\t" + '/mnt/data/outld/'+local_prefix+'.'+"\n")
+                file.write(local_prefix + "\t" + work('outld/')+local_prefix+'.'+"\n")
+        # LDscores of earlier --incremental runs
+        for local_prefix in reused or []:
+            file.write(local_prefix + "\t" + work('prevld/')+local_prefix+'.'+"\n")
 
 
 def write_report(report_name,sum_stat,main_panel,cond_panels,outfile):
@@ -404,10 +620,16 @@ def ldsc_h2_full(infile, ld_ref_panel, ld_w_panel, tg_f_panel,outfile):
 
 
 
-if __name__ == "__main__":
-
-    args = parse_args()
+def main(args):
+    global WORK_DIR, REFERENCE_DIR
+    WORK_DIR, REFERENCE_DIR = args.work_dir, args.reference_dir
 
+    if args.estimate:
+        estimate(ldsc_features(args), args.estimate_calibration)
+        sys.exit(0)
+    if not os.path.exists(WORK_DIR):
+        os.makedirs(WORK_DIR)
+    features = ldsc_features(args) if args.record_run else None
     
     if args.main_annot_bed:
         main_file = args.main_annot_bed
@@ -424,6 +646,12 @@ if __name__ == "__main__":
 
 
     prefix = args.prefix
+
+    # Exported LDscores are uploaded in the background as each chromosome set is completed
+    uploader = AsyncUploader()
+    if args.export_ldscore_path and not args.ldscore_archive:
+        uploader.watch(work('outld/'), os.path.join(args.export_ldscore_path,""))
+
     if not args.just_ldscores:
         ss_list = args.summary_stats_files.split(',')
     else:
@@ -437,37 +665,105 @@ if __name__ == "__main__":
     ld_cond_panel = "No Conditional Panel"
 
     # Set up the ennviroment
+    start_time = time.time()
+    track_memory(args.record_run)
+    scratch = ScratchManager(root=WORK_DIR, enabled=args.clean_scratch)
+    # Summary statistics already staged (e.g. by main_enrichment.py) are shared with other jobs and left alone
+    shared_sumstats = set(glob.glob(work('ss/*')))
     download_files(args,main_file,ss_list,prefix)
+    record_stage(args.record_run, 'staging', features, start_time)
+    start_time = time.time()
+
+    # Only the (geneset, trait) pairs without results in --out
+    plan = None
+    if args.incremental:
+        plan = plan_incremental(args, work('file.ldcts'), glob.glob(work('ss/*')), WORK_DIR)
+        if not plan['needed']:
+            logging.info('All genesets already have results in ' + args.out + ', nothing to do')
+            uploader.close()
+            sys.exit(0)
+        fetch_previous_results(args, plan, work('previous/'))
+    for sumstats in glob.glob(work('ss/*')):
+        if sumstats not in shared_sumstats:
+            scratch.register([sumstats], ['regression_' + os.path.basename(sumstats).replace('.sumstats.gz','')])
     
     # 1000 genome files
     name_plink = os.path.split(args.tkg_plink_folder)
-    name = glob.glob('/mnt/data/' + name_plink[-1] + "/*")
+    name = glob.glob(reference(name_plink[-1]) + "/*")
     plink_panel = commonprefix(name)
     logging.debug('plink_panel: ' + plink_panel)
+    # The store fixes the printed SNPs, the cM window and the panel when it is built
+    if args.ld_matrix_store:
+        try:
+            check_store(local_ld_matrix_store(args), work('list.txt'), 1, plink_panel)
+        except ValueError as e:
+            sys.exit(str(e) + ' - Interrupting')
+    # The genotypes are only read to compute LDscores; a reference folder shared with other jobs is left alone
+    if REFERENCE_DIR == WORK_DIR:
+        scratch.register([reference(name_plink[-1])] + ([local_ld_matrix_store(args)] if args.ld_matrix_store else []) +
+                         ([local_atom_basis(args)] if args.atom_basis else []), ['ldscores'])
+    if args.atom_basis:
+        mismatch = basis_mismatch(local_atom_basis(args), work('list.txt'), work('GENENAME_gene_annot.txt'), gene_window_size(args), 1, plink_panel)
+        if mismatch:
+            logging.warning('Not using --atom-basis: ' + mismatch)
+            args.atom_basis = None
+    spill_dir = args.export_ldscore_path if not args.ldscore_archive else None
 
     #Create annotations for main outcome (put each annotation in a different folder)
     #If it is an LDscore put it in a folder and get the name of the LDscore
     if (args.main_annot_rsids or args.main_annot_genes or args.main_annot_bed):
-        noun = type_of_file('/mnt/data/' + os.path.basename(main_file))
+        noun = type_of_file(work() + os.path.basename(main_file))
         logging.info('The type of file that will be used in the analysis: '+noun)
-        outldscore='/mnt/data/outld/' + prefix
+        outldscore=work('outld/') + prefix
         if args.main_annot_bed:
-            prepare_annotations_bed(args,bed_file='/mnt/data/' + os.path.basename(main_file),outldscore=outldscore, plink_panel=plink_panel)
+            prepare_annotations_bed(args,bed_file=work() + os.path.basename(main_file),outldscore=outldscore, plink_panel=plink_panel)
         elif args.main_annot_genes:
-            prepare_annotations_genes(args,gene_list='/mnt/data/' + os.path.basename(main_file),outldscore=outldscore, plink_panel=plink_panel)
+            prepare_annotations_genes(args,gene_list=work() + os.path.basename(main_file),outldscore=outldscore, plink_panel=plink_panel)
         elif args.main_annot_rsids:
-            prepare_annotations_rsids(args,gene_list='/mnt/data/' + os.path.basename(main_file),outldscore=outldscore, plink_panel=plink_panel)
-        calculate_ldscores(args,outldscore=outldscore,plink_panel=plink_panel,noun=noun)
+            prepare_annotations_rsids(args,gene_list=work() + os.path.basename(main_file),outldscore=outldscore, plink_panel=plink_panel)
+        register_annotations(args,scratch,outldscore,'ldscores_' + prefix,spill_dir)
+        with scratch.stage('ldscores_' + prefix):
+            calculate_ldscores(args,outldscore=outldscore,plink_panel=plink_panel,noun=noun)
+            if 'binary' in noun or args.quantiles==0:
+                check_approx_ldscores(args,outldscore,plink_panel)
         name_main_ldscore = prefix + '.'   
     elif (args.main_annot_ldscores):
-        temp_name_list =  [os.path.basename(x) for x in glob.glob('/mnt/data/outld/*')]
+        temp_name_list =  [os.path.basename(x) for x in glob.glob(work('outld/*'))]
         name_main_ldscore = commonprefix(temp_name_list)
     elif (args.main_annot_ldcts):
-        with open('/mnt/data/file.ldcts','r') as ldcts_file:
-            for line,geneset in zip(ldcts_file,os.listdir('/mnt/data/genesets/')):
+        ldcts_prefixes = []
+        with open(work('file.ldcts'),'r') as ldcts_file:
+            for line in ldcts_file:
                 local_prefix = line.split()[0]
-                prepare_annotations_genes_ldcts(args,gene_list='/mnt/data/genesets/' + geneset,outldscore='/mnt/data/outld/',plink_panel=plink_panel,local_prefix=local_prefix)
-                calculate_ldscores_ldcts(args,outldscore='/mnt/data/outld/',plink_panel=plink_panel,local_prefix=local_prefix)
+                geneset = os.path.basename(line.split()[1])
+                prepare_annotations_genes_ldcts(args,gene_list=work('genesets/') + geneset,outldscore=work('outld/'),plink_panel=plink_panel,local_prefix=local_prefix)
+                ldcts_prefixes.append(local_prefix)
+
+        # Genesets with the same SNP annotation share one set of LDscores
+        if args.dedup_genesets:
+            canonical = dedup_genesets(work('outld/'), ldcts_prefixes, report_file=work() + prefix + '.geneset_overlap.txt', threshold=args.jaccard_threshold)
+        else:
+            canonical = dict((x, x) for x in ldcts_prefixes)
+
+        for local_prefix in ldcts_prefixes:
+            register_annotations(args,scratch,work('outld/') + local_prefix,'ldscores_' + local_prefix,spill_dir)
+            if canonical[local_prefix] == local_prefix:
+                with scratch.stage('ldscores_' + local_prefix):
+                    calculate_ldscores_ldcts(args,outldscore=work('outld/'),plink_panel=plink_panel,local_prefix=local_prefix)
+                    check_approx_ldscores(args,work('outld/') + local_prefix,plink_panel)
+            else:
+                scratch.release('ldscores_' + local_prefix)
+                logging.info('Geneset ' + local_prefix + ' has the same annotation as ' + canonical[local_prefix] + ', reusing its LDscores')
+                link_ldscores(work('outld/'), alias=local_prefix, target=canonical[local_prefix])
+
+    # Matched null genesets for calibration, all LDscores computed in bulk
+    if args.null_genesets:
+        if args.main_annot_ldcts:
+            with open(work('file.ldcts'),'r') as ldcts_file:
+                test_sets = [(line.split()[0], work('genesets/') + os.path.basename(line.split()[1])) for line in ldcts_file if line.strip()]
+        else:
+            test_sets = [(prefix, work() + os.path.basename(main_file))]
+        prepare_null_genesets(args,test_sets,plink_panel,scratch)
 
 	    
     # If provided, prepare annotation for conditioning gene lists
@@ -480,45 +776,54 @@ if __name__ == "__main__":
             cond_files = args.condition_annot_rsids.split(',')
         for k in cond_files:
             k_name = os.path.basename(k)
-            noun = type_of_file('/mnt/data/' + k_name)
-            subprocess.call(['mkdir','/mnt/data/outcondld/' + k_name])
+            noun = type_of_file(work() + k_name)
+            subprocess.call(['mkdir',work('outcondld/') + k_name])
             if args.condition_annot_bed:
-                prepare_annotations_bed(args,bed_file='/mnt/data/' + k_name,outldscore='/mnt/data/outcondld/' + k_name + '/' + k_name, plink_panel=plink_panel)
+                prepare_annotations_bed(args,bed_file=work() + k_name,outldscore=work('outcondld/') + k_name + '/' + k_name, plink_panel=plink_panel)
             elif args.condition_annot_genes:
-                prepare_annotations_genes(args,gene_list='/mnt/data/' + k_name,outldscore='/mnt/data/outcondld/' + k_name + '/' + k_name, plink_panel=plink_panel)
+                prepare_annotations_genes(args,gene_list=work() + k_name,outldscore=work('outcondld/') + k_name + '/' + k_name, plink_panel=plink_panel)
             elif args.condition_annot_rsids:
-                prepare_annotations_rsids(args,gene_list='/mnt/data/' + k_name,outldscore='/mnt/data/outcondld/' + k_name + '/' + k_name, plink_panel=plink_panel)
-            calculate_ldscores(args,outldscore='/mnt/data/outcondld/' + k_name + '/' + k_name,plink_panel=plink_panel,noun=noun)   
+                prepare_annotations_rsids(args,gene_list=work() + k_name,outldscore=work('outcondld/') + k_name + '/' + k_name, plink_panel=plink_panel)
+            register_annotations(args,scratch,work('outcondld/') + k_name + '/' + k_name,'ldscores_' + k_name)
+            with scratch.stage('ldscores_' + k_name):
+                calculate_ldscores(args,outldscore=work('outcondld/') + k_name + '/' + k_name,plink_panel=plink_panel,noun=noun)   
     
+    record_stage(args.record_run, ldscores_stage(args), features, start_time)
+    scratch.release('ldscores')
+
+    # LDscores exported by earlier --incremental runs
+    if plan and plan['reuse']:
+        fetch_ldscores(args.export_ldscore_path, plan['reuse'], work('prevld/'))
+
     # Save parameter file
     if not (args.main_annot_ldcts or args.main_annot_ldscores_ldcts):
         prepare_params_file(args,prefix,name_main_ldscore)
     else:
-        prepare_params_file_ldcts(args,main_file)
+        prepare_params_file_ldcts(args,main_file,reused=plan and plan['reuse'])
 
     # Weight panel
     name_w = os.path.split(args.tkg_weights_folder)
-    name = glob.glob('/mnt/data/inld/' + name_w[-1] + "/*")
+    name = glob.glob(reference('inld/') + name_w[-1] + "/*")
     ld_w_panel = commonprefix(name)
     logging.debug('ld_w_panel: ' + ld_w_panel)
 
 
     # Frequency panel
     name_f = os.path.split(args.tkg_freq_folder)
-    name = glob.glob('/mnt/data/' + name_f[-1] + "/*")
+    name = glob.glob(reference(name_f[-1]) + "/*")
     tg_f_panel = commonprefix(name)
     logging.debug('tg_f_panel: ' + tg_f_panel)
 
     # LDscore baseline panel
     if not args.no_baseline:
         name_ldref = os.path.split(args.baseline_ldscores_folder)
-        name = glob.glob('/mnt/data/inld/' + name_ldref[-1] + "/*")
+        name = glob.glob(reference('inld/') + name_ldref[-1] + "/*")
         ld_ref_panel = commonprefix(name)
         logging.debug('ld_ref_panel: ' + ld_ref_panel)
 
     # LDscore conditional panels
     if args.condition_annot_ldscores:
-        name_ldcond = glob.glob('/mnt/data/cond_ldscores/*')
+        name_ldcond = glob.glob(work('cond_ldscores/*'))
         ld_cond_panels_t = []
         for folder in name_ldcond:
             ld_cond_panels_t.append(commonprefix(glob.glob(folder + '/*')))
@@ -526,7 +831,7 @@ if __name__ == "__main__":
 
     # LDscore conditional panels (created from files)
     if (args.condition_annot_rsids or args.condition_annot_genes or args.condition_annot_bed):
-        name_ldcond_file = glob.glob('/mnt/data/outcondld/*')
+        name_ldcond_file = glob.glob(work('outcondld/*'))
         ld_cond_panels_file_t = []
         for folder in name_ldcond_file:
             ld_cond_panels_file_t.append(commonprefix(glob.glob(folder + '/*')))
@@ -534,7 +839,12 @@ if __name__ == "__main__":
 
     # Summary statistics
     if not args.just_ldscores:
-        list_sumstats_file=glob.glob("/mnt/data/ss/*")
+        list_sumstats_file=glob.glob(work('ss/*'))
+        if plan:
+            for sumstats in list_sumstats_file:
+                if trait_name(sumstats) not in plan['run_traits']:
+                    scratch.release('regression_' + trait_name(sumstats))
+            list_sumstats_file = [x for x in list_sumstats_file if trait_name(x) in plan['run_traits']]
 
     # Panels for conditioning
     if not args.no_baseline:
@@ -552,49 +862,109 @@ if __name__ == "__main__":
         sys.exit("No baseline panel or conditional panel specified - Interrupting")
 
     logging.info('The following panel(s) will be used for conditioning: ' + ':'.join([ld_cond_panel]))
+    cond_panels_report = ld_cond_panel
+
+    # Join the conditioning panels once for all the regressions
+    if args.composite_panel and ',' in ld_cond_panel:
+        ld_cond_panel = composite_panel(ld_cond_panel.split(','), work('composite_panel/'), args.panel_cache)
+        cond_panels_report = cond_panels_report + ' (joined in ' + ld_cond_panel + ')'
     
     if args.just_ldscores:
-        logging.info('LDscores copied to ' + str(args.export_ldscore_path))
-        subprocess.call(['gsutil','-m','cp','-r','/mnt/data/outld/*',os.path.join(args.export_ldscore_path,"")])
-        # Writing report
+        export_ldscores(args,prefix,uploader)
     
 
     else:
         # Partitioning heritability
+        start_time = time.time()
         outfiles_list = []
+        if args.in_process_regression:
+            logging.info('Loading LDscore panels for the in-process regression')
+            try:
+                panels = load_regression_panels(ld_cond_panel, ld_w_panel, work('params.ldcts'))
+                if args.null_genesets:
+                    null_panels = dict(panels)
+                    null_panels['cts_names'], null_panels['cts'], null_panels['cts_M'] = read_cts_panels(work('params.null'), panels['ref_ld'].SNP.values, split_columns=True)
+            except ValueError as e:
+                sys.exit(str(e) + ' - Interrupting')
+            overlap, M_tot = None, None
+            if args.full_report:
+                # The annotation overlap only depends on the panels, it is computed once (or taken from the cache) for all traits
+                overlap, M_tot = overlap_provider(ld_cond_panel.split(','), work('params.ldcts'), tg_f_panel, args.panel_cache or work('overlap_cache'), work_dir=WORK_DIR)
         for sumstats in list_sumstats_file:
             phname = os.path.basename(sumstats).replace('.sumstats.gz','')
             logging.info('Running partition LDscores for ' + phname)
+            if args.in_process_regression:
+                outfile = work() + phname + '.' + prefix + '.ldsc'
+                full_report_prefix = work() + phname + '.' + prefix if args.full_report else None
+                if args.screen_p:
+                    results = h2_cts_screen(sumstats, panels, outfile, args.screen_p, args.screen_calibration, full_report_prefix=full_report_prefix, overlap=overlap, M_tot=M_tot)
+                else:
+                    results = h2_cts(sumstats, panels, outfile, full_report_prefix=full_report_prefix, overlap=overlap, M_tot=M_tot)
+                outfiles_list.append(outfile + '.cell_type_results.txt')
+                if args.null_genesets:
+                    null_results = h2_cts(sumstats, null_panels, outfile + '_null')
+                    null_calibration(results, null_results, outfile + '.null_calibration.results')
+                    outfiles_list.append(outfile + '.null_calibration.results')
+                if args.full_report:
+                    # With --screen-p only the genesets passing the screen have a full report
+                    outfiles_list += [x for x in [full_report_prefix + '.' + x + '.ldsc_full.results' for x in panels['cts_names']] if os.path.exists(x)]
              # If full report, then run  LDscore for each panel
-            if args.full_report:
-                with open('/mnt/data/params.ldcts','r') as f:
+            elif args.full_report:
+                with open(work('params.ldcts'),'r') as f:
                     for x in f:
                         x = x.strip().split("\t")
                         ld_cond_panel_full=ld_cond_panel+","+x[1]
                         ld_cond_panel_full=ld_cond_panel_full.replace(" ", "")
-                        outfile_full = '/mnt/data/' + phname + '.' + prefix + '.' + x[0] + '.ldsc_full'
+                        outfile_full = work() + phname + '.' + prefix + '.' + x[0] + '.ldsc_full'
                         ldsc_h2_full(infile=sumstats, ld_ref_panel=ld_cond_panel_full, ld_w_panel=ld_w_panel,tg_f_panel=tg_f_panel,outfile=outfile_full)
-                        outfiles_list.append('/mnt/data/' + phname + '.' + prefix + '.' + x[0] + '.ldsc_full.results')
+                        outfiles_list.append(work() + phname + '.' + prefix + '.' + x[0] + '.ldsc_full.results')
             else:
-                outfiles_list.append('/mnt/data/' + phname + '.' + prefix + '.ldsc.cell_type_results.txt')
-                outfile = '/mnt/data/' + phname + '.' + prefix + '.ldsc'
+                outfiles_list.append(work() + phname + '.' + prefix + '.ldsc.cell_type_results.txt')
+                outfile = work() + phname + '.' + prefix + '.ldsc'
                 if not args.exclude_file:
-                    ldsc_results = ldsc_h2(infile=sumstats, params_file='/mnt/data/params.ldcts',ld_ref_panel=ld_cond_panel, ld_w_panel=ld_w_panel,tg_f_panel=tg_f_panel,outfile=outfile)
+                    ldsc_results = ldsc_h2(infile=sumstats, params_file=work('params.ldcts'),ld_ref_panel=ld_cond_panel, ld_w_panel=ld_w_panel,tg_f_panel=tg_f_panel,outfile=outfile)
                 else:
-                    ldsc_results = ldsc_h2_exclude(infile=sumstats, params_file='/mnt/data/params.ldcts',ld_ref_panel=ld_cond_panel, ld_w_panel=ld_w_panel,tg_f_panel=tg_f_panel,outfile=outfile,exclude_file='/mnt/data/exclude.bed')
-
+                    ldsc_results = ldsc_h2_exclude(infile=sumstats, params_file=work('params.ldcts'),ld_ref_panel=ld_cond_panel, ld_w_panel=ld_w_panel,tg_f_panel=tg_f_panel,outfile=outfile,exclude_file=work('exclude.bed'))
+            if plan:
+                results_name = phname + '.' + prefix + '.ldsc.cell_type_results.txt'
+                merge_results(work() + results_name, work('previous/') + results_name, plan['done'][phname])
+            # Upload the results of this trait while the next one runs
+            uploader.submit(work() + phname + '.*ldsc*results*',os.path.join(args.out,""))
+            scratch.release('regression_' + phname)
+        record_stage(args.record_run, 'regression_in_process' if args.in_process_regression else 'regression', features, start_time)
 
 
         # Writing report
-        write_report(report_name='/mnt/data/' + prefix + '.report',sum_stat='\t'.join(ss_list),main_panel=main_file, cond_panels=ld_cond_panel, outfile='\t'.join(outfiles_list))
+        write_report(report_name=work() + prefix + '.report',sum_stat='\t'.join(ss_list),main_panel=main_file, cond_panels=cond_panels_report, outfile='\t'.join(outfiles_list))
 
         if args.export_ldscore_path:
-            logging.info('LDscores copied to ' + str(args.export_ldscore_path))
-            subprocess.call(['gsutil','-m','cp','-r','/mnt/data/outld/*',os.path.join(args.export_ldscore_path,"")])
+            export_ldscores(args,prefix,uploader)
     
     # Writing the results
-        logging.info('Results copied to ' + str(args.export_ldscore_path))
-        subprocess.call(['gsutil','cp','/mnt/data/*ldsc*results*',os.path.join(args.out,"")])
-        subprocess.call(['gsutil','cp','/mnt/data/' + prefix + '.report',os.path.join(args.out,"")])
+        logging.info('Results copied to ' + str(args.out))
+        uploader.submit(work('*ldsc*results*'),os.path.join(args.out,""))
+        uploader.submit(work() + prefix + '.report',os.path.join(args.out,""))
+        if args.null_genesets:
+            uploader.submit(work() + prefix + '.null_genesets.gmt',os.path.join(args.out,""))
+        if args.dedup_genesets:
+            uploader.submit(work() + prefix + '.geneset_overlap.txt',os.path.join(args.out,""))
+
+    if args.approx_ldscores:
+        uploader.submit(work() + prefix + '.approx_ldscore_error.txt',os.path.join(args.out or args.export_ldscore_path,""))
+    scratch.summary()
+
+    # Wait for the background uploads and check they all arrived
+    if uploader.close():
+        sys.exit("Some result files could not be uploaded - Interrupting")
+
+    # The manifest is only updated once all the results it lists are in --out
+    if plan:
+        write_manifest(updated_manifest(args, plan), work() + manifest_name(prefix))
+        if not copy_file(work() + manifest_name(prefix), os.path.join(args.out, manifest_name(prefix))):
+            sys.exit("The manifest could not be copied to " + args.out + " - Interrupting")
 
     logging.info('FINITO!')
+
+
+if __name__ == "__main__":
+    main(parse_args())
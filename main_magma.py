@@ -12,27 +12,64 @@ import logging
 import os
 import random
 import string
+import multiprocessing
+import time
+from joblib import Parallel, delayed
+from result_cache import file_checksum, cache_key, cache_fetch, cache_store
+from magma_gsa import run_gsa
+from staging import stage_file, work_dir, reference_dir, reference_lock
+from gene_windows import read_gene_loc, window_index, write_genes_annot
+from ld_matrix_store import read_bim
+from async_upload import AsyncUploader
+from scratch import ScratchManager
+from resident import resident_load
+from resource_estimator import magma_features, estimate, record_stage, track_memory
 from pybedtools import BedTool
 from argparse import Namespace
 
 
-def parse_args():
+# Working folder of the job (--work-dir), set by main
+WORK_DIR = work_dir()
+
+
+def work(path=''):
+    return os.path.join(WORK_DIR, path)
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--main-annot-genes',  help = 'Path to file with a list of genes to run as your annotation.This can also have an additional column for continuous annotations.')
+    parser.add_argument('--main-annot-ldcts', help = 'Path to file that has a name "\t" google bucket path to a geneset, one per line, to test many genesets in one MAGMA run.')
+    parser.add_argument('--main-annot-gmt', help = 'Path to a GMT file (name "\t" description "\t" gene1 "\t" gene2 ...), one geneset per line, to test many genesets in one MAGMA run.')
     parser.add_argument('--condition-annot-genes', help = 'Path to file with a list of genes to run as a conditional annotation. You can specify multiple comma-separated files. These files have two format: 1) simple gene list 2) genelist + annotation columns. In the latter all the annotation columns will be used for conditional analysis.')
     parser.add_argument('--summary-stats-files', required=True,  help = 'File(s) (already processed with munge_sumstats.py) where to apply partition LDscore, files should end with .sumstats.gz. If multiple files are used, need a comma-separated list.')
     parser.add_argument('--prefix', required=True, help = 'Prefix for main-annot file.')
     parser.add_argument('--out', required=True, help = 'Path to save the results')
     parser.add_argument('--windowsize', type=int, default=10, help = 'size (in KB) of the window around the gene, default=10')
+    parser.add_argument('--window-up', type=float, help = 'Size (in KB) of the window upstream of the gene (strand aware), default is --windowsize')
+    parser.add_argument('--window-down', type=float, help = 'Size (in KB) of the window downstream of the gene (strand aware), default is --windowsize')
+    parser.add_argument('--magma-annotate', action='store_true', default=False, help = 'Assign SNPs to genes with magma --annotate instead of the built-in window index (gene_windows.py)')
+    parser.add_argument('--magma-ref-dir', default=reference_dir(), help = 'Local folder where the unzipped 1000 genomes MAGMA reference panel and gene locations are kept, can be shared by the jobs of a machine. If they are already there they are not downloaded again. Default is $SC_REFERENCE_DIR or the working folder')
+    parser.add_argument('--magma-cache', help = 'Local folder or google bucket path used to cache the MAGMA SNP-to-gene annotation and the per-sumstat gene analysis results (genes.raw/genes.out) across jobs')
+    parser.add_argument('--native-gsa', action='store_true', default=False, help = 'Run the competitive gene-set analysis in Python (batched GLS over the genes.raw gene Z-scores and correlations) instead of calling MAGMA --set-annot. Output is written in the .gsa.out layout.')
+    parser.add_argument('--n-jobs', type=int, default=multiprocessing.cpu_count(), help = 'Number of MAGMA gene analysis batches (chromosomes x summary statistics) to run concurrently, default is the number of cores')
+    parser.add_argument('--work-dir', default=work_dir(), help = 'Working folder of the job, where inputs are staged and intermediate and result files written. Concurrent jobs on one machine need one each. Default is $SC_WORK_DIR or /mnt/data')
+    parser.add_argument('--clean-scratch', action='store_true', default=False, help = 'Delete intermediate files from the working folder as soon as the last stage reading them is done: summary statistics and extracted P-values after the gene analysis, chromosome batches after their merge, gene results after the gene-set analysis')
+    parser.add_argument('--scratch-budget', type=float, help = 'Disk budget (GB) of the working folder: gene analysis batches wait to start while it is exceeded and other batches are running')
+    parser.add_argument('--estimate', action='store_true', default=False, help = 'Do not run anything: predict the time, memory and disk of each stage from the input sizes and print recommended dsub resource flags')
+    parser.add_argument('--estimate-calibration', help = 'Calibration file for --estimate fitted from recorded runs (resource_estimator.py fit)')
+    parser.add_argument('--record-run', help = 'Append the measured time and peak memory of each stage to this file, to calibrate --estimate')
     parser.add_argument('--verbose', help="increase output verbosity",action="store_true")
     parser.add_argument('--quantiles', type=int, default=5,required=False, help='If using a continuous annotation,the number of quantiles to split it into for regression.')
     parser.add_argument('--cont-breaks',type=str,required=False,help='Specific boundary points to split your continuous annotation on, comma separated list e.g. 0.1,0.4,0.5,0.6. ATTENTION: if you use negative values add a space in the beginning e.g. <space>-0.1,-0.4,0.5,0.6')
 
 
-    args = parser.parse_args()
-    if not (args.main_annot_genes or args.summary_stats_files or args.prefix or args.out):
-        parser.error("You have to specify --main_annot_genes and --summary-stats-files and --prefix and --out")
+    args = parser.parse_args(argv)
+    if not args.magma_ref_dir:
+        args.magma_ref_dir = args.work_dir
+    if not (args.main_annot_genes or args.main_annot_ldcts or args.main_annot_gmt):
+        parser.error("You have to specify one of --main-annot-genes, --main-annot-ldcts or --main-annot-gmt")
 
     if (args.cont_breaks):
         args.quantiles = None
@@ -68,53 +105,68 @@ def commonprefix(m):
     return s1
 
 
-def download_magma(windowsize):
+def download_magma(args):
 
     """ Download MAGMA files and do initial gene assignment """
 
-    logging.info('Download 1000 genomes reference panel')
-    subprocess.call(['gsutil','cp','gs://singlecellldscore/g1000_eur.zip','/mnt/data/'])
-    subprocess.call(['unzip','-o','/mnt/data/g1000_eur.zip','-d','/mnt/data/'])
-    subprocess.call(['gsutil','cp','gs://singlecellldscore/NCBI37.3.gene.name.loc','/mnt/data/'])
-    logging.info('The Window Size is: ' + str(windowsize))
-    if windowsize > 1000:
+    ref_dir = args.magma_ref_dir
+    # Jobs sharing the reference folder download and unzip it once
+    with reference_lock(ref_dir):
+        if not all(os.path.exists(os.path.join(ref_dir,'g1000_eur' + x)) for x in ['.bed','.bim','.fam']):
+            logging.info('Download 1000 genomes reference panel')
+            subprocess.call(['gsutil','cp','gs://singlecellldscore/g1000_eur.zip',ref_dir])
+            subprocess.call(['unzip','-o',os.path.join(ref_dir,'g1000_eur.zip'),'-d',ref_dir])
+            os.remove(os.path.join(ref_dir,'g1000_eur.zip'))
+        else:
+            logging.info('Using 1000 genomes reference panel in ' + ref_dir)
+        if not os.path.exists(os.path.join(ref_dir,'NCBI37.3.gene.name.loc')):
+            subprocess.call(['gsutil','cp','gs://singlecellldscore/NCBI37.3.gene.name.loc',ref_dir])
+
+    window_up = args.windowsize if args.window_up is None else args.window_up
+    window_down = args.windowsize if args.window_down is None else args.window_down
+    logging.info('The Window Size is: ' + str(window_up) + ' KB upstream, ' + str(window_down) + ' KB downstream')
+    if max(window_up, window_down) > 1000:
         logging.info("Are you sure you specified the window size in KB?") 
-    subprocess.call(['/home/magma',
-                                '--annotate','window=',str(windowsize),
-                                '--snp-loc','/mnt/data/g1000_eur.bim',
-                                '--gene-loc','/mnt/data/NCBI37.3.gene.name.loc',
-                                '--out','/mnt/data/magma_annotation_1000g_h37'])
-        
 
+    # The annotation only depends on the window and on the SNP and gene locations
+    key = cache_key(window_up, window_down, 'magma' if args.magma_annotate else 'native',
+                    file_checksum(os.path.join(ref_dir,'g1000_eur.bim')),
+                    file_checksum(os.path.join(ref_dir,'NCBI37.3.gene.name.loc')))
+    if cache_fetch(args.magma_cache, 'magma_annotation', key, ['magma_annotation_1000g_h37.genes.annot'], work()):
+        return key
+    if args.magma_annotate:
+        subprocess.call(['/home/magma',
+                                '--annotate','window='+str(window_up)+','+str(window_down),
+                                '--snp-loc',os.path.join(ref_dir,'g1000_eur.bim'),
+                                '--gene-loc',os.path.join(ref_dir,'NCBI37.3.gene.name.loc'),
+                                '--out',work('magma_annotation_1000g_h37')])
+    else:
+        window = (int(window_up * 1000), int(window_down * 1000))
+        gene_loc = os.path.join(ref_dir,'NCBI37.3.gene.name.loc')
+        index = window_index(resident_load('gene_loc', [gene_loc], read_gene_loc, gene_loc), read_bim(os.path.join(ref_dir,'g1000_eur')), window)
+        write_genes_annot(index, work('magma_annotation_1000g_h37.genes.annot'), window)
+    cache_store(args.magma_cache, 'magma_annotation', key, [work('magma_annotation_1000g_h37.genes.annot')])
+    return key
+        
 
-def prepare_magma_binary(args):
-
-    """Download and prepare geneset file for MAGMA analysis for binary genelist"""
 
-    with open("/mnt/data/"+ os.path.basename(args.main_annot_genes)) as input:
-        content = input.read().splitlines() 
-    content.insert(0,args.prefix)
-    outlist = (" ".join(map(str, content)))
-    with open('/mnt/data/gene_list_for_magma', 'w') as output:
-        output.write(outlist)
-    logging.info('Wrote geneset for MAGMA: /mnt/data/gene_list_for_magma')
+def magma_sets_binary(gene_file,name):
 
-    download_magma(args.windowsize)
+    """ MAGMA gene-set for a binary genelist """
 
+    with open(gene_file) as input:
+        content = input.read().splitlines()
+    return [(name, [x.strip() for x in content if x.strip()])]
 
 
-def prepare_magma_continuous(args):
+def magma_sets_continuous(args,gene_file,name):
 
-    """Download and prepare geneset file for MAGMA analysis for continuous genelist"""
+    """ MAGMA gene-sets, one per bin, for a continuous genelist """
 
-    df = pd.read_csv("/mnt/data/"+ os.path.basename(args.main_annot_genes), sep="\t", header=None)
+    df = pd.read_csv(gene_file, sep="\t", header=None)
 
     if args.quantiles:
         df["anno_break"] = pd.qcut(df[1], args.quantiles)
-        temp_breaks = pd.unique(df["anno_break"])
-        n_breaks = len(temp_breaks)
-        labs = [str(x).replace(", ","_").replace("(","").replace("]","").replace("[","") for x in temp_breaks]
-        logging.info('MAGMA: using the following breaks: '+ "; ".join([str(i) for i in labs]))
 
     elif args.cont_breaks:
         max_vec = np.max(df[1])
@@ -139,51 +191,51 @@ def prepare_magma_continuous(args):
         name_breaks[0] = str(min_vec)
         name_breaks[-1] = str(max_vec)
         name_breaks = [str(x) for x in name_breaks]
-        labs = [name_breaks[i]+'_'+name_breaks[i+1] for i in xrange(n_breaks-1)]
-        labs = labs[::-1]
-        logging.info('MAGMA: using the following breaks: '+ "; ".join([str(i) for i in labs]))
+        labs = [name_breaks[i]+'_'+name_breaks[i+1] for i in range(n_breaks-1)]
 
         df["anno_break"] = pd.cut(df[1], bins=cut_breaks, labels=labs)
 
+    sets = []
+    for anno in pd.unique(df["anno_break"].dropna()):
+        lab = str(anno).replace(", ","_").replace("(","").replace("]","").replace("[","")
+        sets.append((name + "_" + lab, [str(x) for x in df.loc[df["anno_break"] == anno, 0]]))
+    logging.info('MAGMA: using the following breaks: '+ "; ".join([x[0] for x in sets]))
+    return sets
 
-    for ind,anno in enumerate(pd.unique(df["anno_break"])):
-        dfout=df.loc[df["anno_break"] == anno]
-        outlist = (" ".join(map(str, dfout[0])))
-        outlist = args.prefix + "_" + labs[ind] + " " + outlist
-        with open('/mnt/data/gene_list_for_magma_'+str(ind), 'w') as output:
-            output.write(outlist)
-        logging.info('Wrote geneset for MAGMA: /mnt/data/gene_list_for_magma_'+str(ind))
 
-    download_magma(args.windowsize)
+def magma_sets_gmt(gmt_file):
 
+    """ MAGMA gene-sets from a GMT file """
 
-def process_conditional_genesets(cond_file,prefix_cond):
+    sets = []
+    with open(gmt_file) as input:
+        for line in input:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) > 2:
+                sets.append((fields[0], [x for x in fields[2:] if x]))
+    return sets
 
-    """ Download, process and save conditional genesets """
 
-    with open("/mnt/data/conditional_genesets/"+ os.path.basename(cond_file)) as input:
-        content = input.read().splitlines()
-    content.insert(0,prefix_cond)
-    outlist = (" ".join(map(str, content)))
-    with open('/mnt/data/conditional_gene_list_for_magma_'+prefix_cond, 'w') as output:
-        output.write(outlist)
+def magma_sets_file(args,gene_file,name):
+    if type_of_file(gene_file) == 'binary':
+        return magma_sets_binary(gene_file,name)
+    return magma_sets_continuous(args,gene_file,name)
 
 
-def combine_conditional_genesets():
+def write_magma_sets(sets,set_file=None):
 
-    """Prepare conditional geneset file for MAGMA analysis"""
+    """ Write all gene-sets (main, bins and conditional) into a single --set-annot file """
 
-    all_gene_lists = glob.glob("/mnt/data/gene_list_for_magma*")
-    all_cond_gene_lists = glob.glob("/mnt/data/conditional_gene_list_for_magma_*")
-    to_cat = ' '.join(all_cond_gene_lists)
-    for file in all_gene_lists:
-        os.system('awk 1 ' + file + ' ' + to_cat + ' > ' +  os.path.dirname(file)+'/cond_'+ os.path.basename(file))
+    set_file = set_file or work('gene_sets_for_magma')
+    with open(set_file, 'w') as output:
+        for name, genes in sets:
+            output.write(name + " " + " ".join(genes) + "\n")
+    logging.info('Wrote ' + str(len(sets)) + ' geneset(s) for MAGMA: ' + set_file)
 
-    
 
-def run_magma(args,sumstat,phname,prefix_cond_string_dicot,prefix_cond_string_cont,ncol):
+def extract_sumstats_for_magma(sumstat,phname):
 
-    """ Run MAGMA analysis for each sumistat and given the geneset """
+    """ Write the SNP, P, N columns MAGMA needs from a munged summary statistic """
 
     df = pd.read_csv(sumstat, compression='gzip', header=0, delim_whitespace=True)
     if 'Z' in list(df.columns.values) and 'P' not in list(df.columns.values):
@@ -193,142 +245,194 @@ def run_magma(args,sumstat,phname,prefix_cond_string_dicot,prefix_cond_string_co
     df = df.dropna(axis=0, how='any')
     df["N"] = df['N'].astype(int)
     dfout = df[['SNP', 'P', 'N']]
-    dfout.to_csv('/mnt/data/tmp/extracted_for_magma_'+phname,index=False,sep='\t')
-    subprocess.call(['/home/magma',
-                            '--bfile','/mnt/data/g1000_eur',
-                            '--pval','/mnt/data/tmp/extracted_for_magma_' + phname,
-                            'ncol=N',
-                            '--gene-annot','/mnt/data/magma_annotation_1000g_h37.genes.annot',
-                            '--out','/mnt/data/tmp/genes_for_magma_'+ phname])
-
-    n_magma_genefiles=len(glob.glob('/mnt/data/gene_list_for_magma*'))
-
-    if n_magma_genefiles==1:
-
-        if args.condition_annot_genes and len(prefix_cond_string_dicot)>0 and len(prefix_cond_string_cont)>0:
-            subprocess.call(['/home/magma',
-                                '--gene-results','/mnt/data/tmp/genes_for_magma_'+ phname + '.genes.raw',
-                                '--set-annot','/mnt/data/cond_gene_list_for_magma',
-                                'condition='+ prefix_cond_string_dicot,
-                                '--gene-covar',prefix_cond_string_cont,
-                                'condition=' + ncol_out,
-                                '--out','/mnt/data/magma_results_0_' + phname])
-
-        elif args.condition_annot_genes and len(prefix_cond_string_dicot)>0:
-            subprocess.call(['/home/magma',
-                                '--gene-results','/mnt/data/tmp/genes_for_magma_'+ phname + '.genes.raw',
-                                '--set-annot','/mnt/data/cond_gene_list_for_magma',
-                                'condition='+ prefix_cond_string_dicot,
-                                '--out','/mnt/data/magma_results_0_' + phname])
-
-        elif args.condition_annot_genes and len(prefix_cond_string_cont)>0:
-            subprocess.call(['/home/magma',
-                                '--gene-results','/mnt/data/tmp/genes_for_magma_'+ phname + '.genes.raw',
-                                '--set-annot','/mnt/data/gene_list_for_magma',
-                                '--gene-covar',prefix_cond_string_cont,
-                                'condition=' + ncol_out,
-                                '--out','/mnt/data/magma_results_0_' + phname])
-        else:
-            subprocess.call(['/home/magma',
-                                '--gene-results','/mnt/data/tmp/genes_for_magma_'+ phname + '.genes.raw',
-                                '--set-annot','/mnt/data/gene_list_for_magma',
-                                '--out','/mnt/data/magma_results_0_' + phname])
-
-    elif n_magma_genefiles > 1:
-
-        for quantvalue in range(n_magma_genefiles):
-
-            if args.condition_annot_genes and len(prefix_cond_string_dicot)>0 and len(prefix_cond_string_cont)>0:
-                subprocess.call(['/home/magma',
-                                '--gene-results','/mnt/data/tmp/genes_for_magma_'+ phname + '.genes.raw',
-                                '--set-annot','/mnt/data/cond_gene_list_for_magma_' + str(quantvalue),
-                                'condition='+ prefix_cond_string_dicot,
-                                '--gene-covar',prefix_cond_string_cont,
-                                'condition=' + ncol_out,
-                                '--out','/mnt/data/magma_results_' + str(quantvalue) + "_" + phname])
-
-            elif args.condition_annot_genes and len(prefix_cond_string_dicot)>0:
-                subprocess.call(['/home/magma',
-                                '--gene-results','/mnt/data/tmp/genes_for_magma_'+ phname + '.genes.raw',
-                                '--set-annot','/mnt/data/cond_gene_list_for_magma_' + str(quantvalue),
-                                'condition='+ prefix_cond_string_dicot,
-                                '--out','/mnt/data/magma_results_' + str(quantvalue) + "_" + phname])
-
-            elif args.condition_annot_genes and len(prefix_cond_string_cont)>0:
-                subprocess.call(['/home/magma',
-                                '--gene-results','/mnt/data/tmp/genes_for_magma_'+ phname + '.genes.raw',
-                                '--set-annot','/mnt/data/gene_list_for_magma_' + str(quantvalue),
-                                '--gene-covar',prefix_cond_string_cont,
-                                'condition=' + ncol_out,
-                                '--out','/mnt/data/magma_results_' + str(quantvalue) + "_" + phname])
-            else:
-                subprocess.call(['/home/magma',
-                                '--gene-results','/mnt/data/tmp/genes_for_magma_'+ phname + '.genes.raw',
-                                '--set-annot','/mnt/data/gene_list_for_magma_' + str(quantvalue),
-                                '--out','/mnt/data/magma_results_' + str(quantvalue) + "_" + phname])
-
-    logging.info('MAGMA file generated: '+ '/mnt/data/magma_results_' + phname)
+    dfout.to_csv(work('tmp/extracted_for_magma_')+phname,index=False,sep='\t')
 
 
+def magma_chromosomes(bim_file):
 
-if __name__ == "__main__":
+    """ Chromosomes present in the MAGMA reference panel """
 
-    args = parse_args()
-    main_file = args.main_annot_genes
+    chroms = pd.read_csv(bim_file, delim_whitespace=True, header=None, usecols=[0])[0]
+    return [str(x) for x in pd.unique(chroms)]
 
-    # Download main annotations
-    logging.info('Downloading main annotation file(s):' + main_file)
-    subprocess.call(['gsutil','cp',main_file,'/mnt/data/'])
 
-    noun = type_of_file('/mnt/data/' + os.path.basename(main_file))
-    logging.info('The type of file that will be used in the analysis: '+noun)
+def gene_analysis_batch(phname,chrom,ref_dir,scratch):
 
+    """ MAGMA gene analysis for one summary statistic and one chromosome """
 
-    # Download summary stats
+    with scratch.stage('gene_analysis_' + phname + '_' + chrom):
+        return subprocess.call(['/home/magma',
+                                '--bfile',os.path.join(ref_dir,'g1000_eur'),
+                                '--pval',work('tmp/extracted_for_magma_') + phname,
+                                'ncol=N',
+                                '--gene-annot',work('magma_annotation_1000g_h37.genes.annot'),
+                                '--batch',chrom,'chr',
+                                '--out',work('tmp/genes_for_magma_')+ phname])
+
+
+def reference_key(ref_dir):
+
+    """ Identity of the MAGMA reference panel used for the gene analysis """
+
+    bfile = os.path.join(ref_dir,'g1000_eur')
+    return cache_key(file_checksum(bfile + '.bim'), file_checksum(bfile + '.fam'), os.path.getsize(bfile + '.bed'))
+
+
+def run_gene_analysis(sumstats_files,n_jobs,ref_dir,annot_key,magma_cache=None,scratch=None):
+
+    """ Run the MAGMA gene analysis of all summary statistics in chromosome batches across the available cores, then merge the batches.
+        Gene-level results only depend on the sumstat, the reference and the gene annotation, so they are looked up in the cache first """
+
+    ref_key = reference_key(ref_dir)
+    gene_result_names = ['genes.raw','genes.out']
+    todo = []
+    keys = {}
+    for sumstat in sumstats_files:
+        phname = os.path.basename(sumstat).replace('.sumstats.gz','')
+        keys[phname] = cache_key(file_checksum(sumstat), annot_key, ref_key)
+        local_names = ['genes_for_magma_' + phname + '.' + x for x in gene_result_names]
+        if cache_fetch(magma_cache, 'magma_gene_results', keys[phname], gene_result_names, work('tmp/'), local_names):
+            logging.info('Reusing cached MAGMA gene analysis for ' + phname)
+        else:
+            todo.append((sumstat, phname))
+    if not todo:
+        return
+
+    scratch = scratch or ScratchManager(enabled=False)
+    phnames = [x[1] for x in todo]
+    Parallel(n_jobs=n_jobs, backend='threading')(delayed(extract_sumstats_for_magma)(x,y) for x,y in todo)
+
+    chroms = magma_chromosomes(os.path.join(ref_dir,'g1000_eur.bim'))
+    # The extracted P-values of a trait are kept until its last chromosome batch is done
+    for phname in phnames:
+        scratch.register([work('tmp/extracted_for_magma_') + phname], ['gene_analysis_' + phname + '_' + chrom for chrom in chroms])
+    logging.info('Running MAGMA gene analysis in ' + str(len(chroms)*len(phnames)) + ' batches on ' + str(n_jobs) + ' cores')
+    status = Parallel(n_jobs=n_jobs, backend='threading')(delayed(gene_analysis_batch)(phname,chrom,ref_dir,scratch) for phname in phnames for chrom in chroms)
+    if any(status):
+        raise RuntimeError('MAGMA gene analysis failed for ' + str(sum(1 for x in status if x)) + ' batch(es)')
+
+    for phname in phnames:
+        status = subprocess.call(['/home/magma',
+                            '--merge',work('tmp/genes_for_magma_')+ phname,
+                            '--out',work('tmp/genes_for_magma_')+ phname])
+        # The batches are kept and nothing is cached if the merge failed
+        if status:
+            raise RuntimeError('MAGMA gene analysis merge failed for ' + phname + ' with status ' + str(status))
+        logging.info('MAGMA gene analysis merged: ' + work('tmp/genes_for_magma_') + phname + '.genes.raw')
+        scratch.remove([work('tmp/genes_for_magma_') + phname + '.batch*'])
+        cache_store(magma_cache, 'magma_gene_results', keys[phname],
+                    [work('tmp/genes_for_magma_') + phname + '.' + x for x in gene_result_names], gene_result_names)
+
+
+def run_magma(args,phname,prefix_cond_string_dicot,prefix_cond_string_cont,ncol_out,set_file=None):
+
+    """ Run MAGMA gene-set analysis of all genesets at once for one sumstat """
+
+    set_file = set_file or work('gene_sets_for_magma')
+    if args.native_gsa:
+        run_gsa(work('tmp/genes_for_magma_')+ phname + '.genes.raw', set_file, work('magma_results_') + phname,
+                condition=prefix_cond_string_dicot or None,
+                gene_covar_file=prefix_cond_string_cont or None,
+                covar_cols=ncol_out)
+        return
+
+    cmd = ['/home/magma',
+           '--gene-results',work('tmp/genes_for_magma_')+ phname + '.genes.raw',
+           '--set-annot',set_file]
+    if len(prefix_cond_string_dicot)>0:
+        cmd += ['condition='+ prefix_cond_string_dicot]
+    if len(prefix_cond_string_cont)>0:
+        cmd += ['--gene-covar',prefix_cond_string_cont,
+                'condition=' + ncol_out]
+    cmd += ['--out',work('magma_results_') + phname]
+    subprocess.call(cmd)
+
+    logging.info('MAGMA file generated: '+ work('magma_results_') + phname + '.gsa.out')
+
+
+
+def main(args):
+    global WORK_DIR
+    WORK_DIR = args.work_dir
+
+    if args.estimate:
+        estimate(magma_features(args), args.estimate_calibration)
+        sys.exit(0)
+    if not os.path.exists(WORK_DIR):
+        os.makedirs(WORK_DIR)
+    features = magma_features(args) if args.record_run else None
+    start_time = time.time()
+    track_memory(args.record_run)
+    scratch = ScratchManager(root=WORK_DIR, budget_gb=args.scratch_budget, enabled=args.clean_scratch)
     prefix = args.prefix
+    subprocess.call(['mkdir',work('tmp')])
+    subprocess.call(['mkdir',work('ss')])
+    subprocess.call(['mkdir',work('genesets')])
+
+    # Download main annotations and turn them into MAGMA gene-sets
+    sets = []
+    if args.main_annot_genes:
+        main_file = args.main_annot_genes
+        logging.info('Downloading main annotation file(s):' + main_file)
+        stage_file(main_file,work())
+        noun = type_of_file(work() + os.path.basename(main_file))
+        logging.info('The type of file that will be used in the analysis: '+noun)
+        sets += magma_sets_file(args,work() + os.path.basename(main_file),prefix)
+    if args.main_annot_ldcts:
+        logging.info('Downloading main annotation files from list of files provided.')
+        stage_file(args.main_annot_ldcts,work(),'file.ldcts')
+        with open(work('file.ldcts'),'r') as ldcts_file:
+            for line in ldcts_file:
+                if not line.strip():
+                    continue
+                local_prefix, path = line.split()[0], line.split()[1]
+                stage_file(path,work('genesets/'))
+                sets += magma_sets_file(args,work('genesets/') + os.path.basename(path),local_prefix)
+    if args.main_annot_gmt:
+        logging.info('Downloading main annotation GMT file:' + args.main_annot_gmt)
+        subprocess.call(['gsutil','cp',args.main_annot_gmt,work('file.gmt')])
+        sets += magma_sets_gmt(work('file.gmt'))
+
+
+    # Download summary stats
     ss_list = args.summary_stats_files.split(',')
     logging.info('The summary statistic(s) to download: ' + ':'.join(ss_list))
 
     logging.info('Downloading summary statistic(s):' + ':'.join(ss_list))
-    subprocess.call(['mkdir','/mnt/data/tmp'])
-    subprocess.call(['mkdir','/mnt/data/ss'])
+    # Summary statistics already staged (e.g. by main_enrichment.py) are shared with other jobs and left alone
+    shared_sumstats = set(glob.glob(work('ss/*')))
     for ss in ss_list:
-        subprocess.call(['gsutil','cp',ss,'/mnt/data/ss/'])
+        stage_file(ss,work('ss/'))
+    scratch.register([x for x in glob.glob(work('ss/*')) if x not in shared_sumstats], ['gene_analysis'])
 
     # Summary statistics
-    list_sumstats_file=glob.glob("/mnt/data/ss/*")
-
-    #Prepare genes from main-annot-genes
-    if noun=='binary':
-        prepare_magma_binary(args)
-    elif noun=='continuous':
-        prepare_magma_continuous(args)
+    list_sumstats_file=glob.glob(work('ss/*'))
 
 
     # Download and prepare additional geneset for conditioning (if they are specified)
-    # And attached them to the output from prepare_magma_*
+    # Binary ones are added to the same set file and conditioned on for all tested genesets
     prefix_cond_string_dicot=[]
     prefix_cond_string_cont=[]
     ncol_out=None
     if args.condition_annot_genes:
-        subprocess.call(['mkdir','/mnt/data/conditional_genesets'])
+        subprocess.call(['mkdir',work('conditional_genesets')])
         cond_files = args.condition_annot_genes.split(',')
         counter = 0
         for k in cond_files:
             # Download
-            subprocess.call(['gsutil','cp',k,'/mnt/data/conditional_genesets/'])
+            subprocess.call(['gsutil','cp',k,work('conditional_genesets/')])
             # Get prefix
             prefix_cond = os.path.splitext(os.path.basename(k))[0]
             # Get if file is continuous or not
-            noun_cond = type_of_file('/mnt/data/conditional_genesets/' + os.path.basename(k))
+            local_file_name=work('conditional_genesets/') + os.path.basename(k)
+            noun_cond = type_of_file(local_file_name)
             if noun_cond == 'binary':
-                process_conditional_genesets(k,prefix_cond)
+                sets += magma_sets_binary(local_file_name,prefix_cond)
                 prefix_cond_string_dicot.append(prefix_cond)
             if noun_cond == 'continuous':
                 counter = counter + 1
                 if counter > 1:
                     raise ValueError("No more than 1 continous conditional annotation is allowed")    
-                local_file_name='/mnt/data/conditional_genesets/' + os.path.basename(k)
                 prefix_cond_string_cont=local_file_name
                 ncol=pd.read_csv(local_file_name,delim_whitespace=True,header=None).shape[1]
                 ncol_out=','.join([str(x+1) for x in range(ncol-1)])
@@ -337,17 +441,35 @@ if __name__ == "__main__":
         if prefix_cond_string_dicot:
             prefix_cond_string_dicot = ','.join(prefix_cond_string_dicot)
             logging.info('Binary genesets for adjustment: ' + prefix_cond_string_dicot)
-            combine_conditional_genesets()
-        
-        
+
+    write_magma_sets(sets)
+    annot_key = download_magma(args)
+    record_stage(args.record_run, 'magma_staging', features, start_time)
  
     # Run MAGMA
+    start_time = time.time()
+    run_gene_analysis(list_sumstats_file,args.n_jobs,args.magma_ref_dir,annot_key,args.magma_cache,scratch)
+    record_stage(args.record_run, 'magma_gene_analysis', features, start_time)
+    scratch.release('gene_analysis')
+    start_time = time.time()
+    uploader = AsyncUploader()
     for sumstats in list_sumstats_file:
         phname = os.path.basename(sumstats).replace('.sumstats.gz','')
-        run_magma(args,sumstats,phname,prefix_cond_string_dicot,prefix_cond_string_cont,ncol_out)
+        scratch.register([work('tmp/genes_for_magma_') + phname + '.genes.*'], ['gsa_' + phname])
+        with scratch.stage('gsa_' + phname):
+            run_magma(args,phname,prefix_cond_string_dicot,prefix_cond_string_cont,ncol_out)
+        # Results of a trait are uploaded in the background while the next one runs
+        uploader.submit(work('magma_results_') + phname + '.*',os.path.join(args.out,""))
+    record_stage(args.record_run, 'magma_gsa', features, start_time)
 
     # Writing the results
-    subprocess.call(['gsutil','-m','cp','/mnt/data/magma_results_*',os.path.join(args.out,"")])
+    uploader.submit(work('magma_results_*'),os.path.join(args.out,""))
+    scratch.summary()
+    if uploader.close():
+        sys.exit("Some result files could not be uploaded - Interrupting")
 
     logging.info('FINITO!')
 
+
+if __name__ == "__main__":
+    main(parse_args())
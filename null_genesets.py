@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import pandas as pd
+import numpy as np
+import argparse
+import gzip
+import logging
+import os
+from ldscore_api import load_panel, normalize_chrom, gene_window, genes_to_intervals, annotate_snps
+
+
+MATCH_LEVELS = [['LENGTH_BIN','NSNP_BIN','DENSITY_BIN'], ['LENGTH_BIN','NSNP_BIN'], []]
+
+
+def gene_features(coords, panel, window, gene_col='GENENAME'):
+
+    """ Gene length, number of panel SNPs in the gene window (coverage) and SNP density of every gene """
+
+    genes = coords[coords.CHR.map(normalize_chrom).isin([normalize_chrom(x) for x in panel['chroms']])].reset_index(drop=True)
+    windows = gene_window(genes, window)
+    start = windows.START.values
+    end = windows.END.values
+    nsnp = np.zeros(len(genes))
+    for chrom in panel['chroms']:
+        sel = (genes.CHR.map(normalize_chrom) == normalize_chrom(chrom)).values
+        bp = np.sort(panel['bim'][chrom].BP.values)
+        nsnp[sel] = np.searchsorted(bp, end[sel], side='right') - np.searchsorted(bp, start[sel], side='left')
+    df = pd.DataFrame({'GENE': genes[gene_col].values,
+                       'LENGTH': (genes.END - genes.START).values,
+                       'NSNP': nsnp})
+    df['DENSITY'] = df.NSNP / np.maximum(end - start, 1)
+    return df.drop_duplicates('GENE').reset_index(drop=True)
+
+
+def sample_matched(test_genes, features, n_null, n_bins=5, seed=0):
+
+    """ n_null random genesets matched gene by gene to test_genes on length, SNP coverage and density quantile bins.
+        Strata without enough genes fall back to length and coverage only, then to all genes """
+
+    rng = np.random.RandomState(seed)
+    f = features.copy()
+    for col in ['LENGTH','NSNP','DENSITY']:
+        f[col + '_BIN'] = pd.qcut(f[col].rank(method='first'), n_bins, labels=False)
+    is_test = f.GENE.isin(set(test_genes)).values
+    todo = f[is_test]
+    pool_df = f[~is_test]
+    null = [[] for i in range(n_null)]
+    for keys in MATCH_LEVELS:
+        if todo.empty:
+            break
+        left = []
+        for key, group in (todo.groupby(keys) if keys else [(None, todo)]):
+            if keys:
+                pool = pool_df.GENE.values[np.all(pool_df[keys].values == np.atleast_1d(key), axis=1)]
+            else:
+                pool = pool_df.GENE.values
+            if len(pool) < len(group):
+                if keys:
+                    left.append(group)
+                    continue
+                raise ValueError('Not enough genes outside the test set to sample matched null genesets')
+            # One independent draw without replacement per null geneset
+            draws = np.argsort(rng.rand(n_null, len(pool)), axis=1)[:, :len(group)]
+            for i in range(n_null):
+                null[i] += list(pool[draws[i]])
+        todo = pd.concat(left) if left else todo.iloc[:0]
+    return [sorted(set(x)) for x in null]
+
+
+def write_null_gmt(null_sets, out_file):
+
+    """ Null genesets as a GMT file (name, test set, genes), e.g. for main_magma.py --main-annot-gmt """
+
+    with open(out_file, 'w') as f:
+        for name, sets in null_sets:
+            for i, genes in enumerate(sets):
+                f.write('\t'.join([name + '_null_NULL' + str(i + 1), name] + list(genes)) + '\n')
+
+
+def write_null_annotations(null_sets, coords, panel, window, out_prefix, gene_col='GENENAME'):
+
+    """ One thin .annot.gz per chromosome with a binary column (NULL1..NULLn) per null geneset, so their LDscores come from one pass """
+
+    genes = sorted(set(g for x in null_sets for g in x))
+    intervals = genes_to_intervals(genes, coords, window, gene_col)
+    for chrom in panel['chroms']:
+        chrom_intervals = intervals[intervals.CHR.map(normalize_chrom) == normalize_chrom(chrom)]
+        annot = pd.DataFrame(dict(('NULL' + str(i + 1), annotate_snps(chrom_intervals[chrom_intervals[gene_col].isin(x)], panel['bim'][chrom]))
+                                  for i, x in enumerate(null_sets)),
+                             columns=['NULL' + str(i + 1) for i in range(len(null_sets))])
+        with gzip.open(out_prefix + '.' + str(chrom) + '.annot.gz', 'wb') as f:
+            f.write(annot.to_csv(sep='\t', index=False).encode('utf-8'))
+
+
+def null_calibration(results, null_results, out_file):
+
+    """ Empirical P-value of every test set: fraction of its matched null genesets with a coefficient z-score at least as large """
+
+    rows = []
+    null_z = null_results.Coefficient / null_results.Coefficient_std_error
+    for i, x in results.iterrows():
+        z = null_z[null_results.Name.str.startswith(x.Name + '_null_') | (null_results.Name == x.Name + '_null')].values
+        if not len(z):
+            continue
+        z_test = x.Coefficient / x.Coefficient_std_error
+        rows.append((x.Name, x.Coefficient, x.Coefficient_P_value, len(z), np.mean(z), np.std(z, ddof=1) if len(z) > 1 else np.nan,
+                     (1.0 + np.sum(z >= z_test)) / (1.0 + len(z))))
+    df = pd.DataFrame(rows, columns=['Name','Coefficient','Coefficient_P_value','N_null','Null_z_mean','Null_z_sd','Empirical_P_value'])
+    df = df.sort_values(by='Empirical_P_value')
+    df.to_csv(out_file, sep='\t', index=False)
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--geneset-file', required=True, help = 'File with the genes of the test set, one per line')
+    parser.add_argument('--gene-coord-file', required=True, help = 'File with gene coordinates: GENE CHR START END, with header')
+    parser.add_argument('--gene-col-name', default='GENENAME', help = 'Gene column name in --gene-coord-file')
+    parser.add_argument('--bfile-chr', required=True, help = 'Prefix of the chr-specific plink files used to count SNPs in each gene window')
+    parser.add_argument('--windowsize', type=int, default=100000, help = 'Size of the window around the gene')
+    parser.add_argument('--n-null', type=int, default=100, help = 'Number of matched null genesets, default=100')
+    parser.add_argument('--n-bins', type=int, default=5, help = 'Number of quantile bins of each matching feature, default=5')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', required=True, help = 'Output prefix: <out>.null_genesets.gmt and <out>.<chrom>.annot.gz')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    coords = pd.read_csv(args.gene_coord_file, delim_whitespace=True)
+    panel = load_panel(bfile_chr=args.bfile_chr)
+    test_genes = pd.read_csv(args.geneset_file, delim_whitespace=True, header=None)[0].values
+    null_sets = sample_matched(test_genes, gene_features(coords, panel, args.windowsize, args.gene_col_name), args.n_null, args.n_bins, args.seed)
+    name = os.path.basename(args.out)
+    write_null_gmt([(name, null_sets)], args.out + '.null_genesets.gmt')
+    write_null_annotations(null_sets, coords, panel, args.windowsize, args.out, args.gene_col_name)
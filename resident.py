@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import glob
+import logging
+import os
+from result_cache import file_checksum
+
+
+# Loaded reference data kept in memory between the jobs of a worker (worker.py), by loader name
+STATE = {}
+SETTINGS = {'enabled': False, 'max_entries': 2}
+# (mtime, size, md5) of the files seen by file_stamps
+CHECKSUMS = {}
+
+
+def enable(max_entries=2):
+
+    """ Keep the results of resident_load in memory, up to max_entries variants per loader """
+
+    SETTINGS['enabled'] = True
+    SETTINGS['max_entries'] = max_entries
+
+
+def file_stamps(paths):
+
+    """ (path, size, md5) of the files behind a list of files, folders or chr-split prefixes. Files copied again by each job
+        (gene coordinates, SNP lists) get a new mtime, so the checksum is the key; it is only recomputed when the
+        mtime or size of a file changed """
+
+    stamps = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(glob.glob(os.path.join(path, '*')))
+        else:
+            files = [path] if os.path.isfile(path) else sorted(glob.glob(path + '*'))
+        for x in files:
+            mtime, size = os.path.getmtime(x), os.path.getsize(x)
+            if CHECKSUMS.get(x, (None,))[:2] != (mtime, size):
+                CHECKSUMS[x] = (mtime, size, file_checksum(x))
+            stamps.append((x, size, CHECKSUMS[x][2]))
+    return tuple(stamps)
+
+
+def resident_load(name, paths, loader, *args, **kwargs):
+
+    """ loader(*args, **kwargs), reused while the files it reads (paths) are unchanged when resident state is enabled.
+        Each name keeps its max_entries most recently used variants, so per-chromosome data is loaded under one
+        name per chromosome. Callers must not modify what is returned """
+
+    if not SETTINGS['enabled']:
+        return loader(*args, **kwargs)
+    key = (repr(args), repr(sorted(kwargs.items())), file_stamps(paths))
+    entries = STATE.setdefault(name, [])
+    for i, (entry_key, value) in enumerate(entries):
+        if entry_key == key:
+            logging.debug('Resident ' + name + ' reused')
+            # Least recently used variants are dropped first
+            entries.append(entries.pop(i))
+            return value
+    value = loader(*args, **kwargs)
+    entries.append((key, value))
+    del entries[:-SETTINGS['max_entries']]
+    return value
+
+
+def clear():
+    STATE.clear()
+    CHECKSUMS.clear()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import logging
+import math
+import os
+import subprocess
+import threading
+import time
+from scipy.optimize import nnls
+
+
+# Cost model of each stage: seconds and peak memory (MB) as linear functions of the job features.
+# 'ldscores' covers making the annotations and computing their LDscores.
+# These are starting values from typical 1000 genomes / baselineLD runs on n1-standard VMs;
+# recorded runs (--record-run) refine them with resource_estimator.py fit.
+DEFAULT_COEFFICIENTS = {
+    'staging':               {'seconds': {'const': 30, 'staging_gb': 12},
+                              'memory_mb': {'const': 300}},
+    'ldscores':              {'seconds': {'const': 0, 'sets': 1320, 'columns': 60},
+                              'memory_mb': {'const': 3000, 'columns': 20}},
+    'ldscores_store':        {'seconds': {'const': 0, 'sets': 50, 'columns': 5},
+                              'memory_mb': {'const': 2500, 'columns': 20}},
+    'ldscores_atoms':        {'seconds': {'const': 60, 'sets': 10, 'columns': 1},
+                              'memory_mb': {'const': 2000, 'columns': 5}},
+    'regression':            {'seconds': {'const': 0, 'sumstats': 120, 'sumstats_cts': 15, 'sumstats_cts_full': 150},
+                              'memory_mb': {'const': 3000, 'cond_panels': 1000}},
+    'regression_in_process': {'seconds': {'const': 60, 'sumstats': 60, 'sumstats_cts': 0.5, 'sumstats_cts_full': 1},
+                              'memory_mb': {'const': 3000, 'cond_panels': 1000, 'cts': 6}},
+    'magma_staging':         {'seconds': {'const': 30, 'staging_gb': 12},
+                              'memory_mb': {'const': 300}},
+    'magma_gene_analysis':   {'seconds': {'const': 0, 'batches_per_core': 90},
+                              'memory_mb': {'const': 500, 'cores': 500}},
+    'magma_gsa':             {'seconds': {'const': 0, 'sumstats': 20, 'sumstats_sets': 0.2},
+                              'memory_mb': {'const': 1000, 'sets': 2}},
+}
+
+# Disk use (GB) of the files a job writes, on top of what it stages
+OUTPUT_GB = {'per_set': 0.05, 'per_column': 0.025, 'per_sumstat': 0.2}
+
+
+def path_bytes(path):
+
+    """ Size in bytes of a local or google bucket file or folder, without downloading it """
+
+    if not path:
+        return 0
+    if path.startswith('gs://'):
+        try:
+            out = subprocess.check_output(['gsutil','du','-s',path.rstrip('*')]).decode('utf-8')
+            return int(out.split()[0])
+        except (subprocess.CalledProcessError, IndexError, ValueError):
+            logging.warning('Could not get the size of ' + path)
+            return 0
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def read_lines(path):
+
+    """ Lines of a small input file (gene list, ldcts file), local or in a bucket """
+
+    if path.startswith('gs://'):
+        text = subprocess.check_output(['gsutil','cat',path]).decode('utf-8')
+    else:
+        with open(path) as f:
+            text = f.read()
+    return [x for x in text.splitlines() if x.strip()]
+
+
+def n_bins(args, first_geneset):
+
+    """ Number of annotation columns a geneset becomes: 1 if binary, else the number of bins """
+
+    if len(read_lines(first_geneset)[0].split()) < 2:
+        return 1
+    if getattr(args, 'cont_breaks', None):
+        return len(args.cont_breaks.split(',')) + 1
+    return args.quantiles or 1
+
+
+def split(value):
+    return value.split(',') if value else []
+
+
+def ldscores_stage(args):
+
+    """ Cost model stage of the LDscore computation of a main_ldscore.py run """
+
+    if args.atom_basis:
+        return 'ldscores_atoms'
+    return 'ldscores_store' if args.ld_matrix_store else 'ldscores'
+
+
+def ldsc_features(args):
+
+    """ Job features of a main_ldscore.py run, from the arguments and the small input files only """
+
+    f = {'sumstats': len(split(args.summary_stats_files)), 'cond_panels': 0, 'sets': 0, 'columns': 0, 'cts': 0}
+    genesets = []
+    if args.main_annot_ldcts:
+        genesets = [x.split()[1] for x in read_lines(args.main_annot_ldcts)]
+    elif args.main_annot_genes or args.main_annot_rsids or args.main_annot_bed:
+        genesets = [args.main_annot_genes or args.main_annot_rsids or args.main_annot_bed]
+    if genesets:
+        f['sets'] = len(genesets)
+        f['columns'] = len(genesets) * n_bins(args, genesets[0])
+        f['cts'] = f['columns']
+    elif args.main_annot_ldscores_ldcts:
+        f['cts'] = len(read_lines(args.main_annot_ldscores_ldcts))
+    elif args.main_annot_ldscores:
+        f['cts'] = 1
+    if getattr(args, 'null_genesets', 0):
+        f['sets'] += len(genesets)
+        f['columns'] += len(genesets) * args.null_genesets
+    cond = split(args.condition_annot_genes or args.condition_annot_rsids or args.condition_annot_bed)
+    f['sets'] += len(cond)
+    f['columns'] += len(cond)
+    f['cond_panels'] = len(cond) + len(split(args.condition_annot_ldscores)) + (0 if args.no_baseline else 1)
+    f['sumstats_cts'] = f['sumstats'] * f['cts']
+    f['sumstats_cts_full'] = f['sumstats_cts'] if args.full_report else 0
+
+    staged = [args.tkg_plink_folder, args.tkg_weights_folder, args.tkg_freq_folder, args.ld_matrix_store,
+              args.atom_basis, args.main_annot_ldscores] + split(args.summary_stats_files) + split(args.condition_annot_ldscores)
+    if not args.no_baseline:
+        staged.append(args.baseline_ldscores_folder)
+    if args.main_annot_ldscores_ldcts:
+        staged += [x.split()[1] for x in read_lines(args.main_annot_ldscores_ldcts)]
+    f['staging_gb'] = sum(path_bytes(x) for x in staged) / 1e9
+    f['output_gb'] = f['sets'] * OUTPUT_GB['per_set'] + f['columns'] * OUTPUT_GB['per_column'] + f['sumstats'] * OUTPUT_GB['per_sumstat']
+    f['stages'] = ['staging',
+                   ldscores_stage(args) if f['sets'] else None,
+                   None if args.just_ldscores else ('regression_in_process' if args.in_process_regression else 'regression')]
+    return f
+
+
+def magma_features(args):
+
+    """ Job features of a main_magma.py run, from the arguments and the small input files only """
+
+    f = {'sumstats': len(split(args.summary_stats_files)), 'sets': 0, 'cores': args.n_jobs}
+    if args.main_annot_ldcts:
+        genesets = [x.split()[1] for x in read_lines(args.main_annot_ldcts)]
+        f['sets'] += len(genesets) * n_bins(args, genesets[0])
+    if args.main_annot_genes:
+        f['sets'] += n_bins(args, args.main_annot_genes)
+    if args.main_annot_gmt:
+        f['sets'] += len(read_lines(args.main_annot_gmt))
+    f['sets'] += len(split(args.condition_annot_genes))
+    f['sumstats_sets'] = f['sumstats'] * f['sets']
+    f['batches_per_core'] = math.ceil(f['sumstats'] * 22.0 / max(1, args.n_jobs))
+    ref = [] if os.path.exists(os.path.join(args.magma_ref_dir, 'g1000_eur.bed')) else ['gs://singlecellldscore/g1000_eur.zip']
+    f['staging_gb'] = sum(path_bytes(x) for x in ref + split(args.summary_stats_files)) / 1e9
+    # The unzipped reference panel takes about twice the zip
+    f['output_gb'] = 2 * f['staging_gb'] + f['sumstats'] * OUTPUT_GB['per_sumstat']
+    f['stages'] = ['magma_staging', 'magma_gene_analysis', 'magma_gsa']
+    return f
+
+
+def load_coefficients(calibration_file=None):
+    coefficients = json.loads(json.dumps(DEFAULT_COEFFICIENTS))
+    if calibration_file:
+        with open(calibration_file) as f:
+            coefficients.update(json.load(f))
+    return coefficients
+
+
+def predict(features, coefficients):
+
+    """ Seconds and peak memory of every stage of a job """
+
+    rows = []
+    for stage in [x for x in features['stages'] if x]:
+        row = {'stage': stage}
+        for target in ['seconds', 'memory_mb']:
+            coef = coefficients[stage][target]
+            row[target] = sum(c * (1 if k == 'const' else features.get(k, 0)) for k, c in coef.items())
+        rows.append(row)
+    return pd.DataFrame(rows, columns=['stage','seconds','memory_mb'])
+
+
+def recommend(stages, features, min_cores=4, headroom=1.3):
+
+    """ dsub --min-ram (GB), --min-cores and --disk-size (GB) for the predicted peaks """
+
+    ram = max(4, int(math.ceil(stages.memory_mb.max() * headroom / 1024.0)))
+    disk = max(50, int(math.ceil((features['staging_gb'] + features['output_gb']) * headroom / 10.0 + 1)) * 10)
+    cores = max(min_cores, features.get('cores', min_cores))
+    return {'min-ram': ram, 'min-cores': cores, 'disk-size': disk}
+
+
+def print_estimate(features, stages, flags):
+    print('Staging: {0:.2f} GB, outputs: {1:.2f} GB'.format(features['staging_gb'], features['output_gb']))
+    for _, x in stages.iterrows():
+        print('{0:<24}{1:>10.1f} min{2:>10.1f} GB'.format(x.stage, x.seconds / 60.0, x.memory_mb / 1024.0))
+    print('Total wall time: {0:.1f} h'.format(stages.seconds.sum() / 3600.0))
+    print('Recommended dsub flags: ' + ' '.join('--' + k + ' ' + str(v) for k, v in sorted(flags.items())))
+
+
+def estimate(features, calibration_file=None):
+
+    """ Print the per-stage prediction and the recommended dsub flags of a job """
+
+    stages = predict(features, load_coefficients(calibration_file))
+    flags = recommend(stages, features)
+    print_estimate(features, stages, flags)
+    return stages, flags
+
+
+def process_tree_rss_mb(pid):
+
+    """ Resident memory of a process and all its descendants, from /proc """
+
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/' + entry + '/stat') as f:
+                # The command name in parentheses may contain spaces, the parent pid is the 2nd field after it
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    pages = 0
+    todo = [pid]
+    while todo:
+        x = todo.pop()
+        todo += children.get(x, [])
+        try:
+            with open('/proc/' + str(x) + '/statm') as f:
+                pages += int(f.read().split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+
+
+class MemorySampler(object):
+
+    """ Peak resident memory of this process and its children (ldsc.py, magma, joblib workers) since the last
+        reset, sampled by a background thread, so each stage records its own peak of the concurrent processes """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.peak = 0.0
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._sample)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _sample(self):
+        while True:
+            generation = self.generation
+            rss = process_tree_rss_mb(os.getpid())
+            with self.lock:
+                # A sample taken before a reset belongs to the previous stage
+                if generation == self.generation:
+                    self.peak = max(self.peak, rss)
+            if self.stop.wait(self.interval):
+                return
+
+    def reset(self):
+
+        """ Peak since the last reset, and start a new one """
+
+        rss = process_tree_rss_mb(os.getpid())
+        with self.lock:
+            peak = max(self.peak, rss)
+            self.peak = 0.0
+            self.generation += 1
+        return peak
+
+
+MEMORY = {'sampler': None}
+
+
+def track_memory(runs_file):
+
+    """ Start measuring the memory of the stages of a job recorded with --record-run """
+
+    if not runs_file or not os.path.isdir('/proc'):
+        return
+    if MEMORY['sampler'] is None:
+        MEMORY['sampler'] = MemorySampler()
+    MEMORY['sampler'].reset()
+
+
+def record_stage(runs_file, stage, features, start_time):
+
+    """ Append the measured time and peak memory of a finished stage to a runs log used to fit the cost model """
+
+    if not runs_file:
+        return
+    # None without /proc: the stage has no memory measurement
+    memory_mb = MEMORY['sampler'].reset() if MEMORY['sampler'] else None
+    record = {'stage': stage, 'seconds': time.time() - start_time, 'memory_mb': memory_mb,
+              'features': dict((k, v) for k, v in features.items() if k != 'stages')}
+    with open(runs_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def fit_calibration(runs_files, out_file):
+
+    """ Non-negative least squares fit of the cost model of every stage from recorded runs """
+
+    coefficients = load_coefficients()
+    records = []
+    for runs_file in runs_files:
+        with open(runs_file) as f:
+            records += [json.loads(x) for x in f if x.strip()]
+    fitted = {}
+    for stage in coefficients:
+        recs = [x for x in records if x['stage'] == stage]
+        if not recs:
+            continue
+        fitted[stage] = {}
+        for target in ['seconds', 'memory_mb']:
+            keys = sorted(coefficients[stage][target])
+            measured = [x for x in recs if x[target] is not None]
+            if not measured:
+                fitted[stage][target] = coefficients[stage][target]
+                continue
+            X = np.array([[1.0 if k == 'const' else float(x['features'].get(k, 0)) for k in keys] for x in measured])
+            y = np.array([x[target] for x in measured])
+            fitted[stage][target] = dict(zip(keys, nnls(X, y)[0]))
+        logging.info('Fitted ' + stage + ' from ' + str(len(recs)) + ' recorded run(s)')
+    with open(out_file, 'w') as f:
+        json.dump(fitted, f, indent=2, sort_keys=True)
+    return fitted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['fit'])
+    parser.add_argument('--runs', required=True, help = 'Comma separated runs logs written with --record-run')
+    parser.add_argument('--out', required=True, help = 'Calibration file to write, used with --estimate-calibration')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    fit_calibration(args.runs.split(','), args.out)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+
+
+def is_gcs(path):
+    return path.startswith('gs://')
+
+
+def file_checksum(path, block_size=1 << 20):
+
+    """ md5 checksum of a local file """
+
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def cache_key(*parts):
+
+    """ Key of a cache entry from the values (checksums, parameters) it depends on """
+
+    return hashlib.sha1('|'.join(str(x) for x in parts).encode('utf-8')).hexdigest()
+
+
+def cache_path(cache_dir, namespace, key, name=''):
+    return os.path.join(cache_dir, namespace, key, name)
+
+
+def cache_exists(cache_dir, namespace, key, names):
+
+    """ True if every file of a cache entry is present """
+
+    for name in names:
+        path = cache_path(cache_dir, namespace, key, name)
+        if is_gcs(path):
+            if subprocess.call(['gsutil','-q','stat',path]) != 0:
+                return False
+        elif not os.path.exists(path):
+            return False
+    return True
+
+
+def cache_fetch(cache_dir, namespace, key, names, dest_dir, dest_names=None):
+
+    """ Copy the files of a cache entry to dest_dir (optionally renamed), return False on a cache miss """
+
+    if not cache_dir or not cache_exists(cache_dir, namespace, key, names):
+        return False
+    logging.info('Cache hit for ' + namespace + ' ' + key)
+    for name, dest_name in zip(names, dest_names or names):
+        src = cache_path(cache_dir, namespace, key, name)
+        if is_gcs(src):
+            subprocess.call(['gsutil','cp',src,os.path.join(dest_dir, dest_name)])
+        else:
+            # Keep the modification time so resident copies of the file (resident.py) stay valid
+            shutil.copy2(src, os.path.join(dest_dir, dest_name))
+    return True
+
+
+def cache_store(cache_dir, namespace, key, paths, names=None):
+
+    """ Save local files as a cache entry (optionally under other names) """
+
+    if not cache_dir:
+        return
+    logging.info('Storing ' + namespace + ' ' + key + ' in cache ' + cache_dir)
+    for path, name in zip(paths, names or [os.path.basename(x) for x in paths]):
+        dest = cache_path(cache_dir, namespace, key, name)
+        if is_gcs(dest):
+            subprocess.call(['gsutil','cp',path,dest])
+            continue
+        try:
+            os.makedirs(os.path.dirname(dest))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(dest)):
+                raise
+        # Write under a temporary name first so concurrent jobs never read a partial file
+        tmp = os.path.join(os.path.dirname(dest), '.' + name + '.tmp' + str(os.getpid()))
+        shutil.copy(path, tmp)
+        os.rename(tmp, dest)
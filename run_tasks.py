@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import argparse
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import time
+from staging import work_dir
+
+
+THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+
+def read_tasks(tasks_file):
+
+    """ Rows of a dsub --tasks file as lists of (kind, name, value), kind being env, input, input-recursive, output, output-recursive or label """
+
+    with open(tasks_file) as f:
+        lines = [x.rstrip('\n') for x in f if x.strip()]
+    header = [x.split() for x in lines[0].split('\t')]
+    tasks = []
+    for line in lines[1:]:
+        values = line.split('\t')
+        values += [''] * (len(header) - len(values))
+        tasks.append([(h[0].lstrip('-'), h[1], v.strip()) for h, v in zip(header, values)])
+    return tasks
+
+
+def localize(kind, value, task_dir):
+
+    """ Local path given to the script for a dsub --input/--output parameter, copying inputs from the bucket """
+
+    folder = os.path.join(task_dir, kind.split('-')[0])
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    if not value.startswith('gs://'):
+        return value
+    local = os.path.join(folder, os.path.basename(value.rstrip('/')))
+    if kind.startswith('input'):
+        subprocess.call(['gsutil','-m','cp'] + (['-r'] if kind == 'input-recursive' else []) + [value, folder])
+    return local
+
+
+def delocalize(kind, value, local):
+
+    """ Copy a dsub --output parameter of a finished task to the bucket """
+
+    if not value.startswith('gs://'):
+        return 0
+    if kind == 'output-recursive':
+        return subprocess.call(['gsutil','-m','cp','-r',os.path.join(local, '*'),os.path.join(value, '')])
+    # A wildcard output is copied into the folder of the pattern
+    dest = os.path.dirname(value) + '/' if '*' in os.path.basename(value) else value
+    return subprocess.call(['gsutil','-m','cp',local,dest])
+
+
+def run_task(task):
+
+    """ Run the script of one task in its own working folder, with the shared reference folder, return (index, exit code, seconds) """
+
+    index, params, script, root, ref_dir, cores, keep = task
+    start = time.time()
+    task_dir = os.path.join(root, 'task-' + str(index))
+    if not os.path.exists(task_dir):
+        os.makedirs(task_dir)
+    env = dict(os.environ)
+    env.update({'SC_WORK_DIR': task_dir, 'SC_REFERENCE_DIR': ref_dir})
+    env.update(dict((x, str(cores)) for x in THREAD_VARS))
+    outputs = []
+    with open(os.path.join(root, 'task-' + str(index) + '.log'), 'w') as log:
+        for kind, name, value in params:
+            if kind == 'env':
+                env[name] = value
+            elif kind.startswith('input') or kind.startswith('output'):
+                env[name] = localize(kind, value, task_dir)
+                if kind.startswith('output'):
+                    outputs.append((kind, value, env[name]))
+        cmd = [script] if os.access(script, os.X_OK) else [sys.executable, script]
+        log.flush()
+        code = subprocess.call(cmd, cwd=task_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        if code == 0:
+            code = max([delocalize(kind, value, local) for kind, value, local in outputs] or [0])
+    if code == 0 and not keep:
+        shutil.rmtree(task_dir, ignore_errors=True)
+    return index, code, time.time() - start
+
+
+def run_tasks(tasks_file, script, root, ref_dir=None, n_jobs=None, cores=4, keep=False, tasks_range=None):
+
+    """ Run the rows of a dsub tasks file concurrently on this machine, one process and working folder per task """
+
+    tasks = read_tasks(tasks_file)
+    first, last = (tasks_range[0], tasks_range[-1]) if tasks_range else (1, len(tasks))
+    ref_dir = ref_dir or os.path.join(root, 'reference')
+    n_jobs = n_jobs or max(1, multiprocessing.cpu_count() // cores)
+    for folder in [root, ref_dir]:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    todo = [(i, tasks[i - 1], os.path.abspath(script), root, ref_dir, cores, keep) for i in range(first, last + 1)]
+    logging.info('Running ' + str(len(todo)) + ' task(s) of ' + tasks_file + ', ' + str(n_jobs) + ' at a time, in ' + root)
+    failed = []
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        for index, code, seconds in pool.imap_unordered(run_task, todo):
+            if code:
+                failed.append(index)
+                logging.error('Task ' + str(index) + ' failed with status ' + str(code) + ', see ' + os.path.join(root, 'task-' + str(index) + '.log'))
+            else:
+                logging.info('Task ' + str(index) + ' done in ' + str(round(seconds)) + ' s')
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', required=True, help = 'dsub tasks file: a header of --env/--input/--output NAME columns and one tab-separated row per task')
+    parser.add_argument('--tasks-range', help = 'Only run these rows of the tasks file (1-based, inclusive), e.g. 3-10')
+    parser.add_argument('--script', required=True, help = 'Script run for every task, as dsub --script (e.g. example/run_sc_enrichment_example.py)')
+    parser.add_argument('--work-root', default=work_dir(), help = 'Folder holding one working folder (task-N) and log (task-N.log) per task, default is $SC_WORK_DIR or /mnt/data')
+    parser.add_argument('--reference-dir', help = 'Folder of the reference data staged once and shared read-only by the tasks, default is <work-root>/reference')
+    parser.add_argument('--cores-per-task', type=int, default=4, help = 'Cores given to each task (thread pools of numpy/BLAS), default=4')
+    parser.add_argument('--n-jobs', type=int, help = 'Number of tasks run at the same time, default is the number of cores / --cores-per-task')
+    parser.add_argument('--keep-work', action='store_true', default=False, help = 'Keep the working folder of successful tasks (failed ones are always kept)')
+    parser.add_argument("--verbose", help="increase output verbosity",action="store_true")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    tasks_range = tuple(int(x) for x in args.tasks_range.split('-')) if args.tasks_range else None
+    failed = run_tasks(args.tasks, args.script, os.path.abspath(args.work_root), args.reference_dir and os.path.abspath(args.reference_dir),
+                       args.n_jobs, args.cores_per_task, args.keep_work, tasks_range)
+    if failed:
+        sys.exit('Failed task(s): ' + ','.join(str(x) for x in sorted(failed)))
+    logging.info('FINITO!')
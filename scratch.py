@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import glob
+import logging
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from async_upload import copy_file
+
+
+def disk_used(path):
+
+    """ Bytes used on the filesystem holding path """
+
+    st = os.statvfs(path)
+    return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+
+def path_size(path):
+    if os.path.islink(path) or not os.path.exists(path):
+        return 0
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+class ScratchManager(object):
+
+    """ Reference-counted intermediate files of a job. A file registered with the stages that read it is deleted,
+        or first spilled to a bucket folder, once the last of those stages is released.
+        With a disk budget, a stage waits to start while the scratch disk is over it and other stages are still running """
+
+    def __init__(self, root='/mnt/data', budget_gb=None, enabled=True, poll_seconds=5):
+        self.root = root
+        self.budget = budget_gb * 1e9 if budget_gb else None
+        self.enabled = enabled
+        self.poll_seconds = poll_seconds
+        self.consumers = {}
+        self.spill = {}
+        self.running = 0
+        self.freed = 0
+        self.cond = threading.Condition()
+
+    def register(self, paths, consumers, spill_dir=None):
+
+        """ Track the files (or glob patterns) of paths as read by the given stages """
+
+        if not self.enabled:
+            return
+        with self.cond:
+            for pattern in paths:
+                for path in glob.glob(pattern):
+                    self.consumers.setdefault(path, set()).update(consumers)
+                    if spill_dir:
+                        self.spill[path] = spill_dir
+
+    def release(self, consumer):
+
+        """ A stage is done with its inputs: drop the files no other stage needs """
+
+        with self.cond:
+            done = [path for path, consumers in self.consumers.items() if consumers <= set([consumer])]
+            for path in self.consumers:
+                self.consumers[path].discard(consumer)
+            for path in done:
+                del self.consumers[path]
+        for path in done:
+            self._drop(path)
+        with self.cond:
+            self.cond.notify_all()
+
+    def remove(self, paths):
+
+        """ Drop files (or glob patterns) that no stage needs any more """
+
+        self.register(paths, ['_remove'])
+        self.release('_remove')
+
+    def _drop(self, path):
+        spill_dir = self.spill.pop(path, None)
+        if spill_dir and os.path.isfile(path):
+            if not copy_file(path, os.path.join(spill_dir, os.path.basename(path))):
+                logging.warning('Could not spill ' + path + ' to ' + spill_dir + ', keeping it')
+                return
+        size = path_size(path)
+        remove_path(path)
+        self.freed += size
+        logging.debug('Scratch: removed ' + path)
+
+    def _start(self, name):
+        if self.budget is None:
+            with self.cond:
+                self.running += 1
+            return
+        with self.cond:
+            if disk_used(self.root) > self.budget and self.running:
+                logging.info('Scratch disk over ' + str(self.budget / 1e9) + ' GB, ' + name + ' waits for a running stage to finish')
+            while disk_used(self.root) > self.budget and self.running:
+                self.cond.wait(self.poll_seconds)
+            if disk_used(self.root) > self.budget:
+                # Nothing running here can free space, waiting would not help
+                logging.warning('Scratch disk over ' + str(self.budget / 1e9) + ' GB, running ' + name + ' anyway')
+            self.running += 1
+
+    @contextmanager
+    def stage(self, name):
+
+        """ Run a stage under the disk budget and release its inputs when it finishes """
+
+        self._start(name)
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.running -= 1
+            self.release(name)
+
+    def summary(self):
+        if self.enabled:
+            logging.info('Scratch: ' + str(round(self.freed / 1e9, 2)) + ' GB of intermediate files removed during the job')
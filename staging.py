@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import fcntl
+import logging
+import os
+import subprocess
+from contextlib import contextmanager
+
+
+def work_dir():
+
+    """ Default working folder of a job: $SC_WORK_DIR (set per task by run_tasks.py), else /mnt/data, the data disk of the dsub VMs """
+
+    return os.environ.get('SC_WORK_DIR', '/mnt/data')
+
+
+def reference_dir():
+
+    """ Default folder of the reference data shared by the jobs of a machine: $SC_REFERENCE_DIR, else None (the working folder) """
+
+    return os.environ.get('SC_REFERENCE_DIR')
+
+
+@contextmanager
+def reference_lock(ref_dir):
+
+    """ Hold an exclusive lock on a reference folder while staging into it, so concurrent jobs download it once """
+
+    if not os.path.exists(ref_dir):
+        try:
+            os.makedirs(ref_dir)
+        except OSError:
+            # Created by another job in the meantime
+            pass
+    with open(os.path.join(ref_dir, '.staging.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def stage_file(src, dest_dir, dest_name=None):
+
+    """ Copy an input into dest_dir unless it has already been staged there (e.g. by main_enrichment.py), return the local path """
+
+    dest = os.path.join(dest_dir, dest_name or os.path.basename(src.rstrip('/')))
+    if os.path.exists(dest):
+        logging.info('Already staged: ' + dest)
+        return dest
+    subprocess.call(['gsutil','cp',src,dest])
+    return dest
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+from __future__ import print_function,division
+import argparse
+import glob
+import json
+import logging
+import os
+import shutil
+import time
+import resident
+from staging import work_dir
+import main_ldscore
+import main_magma
+
+
+PIPELINES = {'ldsc': main_ldscore, 'magma': main_magma}
+SPOOL_DIRS = ['incoming', 'running', 'done', 'failed']
+WORK_DIR = work_dir()
+# Per-job folders and the top-level reference files kept between jobs; every other top-level file belongs to a job
+JOB_DIRS = ['ss', 'outld', 'outcondld', 'cond_ldscores', 'outnull', 'genesets', 'conditional_genesets', 'tmp',
+            'composite_panel', 'tmp_overlap', 'previous', 'prevld']
+REFERENCE_FILES = ['g1000_eur.*', 'NCBI37.3.gene.name.loc']
+
+
+def reset_workdir(work_dir=WORK_DIR):
+
+    """ Remove what the previous job left in the working folder, keeping the staged reference data """
+
+    keep = set(x for pattern in REFERENCE_FILES for x in glob.glob(os.path.join(work_dir, pattern)))
+    for name in os.listdir(work_dir):
+        path = os.path.join(work_dir, name)
+        if name in JOB_DIRS and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.isfile(path) and path not in keep:
+            os.remove(path)
+
+
+def make_spool(spool):
+    for x in SPOOL_DIRS:
+        if not os.path.exists(os.path.join(spool, x)):
+            os.makedirs(os.path.join(spool, x))
+
+
+def submit(spool, pipeline, job_args):
+
+    """ Queue a job (pipeline name and its command line arguments) in the spool folder, return the job file """
+
+    make_spool(spool)
+    name = time.strftime('%Y%m%d-%H%M%S') + '-' + str(os.getpid()) + '-' + pipeline + '.json'
+    tmp = os.path.join(spool, name + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump({'pipeline': pipeline, 'args': job_args}, f)
+    # The worker only picks up complete job files
+    os.rename(tmp, os.path.join(spool, 'incoming', name))
+    return os.path.join(spool, 'incoming', name)
+
+
+def claim(spool):
+
+    """ Move the oldest queued job to running/, None if there is none (or another worker took it) """
+
+    for path in sorted(glob.glob(os.path.join(spool, 'incoming', '*.json'))):
+        running = os.path.join(spool, 'running', os.path.basename(path))
+        try:
+            os.rename(path, running)
+        except OSError:
+            continue
+        return running
+    return None
+
+
+def run_job(job, cache_dir=None, work_dir=WORK_DIR):
+
+    """ Parse the job arguments as the pipeline script would and run it in this process, against the resident state """
+
+    pipeline = PIPELINES[job['pipeline']]
+    # The worker owns its working folder; given before parsing, it is also the default reference folder
+    args = pipeline.parse_args([str(x) for x in job['args']] + ['--work-dir', work_dir])
+    # Gene analysis results, composite panels and annotation overlaps are kept for later jobs
+    if cache_dir:
+        if job['pipeline'] == 'magma' and not args.magma_cache:
+            args.magma_cache = cache_dir
+        if job['pipeline'] == 'ldsc' and not args.panel_cache:
+            args.panel_cache = cache_dir
+    pipeline.main(args)
+
+
+def process(spool, running, cache_dir=None, work_dir=WORK_DIR):
+
+    """ Run one claimed job with its log next to it, and move it to done/ or failed/ """
+
+    name = os.path.basename(running)
+    handler = logging.FileHandler(os.path.join(spool, 'running', name[:-len('.json')] + '.log'))
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    logging.getLogger().addHandler(handler)
+    start = time.time()
+    status = 'done'
+    try:
+        with open(running) as f:
+            job = json.load(f)
+        logging.info('Job ' + name + ': ' + job['pipeline'] + ' ' + ' '.join(str(x) for x in job['args']))
+        reset_workdir(work_dir)
+        run_job(job, cache_dir, work_dir)
+    except SystemExit as e:
+        if e.code:
+            logging.error('Job ' + name + ' exited: ' + str(e.code))
+            status = 'failed'
+    except Exception:
+        logging.exception('Job ' + name + ' failed')
+        status = 'failed'
+    finally:
+        logging.info('Job ' + name + ' ' + status + ' in ' + str(round(time.time() - start)) + ' s')
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+    for path in [running, running[:-len('.json')] + '.log']:
+        os.rename(path, os.path.join(spool, status, os.path.basename(path)))
+    return status
+
+
+def serve(spool, cache_dir=None, poll_seconds=5, once=False, work_dir=WORK_DIR):
+
+    """ Run the jobs of the spool folder one after the other, keeping reference data loaded between them """
+
+    make_spool(spool)
+    resident.enable()
+    logging.info('Worker waiting for jobs in ' + os.path.join(spool, 'incoming'))
+    while True:
+        running = claim(spool)
+        if running:
+            process(spool, running, cache_dir, work_dir)
+        elif once:
+            return
+        else:
+            time.sleep(poll_seconds)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['serve','submit'], help = 'serve: run the queued jobs; submit: queue a job')
+    parser.add_argument('--spool', required=True, help = 'Spool folder (incoming/, running/, done/, failed/)')
+    parser.add_argument('--pipeline', choices=sorted(PIPELINES), help = 'submit: ldsc (main_ldscore.py) or magma (main_magma.py)')
+    parser.add_argument('--cache', help = 'serve: folder for the MAGMA gene analysis, composite panel and overlap caches of jobs that do not set their own')
+    parser.add_argument('--poll-seconds', type=float, default=5, help = 'serve: seconds between checks for new jobs, default=5')
+    parser.add_argument('--once', action='store_true', default=False, help = 'serve: stop when the queue is empty')
+    parser.add_argument('--work-dir', default=WORK_DIR, help = 'serve: working folder of the jobs, default is $SC_WORK_DIR or /mnt/data')
+    parser.add_argument('job_args', nargs=argparse.REMAINDER, help = 'submit: the arguments of the pipeline script, after --')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if args.command == 'submit':
+        if not args.pipeline:
+            parser.error('submit needs --pipeline')
+        job_args = args.job_args[1:] if args.job_args[:1] == ['--'] else args.job_args
+        print(submit(args.spool, args.pipeline, job_args))
+    else:
+        serve(args.spool, args.cache, args.poll_seconds, args.once, args.work_dir)